@@ -11,15 +11,49 @@ import httpx # <-- NEW: For async requests to LLM providers
 import asyncio # <-- NEW: For cancellation
 from enum import Enum
 from contextlib import asynccontextmanager
-from typing import List, Dict, Any, Optional, AsyncGenerator, Callable, Tuple, Set
+from typing import List, Dict, Any, Optional, AsyncGenerator, AsyncIterator, Callable, Tuple, Set
 from fastapi import FastAPI, HTTPException, Request, Query
-from fastapi.responses import StreamingResponse # <-- NEW: For SSE
+from fastapi.responses import StreamingResponse, Response # <-- NEW: For SSE
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field, ValidationError
-import traceback # <-- NEW: For detailed error logging
+import logging
 import re # Add 're' import at the top of the file
 from fastapi.staticfiles import StaticFiles
 import html
+import sys
+import io
+
+try:
+    from PIL import Image # Optional: enables server-side image downscaling/re-encoding
+except ImportError:
+    Image = None
+
+try:
+    import orjson # Optional: faster encoding for large JSON responses (GET /c/{chat_id})
+except ImportError:
+    orjson = None
+
+from logging_setup import configure_logging, ContextLogger
+from tracing import GenerationTrace
+from metrics import (
+    MetricsMiddleware, render_metrics, DB_OPERATION_SECONDS, GENERATIONS_ACTIVE, GENERATION_SECONDS, GENERATION_ERRORS,
+    LLM_REQUESTS, LLM_TTFT_SECONDS, LLM_TOKENS_PER_SECOND, LLM_OUTPUT_TOKENS, TOOL_CALLS, TOOL_SECONDS,
+)
+from profiling import ProfileStore, ProfilingMiddleware, collapsed_text
+from loop_monitor import LoopMonitor
+from generation_registry import GenerationRegistry
+from model_registry import ModelRegistry, CHARACTERS_DATA, bump_data_version
+from character_cache import CharacterCache
+from config_watcher import ConfigWatcher, validate_model_config, validate_api_keys, validate_search_keys
+from provider_clients import ProviderClientPool
+from local_models import LocalModelDiscovery
+from slot_affinity import SlotAffinity
+from compression import compress, negotiate
+from static_assets import Asset, StaticAssets
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Chat Data API")
 
@@ -31,6 +65,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware) # Per-route request counts and latency, exposed at /metrics
+profile_store = ProfileStore.from_env()
+app.add_middleware(ProfilingMiddleware, store=profile_store) # On-demand profiles, see profiling.py
 
 # Load configurations
 def load_config(file_path):
@@ -48,7 +85,9 @@ model_configs = load_config('model_config.yaml')
 
 # Database setup (Schema v2: adds preferred_model, cot_start_tag, cot_end_tag to characters)
 # Use a new filename to avoid clobbering old schema; no automatic migration performed here.
-DB_PATH = "chat_db_branching_v2.sqlite"
+DB_PATH = os.environ.get("ZERYO_DB_PATH") or "chat_db_branching_v2.sqlite" # serve.py --db-path sets the env var
+# Per-call token usage columns stored on messages and summed in usage_rollups
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "reasoning_tokens", "cache_read_tokens", "cache_write_tokens")
 
 def get_db_connection():
     conn = sqlite3.connect(DB_PATH, timeout=10)
@@ -58,7 +97,7 @@ def get_db_connection():
         conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA busy_timeout = 5000;")
     except Exception as e:
-        print(f"Warning: Could not set pragmas: {e}")
+        logger.warning("Could not set pragmas: %s", e)
     return conn
 
 # --- Database Initialization (Add tool_calls column) ---
@@ -88,6 +127,14 @@ def init_db():
         tool_call_id TEXT, -- Optional: Store ID if this is a tool result message OR the ID of the call made by an assistant msg
         tool_calls TEXT, -- Optional: Store LLM's requested tool calls (JSON) for assistant messages
         thinking_content TEXT, -- Optional: Store CoT/reasoning content separately from main message
+        token_count INTEGER, -- Cached token estimate for context window management
+        pinned INTEGER DEFAULT 0, -- 1 if this message's turn must never be trimmed from context
+        cache_read_tokens INTEGER, -- Prompt tokens served from the provider's prompt cache for this LLM call
+        cache_write_tokens INTEGER, -- Prompt tokens written to the provider's prompt cache for this LLM call
+        trace_id TEXT, -- generation_traces row for the generation that produced this message
+        prompt_tokens INTEGER, -- Provider-reported usage for the LLM call that produced this message
+        completion_tokens INTEGER,
+        reasoning_tokens INTEGER,
         FOREIGN KEY (chat_id) REFERENCES chats (chat_id) ON DELETE CASCADE,
         FOREIGN KEY (parent_message_id) REFERENCES messages (message_id) ON DELETE CASCADE
     )
@@ -99,6 +146,19 @@ def init_db():
     except sqlite3.OperationalError: pass
     try: cursor.execute("ALTER TABLE messages ADD COLUMN thinking_content TEXT")
     except sqlite3.OperationalError: pass
+    try: cursor.execute("ALTER TABLE messages ADD COLUMN token_count INTEGER") # Cached prompt-token estimate (NULL = not computed yet)
+    except sqlite3.OperationalError: pass
+    try: cursor.execute("ALTER TABLE messages ADD COLUMN pinned INTEGER DEFAULT 0") # Pinned turns survive context trimming
+    except sqlite3.OperationalError: pass
+    try: cursor.execute("ALTER TABLE messages ADD COLUMN cache_read_tokens INTEGER")
+    except sqlite3.OperationalError: pass
+    try: cursor.execute("ALTER TABLE messages ADD COLUMN cache_write_tokens INTEGER")
+    except sqlite3.OperationalError: pass
+    try: cursor.execute("ALTER TABLE messages ADD COLUMN trace_id TEXT")
+    except sqlite3.OperationalError: pass
+    for usage_column in ("prompt_tokens", "completion_tokens", "reasoning_tokens"):
+        try: cursor.execute(f"ALTER TABLE messages ADD COLUMN {usage_column} INTEGER")
+        except sqlite3.OperationalError: pass
 
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS attachments (
@@ -151,15 +211,118 @@ def init_db():
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_parent_id ON messages (parent_message_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachments_message_id ON attachments (message_id)")
+    # Processed image variants, one per (attachment, provider profile); removed with the attachment
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS attachment_variants (
+        attachment_id TEXT,
+        profile TEXT,
+        mime_type TEXT,
+        content TEXT, -- Base64 of the processed image
+        PRIMARY KEY (attachment_id, profile),
+        FOREIGN KEY (attachment_id) REFERENCES attachments (attachment_id) ON DELETE CASCADE
+    )
+    ''')
+    # Span timeline of each generation (context build, LLM calls, tools, persists), linked from messages.trace_id
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS generation_traces (
+        trace_id TEXT PRIMARY KEY,
+        chat_id TEXT,
+        provider TEXT,
+        model_name TEXT,
+        created_at INTEGER,
+        total_ms REAL,
+        message_ids TEXT, -- JSON list of messages saved by the generation
+        spans TEXT, -- JSON list of {name, start_ms, duration_ms?, ...attrs}
+        FOREIGN KEY (chat_id) REFERENCES chats (chat_id) ON DELETE CASCADE
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_generation_traces_chat_id ON generation_traces (chat_id)")
+    # Daily token usage per (chat, character, model), maintained by create_message. No FK to chats:
+    # usage history outlives deleted chats.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS usage_rollups (
+        day TEXT, -- UTC date, YYYY-MM-DD
+        chat_id TEXT,
+        character_id TEXT, -- '' when the chat had no character
+        model_name TEXT,
+        calls INTEGER DEFAULT 0,
+        prompt_tokens INTEGER DEFAULT 0,
+        completion_tokens INTEGER DEFAULT 0,
+        reasoning_tokens INTEGER DEFAULT 0,
+        cache_read_tokens INTEGER DEFAULT 0,
+        cache_write_tokens INTEGER DEFAULT 0,
+        PRIMARY KEY (day, chat_id, character_id, model_name)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_rollups_chat ON usage_rollups (chat_id, day)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_rollups_character ON usage_rollups (character_id, day)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_rollups_model ON usage_rollups (model_name, day)")
+    # Backfill once from messages saved before the rollup table existed
+    cursor.execute("SELECT 1 FROM usage_rollups LIMIT 1")
+    if cursor.fetchone() is None:
+        cursor.execute(f'''
+        INSERT INTO usage_rollups (day, chat_id, character_id, model_name, calls, {", ".join(USAGE_FIELDS)})
+        SELECT date(m.timestamp / 1000, 'unixepoch'), m.chat_id, COALESCE(c.character_id, ''), COALESCE(m.model_name, 'unknown'), COUNT(*),
+               {", ".join(f"COALESCE(SUM(m.{field}), 0)" for field in USAGE_FIELDS)}
+        FROM messages m LEFT JOIN chats c ON c.chat_id = m.chat_id
+        WHERE m.role = 'llm' AND ({" OR ".join(f"m.{field} IS NOT NULL" for field in USAGE_FIELDS)})
+        GROUP BY 1, 2, 3, 4
+        ''')
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_timestamp_updated ON chats (timestamp_updated DESC)")
+    # Running generations across worker processes (see generation_registry.py); rows are ephemeral
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS active_generations (
+        chat_id TEXT PRIMARY KEY,
+        generation_id TEXT NOT NULL,
+        owner TEXT NOT NULL, -- host:pid of the worker streaming it
+        started_at REAL NOT NULL,
+        heartbeat_at REAL NOT NULL,
+        abort_requested INTEGER NOT NULL DEFAULT 0
+    )''')
+    # Change counters for data cached in memory by each worker (see model_registry.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )''')
     conn.commit()
     conn.close()
 
 TOOL_CALL_REGEX = re.compile(r'<tool_call\s+name="([\w\-.]+)"(?:\s+id="([\w\-]+)")?\s*>(.*?)</tool_call>', re.DOTALL)
 
-ACTIVE_GENERATIONS: Dict[str, asyncio.Event] = {}
-
 init_db()
+generation_registry = GenerationRegistry.from_env(get_db_connection) # Replaces the per-process ACTIVE_GENERATIONS dict
+character_cache = CharacterCache.from_env(get_db_connection)
+model_registry = ModelRegistry(character_cache)
+model_registry.load_configs(model_configs)
+provider_clients = ProviderClientPool() # Shared httpx client for LLM calls, see provider_clients.py
+local_models = LocalModelDiscovery.from_env(provider_clients, lambda: api_keys_config) # Cached /v1/models of the local runtime
+local_slots = SlotAffinity.from_env() # Chat -> llama.cpp slot pinning (ZERYO_LOCAL_SLOTS)
+static_assets = StaticAssets(os.path.dirname(os.path.abspath(__file__))) # Hashed, precompressed frontend files
+
+# --- Config hot reload (see config_watcher.py) ---
+def _apply_model_config(data: Dict[str, Any]) -> None:
+    global model_configs
+    model_registry.load_configs(data)
+    model_configs = data
+
+def _apply_api_keys(data: Dict[str, Any]) -> None:
+    global api_keys_config
+    api_keys_config = data
+    provider_clients.rebuild() # Running streams finish on the old client
+    local_models.invalidate() # local_base_url may have changed
+    tools_web = sys.modules.get("tools_web") # Loaded lazily; otherwise it reads the files when first imported
+    if tools_web is not None: # Validated content only; the search keys in effect stay as they are
+        tools_web.load_keys(api_keys=data, search_keys=tools_web.SEARCH_KEYS)
+
+def _apply_search_keys(data: Dict[str, Any]) -> None:
+    if "tools_web" in sys.modules:
+        sys.modules["tools_web"].load_keys(api_keys=api_keys_config, search_keys=data)
+
+config_watcher = ConfigWatcher.from_env(get_db_connection)
+config_watcher.watch("model_config", "model_config.yaml", model_configs, validate_model_config, _apply_model_config)
+config_watcher.watch("api_keys", "api_keys.yaml", api_keys_config, validate_api_keys, _apply_api_keys)
+config_watcher.watch("search_api_keys", os.environ.get("SEARCH_API_KEYS_PATH", "search_api_keys.yaml"), {}, validate_search_keys, _apply_search_keys, required=False)
 
 # Pydantic models
 class MessageRole(str, Enum):
@@ -191,6 +354,14 @@ class Message(BaseModel):
     tool_call_id: Optional[str] = None
     tool_calls: Optional[Any] = None
     thinking_content: Optional[str] = None
+    token_count: Optional[int] = None
+    pinned: Optional[bool] = False
+    cache_read_tokens: Optional[int] = None
+    cache_write_tokens: Optional[int] = None
+    trace_id: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    reasoning_tokens: Optional[int] = None
 
 
 class AddMessageRequest(BaseModel):
@@ -263,6 +434,9 @@ class UpdateCharacterRequest(Character):
 class SetActiveBranchRequest(BaseModel):
     child_index: int
 
+class PinMessageRequest(BaseModel):
+    pinned: bool = True
+
 class ApiKeysUpdateRequest(BaseModel):
     openrouter: Optional[str] = None
     google: Optional[str] = None
@@ -292,7 +466,10 @@ class GenerateRequest(BaseModel):
     preserve_thinking: bool = False  # If True, include thinking content in LLM context
     max_tool_calls: int = -1  # Maximum number of tool calls per generation (-1 for unlimited)
 
-from tools import TOOL_REGISTRY, TOOL_DEFINITIONS, convert_tools_to_openai_format, TOOLS_OPENAI_FORMAT
+from tools import (
+    TOOLS, TOOL_REGISTRY, TOOL_DEFINITIONS, TOOLS_OPENAI_FORMAT, TOOL_IMPORT_BUDGET_MS,
+    LazyHandler, ToolSpec, ToolArgumentError, ToolTimeoutError, import_report, preload_tools,
+)
 # --- Tool Registry and Descriptions ---
 
 TOOLS_AVAILABLE: List[ToolDefinition] = [
@@ -315,16 +492,327 @@ def resolve_tools_subset(tool_names: Optional[List[str]]) -> Tuple[List[ToolDefi
     else:
         names_lower = {name.lower() for name in tool_names}
         subset = [tool for tool in TOOLS_AVAILABLE if tool.name.lower() in names_lower]
-        # Convert subset to OpenAI format
-        subset_defs = [{"name": t.name, "description": t.description, "parameters": t.parameters} for t in subset]
-        openai_tools = convert_tools_to_openai_format(subset_defs)
+        openai_tools = [TOOLS[tool.name].openai_format for tool in subset] # Schemas are built once when tools.py loads
 
     registry = {tool.name: TOOL_REGISTRY[tool.name] for tool in subset if tool.name in TOOL_REGISTRY}
     return subset, registry, openai_tools
 
 
+async def _run_tool_limited(spec: ToolSpec, tool_function: Callable[..., Any], arguments: Dict[str, Any]) -> Any:
+    """Runs the handler in one of the tool's concurrency slots, within its timeout (slot wait included)."""
+    is_coroutine = asyncio.iscoroutinefunction(tool_function)
+    deadline = time.monotonic() + spec.timeout
+    try:
+        await asyncio.wait_for(spec.semaphore.acquire(), spec.timeout)
+    except asyncio.TimeoutError:
+        raise ToolTimeoutError(spec.name, spec.timeout, f"all {spec.max_concurrency} slots busy") from None
+    task = asyncio.ensure_future(tool_function(**arguments) if is_coroutine else asyncio.to_thread(tool_function, **arguments))
+
+    def _release(done: asyncio.Future) -> None:
+        spec.semaphore.release()
+        if not done.cancelled(): done.exception() # Retrieved here so an abandoned task's error is not reported as unhandled
+
+    # A sync handler's thread cannot be stopped, so it keeps its slot until it really finishes
+    task.add_done_callback(_release)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        if is_coroutine: task.cancel()
+        raise ToolTimeoutError(spec.name, spec.timeout) from None
+    except asyncio.CancelledError:
+        if is_coroutine: task.cancel()
+        raise
+
+
+async def invoke_tool(tool_name: str, tool_function: Callable[..., Any], arguments: Dict[str, Any]) -> Any:
+    """
+    Runs a tool handler (sync handlers in a worker thread), recording its duration and outcome.
+    Registered tools are held to their ToolSpec: arguments are validated first, cacheable results
+    are reused, and the run is bounded by the tool's concurrency limit, timeout and output cap.
+    """
+    spec = TOOLS.get(tool_name)
+    outcome = "error"
+    try:
+        if spec is not None:
+            try: arguments = spec.validate(arguments)
+            except ToolArgumentError:
+                outcome = "invalid"
+                raise
+            cached = spec.cached(arguments)
+            if cached is not None:
+                outcome = "cached"
+                return cached
+        with TOOL_SECONDS.time(tool=tool_name):
+            if isinstance(tool_function, LazyHandler):
+                tool_function = tool_function.resolve() if tool_function.loaded else await asyncio.to_thread(tool_function.resolve) # First call imports the handler's module off the loop
+            if spec is None:
+                result = await tool_function(**arguments) if asyncio.iscoroutinefunction(tool_function) else await asyncio.to_thread(tool_function, **arguments)
+            else:
+                try: result = spec.cap_output(str(await _run_tool_limited(spec, tool_function, arguments)))
+                except ToolTimeoutError:
+                    outcome = "timeout"
+                    raise
+                spec.remember(arguments, result)
+        outcome = "ok"
+        return result
+    finally:
+        TOOL_CALLS.inc(tool=tool_name, outcome=outcome)
+
+
+# --- Context Window Management ---
+# Token counts are estimated (~4 UTF-8 bytes per token) rather than run through a
+# provider tokenizer; the estimate is only used to decide what fits, so it errs high.
+MESSAGE_TOKEN_OVERHEAD = 4 # Role/separator tokens added per message by chat templates
+IMAGE_TOKEN_ESTIMATE = 1024 # Rough per-image cost across vision providers
+DEFAULT_OUTPUT_TOKEN_RESERVE = 1024 # Reserved for the reply when max_tokens is not set
+CONTEXT_POLICIES = ("drop_oldest", "summarize", "none")
+SUMMARY_EXCERPT_CHARS = 200 # Per-message excerpt length for the 'summarize' policy
+
+def estimate_tokens(text: Optional[str]) -> int:
+    if not text:
+        return 0
+    return (len(text.encode("utf-8")) + 3) // 4
+
+def estimate_message_tokens(content: Optional[str], attachments: Optional[List[Dict[str, Any]]] = None, tool_calls: Any = None) -> int:
+    """Estimates the prompt tokens a stored message contributes (excluding thinking content)."""
+    total = MESSAGE_TOKEN_OVERHEAD + estimate_tokens(content)
+    for attachment in attachments or []:
+        if attachment.get("type") == "image":
+            total += IMAGE_TOKEN_ESTIMATE
+        else:
+            total += estimate_tokens(attachment.get("content")) + estimate_tokens(attachment.get("name")) + 8
+    if tool_calls:
+        total += estimate_tokens(tool_calls if isinstance(tool_calls, str) else json.dumps(tool_calls))
+    return total
+
+def context_entry_tokens(entry: Dict[str, Any]) -> int:
+    """Token estimate for a context entry, using the cached count when build_context_from_db supplied one."""
+    if entry.get("token_count") is not None:
+        return entry["token_count"]
+    return estimate_message_tokens(entry.get("message"), entry.get("attachments"), entry.get("tool_calls"))
+
+def trim_context_to_budget(
+    context: List[Dict[str, Any]],
+    max_prompt_tokens: int,
+    policy: str = "drop_oldest"
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Trims a context list (as built by build_context_from_db) to fit max_prompt_tokens.
+
+    Leading system entries are always kept. The rest is grouped into turns (a user
+    message plus the assistant/tool messages that follow it) so tool calls are never
+    separated from their results. The oldest unpinned turns are dropped first and the
+    latest turn is always kept. With policy 'summarize', the dropped turns are replaced
+    by a short extractive digest returned in stats["summary"] for the caller to place.
+    """
+    stats = {"trimmed_tokens": 0, "trimmed_messages": 0, "context_tokens": 0, "summary": None}
+    total = sum(context_entry_tokens(entry) for entry in context)
+    stats["context_tokens"] = total
+    if policy == "none" or max_prompt_tokens <= 0 or total <= max_prompt_tokens:
+        return context, stats
+
+    head: List[Dict[str, Any]] = []
+    turns: List[List[Dict[str, Any]]] = []
+    for entry in context:
+        if entry.get("role") == "system" and not turns:
+            head.append(entry)
+        elif entry.get("role") == "user" or not turns:
+            turns.append([entry])
+        else:
+            turns[-1].append(entry)
+
+    summary_budget_tokens = max_prompt_tokens // 10 if policy == "summarize" else 0
+    target = max_prompt_tokens - summary_budget_tokens
+    dropped_indexes: Set[int] = set()
+    for index, turn in enumerate(turns[:-1]):
+        if total <= target:
+            break
+        if any(entry.get("pinned") for entry in turn):
+            continue
+        dropped_indexes.add(index)
+        turn_tokens = sum(context_entry_tokens(entry) for entry in turn)
+        total -= turn_tokens
+        stats["trimmed_tokens"] += turn_tokens
+        stats["trimmed_messages"] += len(turn)
+
+    kept = list(head)
+    dropped_entries: List[Dict[str, Any]] = []
+    for index, turn in enumerate(turns):
+        (dropped_entries if index in dropped_indexes else kept).extend(turn)
+
+    if policy == "summarize" and dropped_entries:
+        summary_lines = [f"[Earlier conversation condensed: {len(dropped_entries)} messages omitted to fit the context window.]"]
+        remaining_chars = summary_budget_tokens * 4
+        for entry in dropped_entries:
+            text = (entry.get("message") or "").strip()
+            if entry.get("role") not in ("user", "assistant") or not text:
+                continue
+            excerpt = " ".join(text.split())[:SUMMARY_EXCERPT_CHARS]
+            line = f"- {entry['role']}: {excerpt}{'...' if len(text) > SUMMARY_EXCERPT_CHARS else ''}"
+            if len(line) > remaining_chars:
+                break
+            summary_lines.append(line)
+            remaining_chars -= len(line)
+        stats["summary"] = "\n".join(summary_lines)
+        total += estimate_tokens(stats["summary"]) + MESSAGE_TOKEN_OVERHEAD
+
+    stats["context_tokens"] = total
+    return kept, stats
+
+# --- Image Preprocessing ---
+# Per-provider targets for images sent to vision models. Images larger than max_edge
+# (longest side) or max_bytes are downscaled/re-encoded when Pillow is installed.
+IMAGE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "openrouter": {"max_edge": 1568, "max_bytes": 3_750_000, "mime_types": ("image/jpeg", "image/png", "image/webp", "image/gif")},
+    "google": {"max_edge": 3072, "max_bytes": 7_000_000, "mime_types": ("image/jpeg", "image/png", "image/webp")},
+    "local": {"max_edge": 1024, "max_bytes": 2_000_000, "mime_types": ("image/jpeg", "image/png")},
+}
+IMAGE_JPEG_QUALITY = 85
+
+def detect_image_mime(b64_content: str) -> str:
+    """Detects an image MIME type from the magic bytes of base64 content (defaults to JPEG)."""
+    try:
+        head = base64.b64decode(b64_content[:24] + "=" * (-len(b64_content[:24]) % 4), validate=False)
+    except Exception:
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"): return "image/png"
+    if head.startswith(b"\xff\xd8\xff"): return "image/jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"): return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP": return "image/webp"
+    return "image/jpeg"
+
+def process_image_for_profile(b64_content: str, profile: Dict[str, Any]) -> Tuple[str, str]:
+    """
+    Returns (mime_type, base64) for an image, downscaled to the profile's max_edge and
+    re-encoded if it is too large or in a format the provider does not accept.
+    Without Pillow, the original is returned with its detected MIME type.
+    """
+    mime_type = detect_image_mime(b64_content)
+    if Image is None:
+        return mime_type, b64_content
+    raw_size = len(b64_content) * 3 // 4
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(b64_content))) as img:
+            needs_resize = max(img.size) > profile["max_edge"]
+            if not needs_resize and raw_size <= profile["max_bytes"] and mime_type in profile["mime_types"]:
+                return mime_type, b64_content
+            img.load()
+            if needs_resize:
+                img.thumbnail((profile["max_edge"], profile["max_edge"]), Image.LANCZOS)
+            keep_png = mime_type == "image/png" and "image/png" in profile["mime_types"] and img.mode in ("RGBA", "LA", "P")
+            buffer = io.BytesIO()
+            if keep_png:
+                img.save(buffer, format="PNG", optimize=True)
+                out_mime = "image/png"
+            if not keep_png or buffer.tell() > profile["max_bytes"]:
+                buffer = io.BytesIO()
+                img.convert("RGB").save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+                out_mime = "image/jpeg"
+            return out_mime, base64.b64encode(buffer.getvalue()).decode("ascii")
+    except Exception as e:
+        logger.warning("Image preprocessing failed, sending original: %s", e)
+        return mime_type, b64_content
+
+def prepare_context_images(
+    context: List[Dict[str, Any]],
+    provider: str,
+    supports_images: bool,
+    max_image_turns: Optional[int] = None
+) -> Dict[str, int]:
+    """
+    Prepares image attachments in a context list (as built by build_context_from_db)
+    for a provider, in place. Images are dropped with a text placeholder when the model
+    does not support images or when they are older than max_image_turns user turns;
+    the rest are replaced by their processed variant for the provider's IMAGE_PROFILES
+    entry, cached in attachment_variants. Blocking (Pillow, sqlite): run in a thread.
+    """
+    stats = {"images_sent": 0, "images_dropped": 0, "bytes_saved": 0}
+    provider_lower = provider.lower()
+    profile = IMAGE_PROFILES.get(provider_lower, IMAGE_PROFILES["openrouter"])
+    profile_key = f"{provider_lower}:{profile['max_edge']}:{profile['max_bytes']}"
+
+    user_turns_after: List[int] = []
+    turns_seen = 0
+    for entry in reversed(context):
+        user_turns_after.append(turns_seen)
+        if entry.get("role") == "user": turns_seen += 1
+    user_turns_after.reverse()
+
+    conn = None
+    try:
+        for index, entry in enumerate(context):
+            images = [a for a in entry.get("attachments") or [] if a.get("type") == "image" and a.get("content")]
+            if not images:
+                continue
+            image_ids = {id(a) for a in images}
+            too_old = max_image_turns is not None and user_turns_after[index] >= max_image_turns
+            if not supports_images or too_old:
+                reason = "the selected model does not accept images" if not supports_images else "older images are not resent"
+                notes = [f"[Image omitted: {a.get('name') or 'image'} ({reason})]" for a in images]
+                entry["attachments"] = [a for a in entry["attachments"] if id(a) not in image_ids]
+                entry["message"] = "\n".join(filter(None, [entry.get("message")] + notes))
+                stats["images_dropped"] += len(images)
+                continue
+
+            processed_attachments = []
+            for attachment in entry["attachments"]:
+                if id(attachment) not in image_ids:
+                    processed_attachments.append(attachment)
+                    continue
+                attachment_id = attachment.get("attachment_id")
+                variant = None
+                if attachment_id:
+                    if conn is None: conn = get_db_connection()
+                    variant = conn.execute("SELECT mime_type, content FROM attachment_variants WHERE attachment_id = ? AND profile = ?",
+                                           (attachment_id, profile_key)).fetchone()
+                if variant:
+                    mime_type, content = variant["mime_type"], variant["content"]
+                else:
+                    mime_type, content = process_image_for_profile(attachment["content"], profile)
+                    if attachment_id:
+                        try:
+                            conn.execute("INSERT OR REPLACE INTO attachment_variants (attachment_id, profile, mime_type, content) VALUES (?, ?, ?, ?)",
+                                         (attachment_id, profile_key, mime_type, content))
+                            conn.commit()
+                        except sqlite3.Error as e:
+                            logger.warning("Could not cache image variant for attachment %s: %s", attachment_id, e)
+                stats["bytes_saved"] += max(0, (len(attachment["content"]) - len(content)) * 3 // 4)
+                stats["images_sent"] += 1
+                processed_attachments.append({**attachment, "content": content, "mime_type": mime_type})
+            entry["attachments"] = processed_attachments
+    finally:
+        if conn: conn.close()
+    return stats
+
+def record_llm_call_metrics(provider: Optional[str], model_name: str, started_at: float, first_token_at: Optional[float], output_chars: int, error: Optional[BaseException], completion_tokens: Optional[int] = None) -> None:
+    """Records outcome, time to first token and decode rate for one upstream LLM call."""
+    labels = {"provider": provider or "unknown", "model": model_name}
+    outcome = "ok" if error is None else ("aborted" if isinstance(error, asyncio.CancelledError) else "error")
+    LLM_REQUESTS.inc(outcome=outcome, **labels)
+    if first_token_at is None:
+        return
+    LLM_TTFT_SECONDS.observe(first_token_at - started_at, **labels)
+    output_tokens = completion_tokens if completion_tokens is not None else (output_chars + 3) // 4 # Same ~4 chars/token estimate as estimate_tokens
+    LLM_OUTPUT_TOKENS.inc(output_tokens, **labels)
+    decode_seconds = time.perf_counter() - first_token_at
+    if decode_seconds > 0 and output_tokens > 1:
+        LLM_TOKENS_PER_SECOND.observe(output_tokens / decode_seconds, **labels)
+
+def save_generation_trace(trace: GenerationTrace, chat_id: str, provider: Optional[str], model_name: str, message_ids: List[str]) -> None:
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            """INSERT OR REPLACE INTO generation_traces (trace_id, chat_id, provider, model_name, created_at, total_ms, message_ids, spans)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (trace.trace_id, chat_id, provider, model_name, int(trace.created_at * 1000), trace.total_ms(), json.dumps(message_ids), json.dumps(trace.spans))
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
 # Database Helper Functions
 
+@DB_OPERATION_SECONDS.time(operation="build_context_from_db")
 def build_context_from_db(
     conn: sqlite3.Connection,
     cursor: sqlite3.Cursor,
@@ -340,8 +828,11 @@ def build_context_from_db(
     formats it for LLM context, including attachments, tool calls/results.
     If preserve_thinking is True, includes thinking_content in assistant messages.
     Otherwise, thinking content is excluded from the context.
+    Each entry carries its message_id, pinned flag and token_count; missing token
+    counts are computed once and written back to the messages table.
     """
     context = []
+    token_count_updates: List[Tuple[int, str]] = []
     messages_map = {} # message_id -> {data, attachments, children_ids, active_child_index}
 
     # Fetch all messages for the chat to build the tree structure
@@ -351,21 +842,21 @@ def build_context_from_db(
 
     if not all_messages_data:
         if system_prompt:
-            context.append({"role": "system", "message": system_prompt, "attachments": []})
+            context.append({"role": "system", "message": system_prompt, "attachments": [], "token_count": estimate_tokens(system_prompt) + MESSAGE_TOKEN_OVERHEAD})
         return context
 
     # Populate map and identify roots
     root_ids = []
     for msg_data in all_messages_data:
         msg_id = msg_data["message_id"]
-        cursor.execute("SELECT type, content, name FROM attachments WHERE message_id = ?", (msg_id,))
-        attachments = [{"type": row["type"], "content": row["content"], "name": row["name"]} for row in cursor.fetchall()]
+        cursor.execute("SELECT attachment_id, type, content, name FROM attachments WHERE message_id = ?", (msg_id,))
+        attachments = [{"attachment_id": row["attachment_id"], "type": row["type"], "content": row["content"], "name": row["name"]} for row in cursor.fetchall()]
 
         # Deserialize tool_calls JSON string back into a list/dict
         tool_calls_data = None
         if msg_data["tool_calls"]:
             try: tool_calls_data = json.loads(msg_data["tool_calls"])
-            except json.JSONDecodeError: print(f"Warning: Could not parse tool_calls JSON for msg {msg_id}")
+            except json.JSONDecodeError: logger.warning("Could not parse tool_calls JSON for msg %s", msg_id)
 
         messages_map[msg_id] = {
             "data": dict(msg_data),
@@ -383,7 +874,7 @@ def build_context_from_db(
 
     # Add system prompt first if provided
     if system_prompt:
-        context.append({"role": "system", "message": system_prompt, "attachments": []})
+        context.append({"role": "system", "message": system_prompt, "attachments": [], "token_count": estimate_tokens(system_prompt) + MESSAGE_TOKEN_OVERHEAD})
 
     processed_ids = set()
 
@@ -412,7 +903,17 @@ def build_context_from_db(
         # Map internal roles to standard API roles ('llm' -> 'assistant')
         context_role = "assistant" if role_for_context == "llm" else role_for_context
 
+        token_count = msg.get("token_count")
+        if token_count is None:
+            token_count = estimate_message_tokens(msg["message"], msg_attachments, msg.get("tool_calls"))
+            token_count_updates.append((token_count, message_id))
+        if is_llm and preserve_thinking and msg_thinking_content:
+            token_count += estimate_tokens(msg_thinking_content)
+
         context_entry = {
+            "message_id": message_id,
+            "pinned": bool(msg.get("pinned")),
+            "token_count": token_count,
             "role": context_role,
             "message": content_for_context if content_for_context else None,
             "attachments": msg_attachments, # Include attachments
@@ -425,7 +926,7 @@ def build_context_from_db(
         # Ensure tool messages have content (the result) and tool_call_id
         if context_role == "tool":
             if not context_entry["message"]: context_entry["message"] = "[Tool Execution Result Missing]" # Add placeholder if empty
-            if not context_entry["tool_call_id"]: print(f"Warning: Tool message {message_id} missing tool_call_id in context.")
+            if not context_entry["tool_call_id"]: logger.warning("Tool message %s missing tool_call_id in context.", message_id)
         # Ensure assistant messages making tool calls have the tool_calls structure
         if context_role == "assistant" and context_entry["tool_calls"]:
              if context_entry["message"] is None: context_entry["message"] = "" # Ensure content isn't null if tool_calls present
@@ -447,12 +948,12 @@ def build_context_from_db(
            context_entry.get("tool_calls"):
             context.append(context_entry)
         else:
-            print(f"Skipping empty context entry for message {message_id}")
+            logger.debug("Skipping empty context entry for message %s", message_id)
 
 
         # Stop condition: We've processed the target message
         if message_id == stop_at_message_id:
-            print(f"Context build reached and included stop message: {message_id}")
+            logger.debug("Context build reached and included stop message: %s", message_id)
             return True # Found the target message
 
         # Recurse to the active child
@@ -477,7 +978,14 @@ def build_context_from_db(
         if traverse_active(root_id):
             break
 
-    print(f"Built context with {len(context)} entries for chat {chat_id}, stopping at {stop_at_message_id}.")
+    if token_count_updates:
+        try:
+            cursor.executemany("UPDATE messages SET token_count = ? WHERE message_id = ?", token_count_updates)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Could not cache token counts for chat %s: %s", chat_id, e)
+
+    logger.debug("Built context with %s entries for chat %s, stopping at %s.", len(context), chat_id, stop_at_message_id)
     # print("Final context sample:", json.dumps(context[-3:], indent=2)) # Debug: print last few entries
     return context
 
@@ -506,7 +1014,7 @@ def save_assistant_message_tx(
             (content, model_name, timestamp, message_id_to_edit, chat_id, role.value)
         )
         message_id = message_id_to_edit
-        print(f"Updated assistant message {message_id} in transaction.")
+        logger.debug("Updated assistant message %s in transaction.", message_id)
     else:
         # Insert new message
         message_id = str(uuid.uuid4())
@@ -516,7 +1024,7 @@ def save_assistant_message_tx(
                VALUES (?, ?, ?, ?, ?, ?, ?)""",
             (message_id, chat_id, role.value, content, model_name, timestamp, parent_message_id)
         )
-        print(f"Inserted new assistant message {message_id} in transaction.")
+        logger.debug("Inserted new assistant message %s in transaction.", message_id)
 
         # Update parent's active child index
         if parent_message_id:
@@ -526,189 +1034,456 @@ def save_assistant_message_tx(
                 new_idx = children_ids.index(message_id) if message_id in children_ids else len(children_ids) - 1
                 cursor.execute("UPDATE messages SET active_child_index = ? WHERE message_id = ?", (new_idx, parent_message_id))
             except Exception as update_err:
-                print(f"Warning: Failed to update parent active index during save_assistant_message_tx: {update_err}")
+                logger.warning("Failed to update parent active index during save_assistant_message_tx: %s", update_err)
 
     # Update chat timestamp
     cursor.execute("UPDATE chats SET timestamp_updated = ? WHERE chat_id = ?", (timestamp, chat_id))
     return message_id
 
-def format_messages_for_provider(messages: List[Dict[str, Any]], provider: str) -> List[Dict[str, Any]]:
+# --- Prompt Caching ---
+MAX_CACHE_BREAKPOINTS = 4 # Anthropic (via OpenRouter) accepts at most 4 cache_control markers per request
+CACHE_MIN_ATTACHMENT_CHARS = 4096 # File attachments at least this large get their own breakpoint
+
+def _mark_cache_breakpoint(message_obj: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """
-    Formats an array of internal message objects (including attachments)
-    into the structure required by a specific LLM provider.
+    Returns a copy of an OpenAI-style message with an ephemeral cache_control marker on its
+    last text part, or None if it has no text to mark. The input (which may be cached by
+    ProviderMessageFormatter) is left untouched.
     """
-    formatted = []
-    provider_lower = provider.lower()
-    print(f"Formatting {len(messages)} messages for provider: {provider_lower}")
-
-    for msg in messages:
-        internal_role = msg.get("role") # user, llm, system, tool
-        content = msg.get("message") # Text content
-        attachments = msg.get("attachments", []) # List of {type, content, name}
-        tool_calls = msg.get("tool_calls") # For native tool use
-        tool_call_id = msg.get("tool_call_id") # For native tool use
+    content = message_obj.get("content")
+    if isinstance(content, str):
+        if not content:
+            return None
+        return {**message_obj, "content": [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]}
+    if isinstance(content, list):
+        last_text_index = next((i for i in range(len(content) - 1, -1, -1) if content[i].get("type") == "text" and content[i].get("text")), None)
+        if last_text_index is not None:
+            marked_content = list(content)
+            marked_content[last_text_index] = {**content[last_text_index], "cache_control": {"type": "ephemeral"}}
+            return {**message_obj, "content": marked_content}
+    return None
 
-        # --- Role Mapping ---
-        provider_role = internal_role
+def _apply_cache_breakpoints(formatted: List[Dict[str, Any]], large_attachment_ids: Set[int]) -> None:
+    """
+    Marks stable prefixes for provider prompt caching, in priority order: the system
+    prompt, the latest message (so the next tool-loop iteration or regeneration reads
+    everything before it from cache), the end of older history (the message before the
+    last user turn) and messages carrying large file attachments.
+    Marked messages are replaced in the list by marked copies.
+    """
+    candidates: List[int] = []
+    system_indexes = [i for i, msg in enumerate(formatted) if msg.get("role") == "system"]
+    if system_indexes: candidates.append(system_indexes[-1])
+    if formatted: candidates.append(len(formatted) - 1)
+    last_user_index = next((i for i in range(len(formatted) - 1, -1, -1) if formatted[i].get("role") == "user"), None)
+    if last_user_index: candidates.append(last_user_index - 1)
+    candidates.extend(i for i, msg in enumerate(formatted) if id(msg) in large_attachment_ids)
+
+    marked: Set[int] = set()
+    for index in candidates:
+        if len(marked) >= MAX_CACHE_BREAKPOINTS: break
+        if index in marked: continue
+        marked_msg = _mark_cache_breakpoint(formatted[index])
+        if marked_msg is not None:
+            formatted[index] = marked_msg
+            marked.add(index)
+
+def _format_message_for_provider(msg: Dict[str, Any], provider_lower: str, tool_name: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Formats a single internal message for a provider. Returns (message, has_large_attachment);
+    message is None when the provider has no representation for it (e.g. Google system prompts).
+    tool_name is the name of the call a tool result answers (Google functionResponse needs it).
+    """
+    internal_role = msg.get("role") # user, llm, system, tool
+    content = msg.get("message") # Text content
+    attachments = msg.get("attachments", []) # List of {type, content, name}
+    tool_calls = msg.get("tool_calls") # For native tool use
+    tool_call_id = msg.get("tool_call_id") # For native tool use
+
+    # --- Role Mapping ---
+    provider_role = internal_role
+    if provider_lower == 'google':
+        if internal_role == 'assistant' or internal_role == 'llm': provider_role = 'model'
+        elif internal_role == 'system':
+            # System prompts for Google are handled by 'systemInstruction' field in the main request,
+            # not as part of the 'contents' array. So, skip them here.
+            return None, False
+        elif internal_role == 'tool': provider_role = 'function' # Google uses 'function' for tool results
+    elif provider_lower in ['openrouter', 'local', 'openai']: # OpenAI / Compatible
+        if internal_role == 'llm': provider_role = 'assistant'
+        # System prompt IS part of the messages list for OpenAI
+        # Tool role is 'tool'
+    else: # Default to OpenAI compatible
+         if internal_role == 'llm': provider_role = 'assistant'
+
+    # --- Content Formatting (Handles Text, Images, Files) ---
+    content_parts = []
+    final_message_obj = {"role": provider_role}
+
+    # 1. Add Text Part
+    if content:
         if provider_lower == 'google':
-            if internal_role == 'assistant' or internal_role == 'llm': provider_role = 'model'
-            elif internal_role == 'system':
-                # System prompts for Google are handled by 'systemInstruction' field in the main request,
-                # not as part of the 'contents' array. So, skip them here.
-                continue
-            elif internal_role == 'tool': provider_role = 'function' # Google uses 'function' for tool results
-        elif provider_lower in ['openrouter', 'local', 'openai']: # OpenAI / Compatible
-            if internal_role == 'llm': provider_role = 'assistant'
-            # System prompt IS part of the messages list for OpenAI
-            # Tool role is 'tool'
-        else: # Default to OpenAI compatible
-             if internal_role == 'llm': provider_role = 'assistant'
-
-        # --- Content Formatting (Handles Text, Images, Files) ---
-        content_parts = []
-        final_message_obj = {"role": provider_role}
-
-        # 1. Add Text Part
-        if content:
-            if provider_lower == 'google':
-                content_parts.append({"text": content})
-            else: # OpenAI / Compatible
-                content_parts.append({"type": "text", "text": content})
-
-        # 2. Add Attachment Parts
-        files_content_buffer = "" # Buffer to combine text file contents
-        image_attachments = []
-        for attachment in attachments:
-            if attachment['type'] == 'image':
-                if attachment['content']:
-                    image_attachments.append(attachment)
-                else:
-                    print(f"Warning: Skipping image attachment with missing content (Name: {attachment.get('name', 'N/A')})")
-            elif attachment['type'] == 'file':
-                if attachment['content']:
-                     files_content_buffer += f"\n\n--- Attached File: {attachment.get('name', 'file')} ---\n{attachment['content']}\n--- End File ---"
-                else:
-                     print(f"Warning: Skipping file attachment with missing content (Name: {attachment.get('name', 'N/A')})")
+            content_parts.append({"text": content})
+        else: # OpenAI / Compatible
+            content_parts.append({"type": "text", "text": content})
+
+    # 2. Add Attachment Parts
+    files_content_buffer = "" # Buffer to combine text file contents
+    image_attachments = []
+    for attachment in attachments:
+        if attachment['type'] == 'image':
+            if attachment['content']:
+                image_attachments.append(attachment)
+            else:
+                logger.warning("Skipping image attachment with missing content (Name: %s)", attachment.get('name', 'N/A'))
+        elif attachment['type'] == 'file':
+            if attachment['content']:
+                 files_content_buffer += f"\n\n--- Attached File: {attachment.get('name', 'file')} ---\n{attachment['content']}\n--- End File ---"
+            else:
+                 logger.warning("Skipping file attachment with missing content (Name: %s)", attachment.get('name', 'N/A'))
 
-        if files_content_buffer:
-            if provider_lower == 'google':
-                last_text_part = next((part for part in reversed(content_parts) if 'text' in part), None)
-                if last_text_part:
-                    last_text_part['text'] += files_content_buffer
-                else:
-                    content_parts.append({"text": files_content_buffer.lstrip()})
-            else: # OpenAI / Compatible
-                last_text_part = next((part for part in reversed(content_parts) if part.get('type') == 'text'), None)
-                if last_text_part:
-                    last_text_part['text'] += files_content_buffer
-                else:
-                    content_parts.append({"type": "text", "text": files_content_buffer.lstrip()})
-
-        for img_attachment in image_attachments:
-             img_content = img_attachment['content']
-             # Determine MIME type (very basic, assuming JPEG if not specified)
-             mime_type = "image/jpeg" # Default
-             # Could add more sophisticated MIME type detection here if name or content has hints
-             # e.g., if img_attachment['name'] has .png, .jpeg, etc.
-             # For now, sticking to JPEG as it was before.
-             if provider_lower == 'google':
-                 content_parts.append({"inlineData": {"mimeType": mime_type, "data": img_content}}) # inlineData, mimeType, data
-             else: # OpenAI / Compatible
-                 content_parts.append({
-                     "type": "image_url",
-                     "image_url": {"url": f"data:{mime_type};base64,{img_content}"}
-                 })
-
-        # 3. Assign Content/Parts and Tool Info to Final Object
+    if files_content_buffer:
         if provider_lower == 'google':
-            if content_parts:
-                final_message_obj["parts"] = content_parts
-            elif provider_role == 'function': # Tool result message
-                 # For manual tool flow, content is the string result
-                 if content:
-                      final_message_obj["parts"] = [{"text": content}]
-                 else: # Should have content if it's a tool result
-                      final_message_obj["parts"] = [{"text": "[Tool Execution Result Missing]"}]
-            elif provider_role in ['user', 'model'] and not content_parts:
-                # Google API requires 'parts' to be non-empty for user/model roles.
-                # If after processing text and attachments, parts is still empty, add an empty text part.
-                print(f"Warning: Google message (Role: {provider_role}) has no content parts. Adding empty text part.")
-                final_message_obj["parts"] = [{"text": ""}] # Ensure parts is not empty
+            last_text_part = next((part for part in reversed(content_parts) if 'text' in part), None)
+            if last_text_part:
+                last_text_part['text'] += files_content_buffer
             else:
-                 print(f"Warning: Skipping Google message with no parts (Role: {provider_role}, Content: '{content}')")
-                 continue
-
+                content_parts.append({"text": files_content_buffer.lstrip()})
         else: # OpenAI / Compatible
-            if content_parts:
-                if len(content_parts) > 1:
-                    final_message_obj["content"] = content_parts
-                elif len(content_parts) == 1 and content_parts[0]['type'] == 'text':
-                     final_message_obj["content"] = content_parts[0]['text']
-                elif len(content_parts) == 1 and content_parts[0]['type'] == 'image_url':
-                     final_message_obj["content"] = content_parts
-                else:
-                     final_message_obj["content"] = None
-
-            if provider_role == 'assistant' and tool_calls:
-                 if final_message_obj.get("content") is None: final_message_obj["content"] = ""
-                 final_message_obj["tool_calls"] = tool_calls
-            elif provider_role == 'tool':
-                 if not content and attachments:
-                      final_message_obj["content"] = "[Tool result data in attachment]"
-                 elif not content:
-                      print("Warning: Tool message has no text content, skipping.")
-                      continue
-                 else:
-                     final_message_obj["content"] = content
-                 if not tool_call_id:
-                      print(f"Warning: Tool message missing tool_call_id.")
-                 else:
-                      final_message_obj["tool_call_id"] = tool_call_id
-            elif provider_role == 'system':
+            last_text_part = next((part for part in reversed(content_parts) if part.get('type') == 'text'), None)
+            if last_text_part:
+                last_text_part['text'] += files_content_buffer
+            else:
+                content_parts.append({"type": "text", "text": files_content_buffer.lstrip()})
+
+    for img_attachment in image_attachments:
+         img_content = img_attachment['content']
+         # MIME type is set by prepare_context_images; otherwise sniff it from the data
+         mime_type = img_attachment.get('mime_type') or detect_image_mime(img_content)
+         if provider_lower == 'google':
+             content_parts.append({"inlineData": {"mimeType": mime_type, "data": img_content}}) # inlineData, mimeType, data
+         else: # OpenAI / Compatible
+             content_parts.append({
+                 "type": "image_url",
+                 "image_url": {"url": f"data:{mime_type};base64,{img_content}"}
+             })
+
+    # 3. Assign Content/Parts and Tool Info to Final Object
+    if provider_lower == 'google':
+        if provider_role == 'model' and tool_calls:
+            for call in tool_calls:
+                function = call.get("function") or {}
+                try: call_args = json.loads(function.get("arguments") or "{}")
+                except json.JSONDecodeError: call_args = {}
+                call_part: Dict[str, Any] = {"functionCall": {"name": function.get("name"), "args": call_args if isinstance(call_args, dict) else {"value": call_args}}}
+                if call.get("thought_signature"): call_part["thoughtSignature"] = call["thought_signature"]
+                content_parts.append(call_part)
+        if provider_role == 'function' and tool_name:
+            final_message_obj["parts"] = [{"functionResponse": {"name": tool_name, "response": {"result": content or "[Tool Execution Result Missing]"}}}]
+        elif content_parts:
+            final_message_obj["parts"] = content_parts
+        elif provider_role == 'function': # Tool result message
+             # For manual tool flow, content is the string result
+             if content:
+                  final_message_obj["parts"] = [{"text": content}]
+             else: # Should have content if it's a tool result
+                  final_message_obj["parts"] = [{"text": "[Tool Execution Result Missing]"}]
+        elif provider_role in ['user', 'model'] and not content_parts:
+            # Google API requires 'parts' to be non-empty for user/model roles.
+            # If after processing text and attachments, parts is still empty, add an empty text part.
+            logger.warning("Google message (Role: %s) has no content parts. Adding empty text part.", provider_role)
+            final_message_obj["parts"] = [{"text": ""}] # Ensure parts is not empty
+        else:
+             logger.warning("Skipping Google message with no parts (Role: %s, Content: '%s')", provider_role, content)
+             return None, False
+
+    else: # OpenAI / Compatible
+        if content_parts:
+            if len(content_parts) > 1:
+                final_message_obj["content"] = content_parts
+            elif len(content_parts) == 1 and content_parts[0]['type'] == 'text':
+                 final_message_obj["content"] = content_parts[0]['text']
+            elif len(content_parts) == 1 and content_parts[0]['type'] == 'image_url':
+                 final_message_obj["content"] = content_parts
+            else:
+                 final_message_obj["content"] = None
+
+        if provider_role == 'assistant' and tool_calls:
+             if final_message_obj.get("content") is None: final_message_obj["content"] = ""
+             # thought_signature is Google-only state kept alongside the call
+             final_message_obj["tool_calls"] = [{key: value for key, value in call.items() if key != "thought_signature"} for call in tool_calls]
+        elif provider_role == 'tool':
+             if not content and attachments:
+                  final_message_obj["content"] = "[Tool result data in attachment]"
+             elif not content:
+                  logger.warning("Tool message has no text content, skipping.")
+                  return None, False
+             else:
                  final_message_obj["content"] = content
-            elif final_message_obj.get("content") is None and not tool_calls:
-                 print(f"Warning: Skipping OpenAI message with no content/tool_calls (Role: {provider_role})")
-                 continue
+             if not tool_call_id:
+                  logger.warning("Tool message missing tool_call_id.")
+             else:
+                  final_message_obj["tool_call_id"] = tool_call_id
+        elif provider_role == 'system':
+             final_message_obj["content"] = content
+        elif final_message_obj.get("content") is None and not tool_calls:
+             logger.warning("Skipping OpenAI message with no content/tool_calls (Role: %s)", provider_role)
+             return None, False
+
+    return final_message_obj, len(files_content_buffer) >= CACHE_MIN_ATTACHMENT_CHARS
+
+class ProviderMessageFormatter:
+    """
+    Formats conversation history for one provider, incrementally.
 
-        formatted.append(final_message_obj)
+    Formatted messages are cached by (message_id, provider), and the consecutive-role
+    cleanup pass keeps its state between calls, so within the tool loop each call only
+    formats and checks the messages appended since the previous call (the new assistant
+    and tool results). If the history prefix changes, everything is re-formatted.
+    """
 
-    cleaned = []
-    last_role = None
-    for i, msg in enumerate(formatted):
+    def __init__(self, provider: str):
+        self.provider_lower = provider.lower()
+        self._format_cache: Dict[Tuple[str, str], Tuple[Optional[Dict[str, Any]], bool]] = {}
+        self._reset()
+
+    def _reset(self) -> None:
+        self._source: List[Dict[str, Any]] = [] # Internal messages already processed (by identity)
+        self._cleaned: List[Dict[str, Any]] = []
+        self._large_attachment_ids: Set[int] = set()
+        self._last_role: Optional[str] = None
+        self._tool_names: Dict[str, str] = {} # tool_call_id -> function name, for Google functionResponse parts
+
+    def _cache_key(self, msg: Dict[str, Any]) -> Tuple[str, str]:
+        # Entries without a DB id (system prompt, context summary) are keyed by object identity,
+        # which is stable for the lifetime of the history list this formatter is used with.
+        return (msg.get("message_id") or f"obj:{id(msg)}", self.provider_lower)
+
+    def _accept(self, msg: Dict[str, Any]) -> bool:
+        """Consecutive-role cleanup for one message, given the role of the previously accepted one."""
+        last_role = self._last_role
         current_role = msg.get("role")
         # Tool messages can follow assistant or other tool messages in multi-tool call scenarios
         is_tool_related_sequence = (last_role == 'assistant' and current_role == 'tool') or \
                                    (last_role == 'tool' and current_role == 'assistant') or \
                                    (last_role == 'tool' and current_role == 'tool')  # Multiple tool results
 
-        if i > 0 and current_role == last_role and not is_tool_related_sequence:
-             if provider_lower == 'google' and current_role in ['user', 'model']:
+        if self.provider_lower == 'google':
+            is_tool_related_sequence = is_tool_related_sequence or (last_role == 'model' and current_role == 'function')
+
+        if last_role is not None and current_role == last_role and not is_tool_related_sequence:
+             if self.provider_lower == 'google' and current_role in ['user', 'model']:
                  # Google strictly requires user/model alternation.
                  # If this happens, it's an issue with the input message history construction.
-                 print(f"ERROR: Consecutive identical roles '{current_role}' for Google provider. This will likely cause an API error.")
+                 logger.error("Consecutive identical roles '%s' for Google provider. This will likely cause an API error.", current_role)
                  # Potentially raise an error or try to fix, but for now just warn and proceed.
              elif current_role != 'system':
-                 print(f"Warning: Skipping consecutive message with role {current_role} for non-Google provider.")
-                 continue
+                 logger.warning("Skipping consecutive message with role %s for non-Google provider.", current_role)
+                 return False
 
-        if provider_lower == 'google':
+        if self.provider_lower == 'google':
             if last_role == 'model' and current_role not in ['user', 'function']:
-                print(f"Warning: Google API expects user/function message after model message. Got {current_role}.")
+                logger.warning("Google API expects user/function message after model message. Got %s.", current_role)
             if last_role == 'user' and current_role not in ['model']:
-                 print(f"Warning: Google API expects model message after user message. Got {current_role}.")
+                 logger.warning("Google API expects model message after user message. Got %s.", current_role)
             if last_role == 'function' and current_role not in ['model']:
-                 print(f"Warning: Google API expects model message after function message. Got {current_role}.")
+                 logger.warning("Google API expects model message after function message. Got %s.", current_role)
+
+        self._last_role = current_role
+        return True
+
+    def format(self, messages: List[Dict[str, Any]], cache_breakpoints: bool = False) -> List[Dict[str, Any]]:
+        processed = len(self._source)
+        if processed > len(messages) or any(a is not b for a, b in zip(self._source, messages)):
+            self._reset()
+            processed = 0
+        new_messages = messages[processed:]
+        logger.debug("Formatting %s new of %s messages for provider: %s", len(new_messages), len(messages), self.provider_lower)
+
+        for msg in new_messages:
+            self._source.append(msg)
+            for call in msg.get("tool_calls") or []:
+                if call.get("id"): self._tool_names[call["id"]] = (call.get("function") or {}).get("name")
+            key = self._cache_key(msg)
+            cached = self._format_cache.get(key)
+            if cached is None:
+                cached = _format_message_for_provider(msg, self.provider_lower, self._tool_names.get(msg.get("tool_call_id")))
+                self._format_cache[key] = cached
+            formatted_msg, has_large_attachment = cached
+            if formatted_msg is None:
+                continue
+            if self.provider_lower == 'google' and formatted_msg.get("role") == 'function' and self._last_role == 'function' and self._cleaned:
+                # Google expects all responses to one model turn's function calls in a single content
+                merged = self._cleaned[-1]
+                self._cleaned[-1] = {"role": "function", "parts": merged.get("parts", []) + formatted_msg.get("parts", [])}
+                continue
+            if not self._accept(formatted_msg):
+                continue
+            self._cleaned.append(formatted_msg)
+            if has_large_attachment:
+                self._large_attachment_ids.add(id(formatted_msg))
 
-        cleaned.append(msg)
-        last_role = current_role
-    
-    if provider_lower == 'google' and cleaned and cleaned[0].get("role") == 'model':
-        print("Warning: First message for Google API request is 'model'. This might be an issue if no prior user message context exists (e.g. system prompt).")
-    if provider_lower == 'google' and cleaned and cleaned[-1].get("role") == 'model':
-         print("Warning: Last message role is 'model' for Google API request. Awaiting user input usually follows.")
+        cleaned = list(self._cleaned)
+        if self.provider_lower == 'google' and cleaned and cleaned[0].get("role") == 'model':
+            logger.warning("First message for Google API request is 'model'. This might be an issue if no prior user message context exists (e.g. system prompt).")
+        if self.provider_lower == 'google' and cleaned and cleaned[-1].get("role") == 'model':
+             logger.warning("Last message role is 'model' for Google API request. Awaiting user input usually follows.")
+
+        if cache_breakpoints and self.provider_lower != 'google':
+            _apply_cache_breakpoints(cleaned, self._large_attachment_ids)
+
+        return cleaned
 
+def format_messages_for_provider(messages: List[Dict[str, Any]], provider: str, cache_breakpoints: bool = False) -> List[Dict[str, Any]]:
+    """
+    Formats an array of internal message objects (including attachments)
+    into the structure required by a specific LLM provider.
+    If cache_breakpoints is True (OpenAI-compatible providers only), stable prefixes
+    are marked with cache_control for provider prompt caching.
+    For repeated formatting of a growing history, use ProviderMessageFormatter.
+    """
+    return ProviderMessageFormatter(provider).format(messages, cache_breakpoints=cache_breakpoints)
+
+# JSON-schema keywords accepted in Google functionDeclarations (an OpenAPI subset); others are rejected by the API
+GOOGLE_SCHEMA_KEYS = {"type", "format", "description", "nullable", "enum", "properties", "required", "items", "minItems", "maxItems", "minimum", "maximum", "anyOf", "title"}
+
+def _google_schema(schema: Any) -> Any:
+    if not isinstance(schema, dict):
+        return schema
+    cleaned = {key: value for key, value in schema.items() if key in GOOGLE_SCHEMA_KEYS}
+    if isinstance(cleaned.get("properties"), dict):
+        cleaned["properties"] = {name: _google_schema(prop) for name, prop in cleaned["properties"].items()}
+    if "items" in cleaned: cleaned["items"] = _google_schema(cleaned["items"])
+    if isinstance(cleaned.get("anyOf"), list): cleaned["anyOf"] = [_google_schema(option) for option in cleaned["anyOf"]]
     return cleaned
 
+def google_function_declarations(openai_tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Converts OpenAI-format tools into a Google `tools` entry with functionDeclarations."""
+    declarations = []
+    for tool in openai_tools:
+        function = tool.get("function") or {}
+        declaration = {"name": function.get("name"), "description": function.get("description", "")}
+        parameters = function.get("parameters")
+        if parameters and parameters.get("properties"): # Google rejects empty object schemas
+            declaration["parameters"] = _google_schema(parameters)
+        declarations.append(declaration)
+    return [{"functionDeclarations": declarations}] if declarations else []
+
+def collect_native_tool_calls(accumulators: Dict[str, Dict[str, Any]], order: List[str], active_tool_registry: Dict[str, Callable[..., Any]], log: logging.LoggerAdapter) -> List[Dict[str, Any]]:
+    """
+    Turns streamed native tool call accumulators ({id, name, arguments_chunks, thought_signature})
+    into the call descriptions used by the tool loop.
+    """
+    calls = []
+    for index_key in order:
+        accumulator = accumulators.get(index_key)
+        if not accumulator:
+            log.warning("No accumulator for %s", index_key, extra={"phase": "tool"})
+            continue
+        # Get the actual call ID (stored from first chunk) or generate one
+        call_id = accumulator.get("id") or f"tool_{uuid.uuid4().hex[:8]}"
+        name = accumulator.get("name") or "unknown_tool"
+        if name == "unknown_tool":
+            log.warning("Tool call missing name for %s, accumulator: %s", index_key, accumulator, extra={"phase": "tool"})
+            continue  # Skip tool calls without names
+        arguments_text = "".join(accumulator.get("arguments_chunks", []))
+        log.debug("Native tool call: name=%s, id=%s, args_len=%s", name, call_id, len(arguments_text), extra={"phase": "tool"})
+        parsed_args: Dict[str, Any] = {}
+        parse_error: Optional[Exception] = None
+        if arguments_text:
+            try:
+                # Native tool calls: arguments is already the direct args object (not wrapped)
+                parsed_payload_obj = json.loads(arguments_text)
+                parsed_args = parsed_payload_obj if isinstance(parsed_payload_obj, dict) else {"value": parsed_payload_obj}
+            except Exception as parse_err_native:
+                parse_error = parse_err_native
+        calls.append({
+            "name": name,
+            "id": call_id,
+            "arguments": parsed_args,
+            "raw_payload": arguments_text,
+            # Display tag for the frontend (for compatibility with existing UI)
+            "raw_tag": f'<tool_call name="{name}" id="{call_id}">{json.dumps(parsed_args)}</tool_call>',
+            "parse_error": parse_error,
+            "enabled": name in active_tool_registry,
+            "thought_signature": accumulator.get("thought_signature"),
+        })
+    return calls
+
+def native_tool_call_info(calls: List[Dict[str, Any]], pre_text: str) -> Dict[str, Any]:
+    """The tool loop's description of a batch of native tool calls (first call mirrored at the top level)."""
+    return {
+        "name": calls[0]["name"],
+        "arguments": calls[0]["arguments"],
+        "id": calls[0]["id"],
+        "type": "native",
+        "payload_raw": calls[0]["raw_payload"],
+        "parse_error": calls[0].get("parse_error"),
+        "trailing_text": "",
+        "enabled": calls[0]["enabled"],
+        "pre_text": pre_text,
+        "calls": calls
+    }
+
+async def iter_sse_data(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Incremental Server-Sent Events parser: yields the data payload of each event.
+    Multi-line `data:` fields are joined with newlines; comments and other fields are ignored.
+    """
+    data_lines: List[str] = []
+    async for line in lines:
+        if not line.strip(): # Blank line dispatches the event
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+            continue
+        if line.startswith("data:"):
+            data_lines.append(line[6:] if line.startswith("data: ") else line[5:])
+    if data_lines: # Stream closed without the final blank line
+        yield "\n".join(data_lines)
+
+def extract_usage_counts(usage: Any) -> Dict[str, int]:
+    """
+    Normalizes a provider usage payload (OpenAI/OpenRouter `usage` or Google
+    `usageMetadata`) into the token counts stored per message (see USAGE_FIELDS).
+    completion_tokens includes reasoning tokens for every provider.
+    """
+    counts: Dict[str, int] = {}
+    if not isinstance(usage, dict):
+        return counts
+    prompt_details = usage.get("prompt_tokens_details")
+    if not isinstance(prompt_details, dict): prompt_details = {}
+    completion_details = usage.get("completion_tokens_details")
+    if not isinstance(completion_details, dict): completion_details = {}
+
+    def first_present(*values: Any) -> Optional[int]:
+        return next((int(value) for value in values if isinstance(value, (int, float))), None)
+
+    prompt = first_present(usage.get("prompt_tokens"), usage.get("promptTokenCount"), usage.get("input_tokens"))
+    reasoning = first_present(completion_details.get("reasoning_tokens"), usage.get("thoughtsTokenCount"))
+    completion = first_present(usage.get("completion_tokens"), usage.get("output_tokens"))
+    if completion is None and "candidatesTokenCount" in usage: # Google reports thoughts separately from candidates
+        completion = int(usage["candidatesTokenCount"]) + (reasoning or 0)
+    cache_read = first_present(prompt_details.get("cached_tokens"), usage.get("cache_read_input_tokens"), usage.get("cachedContentTokenCount"))
+    cache_write = first_present(prompt_details.get("cache_write_tokens"), usage.get("cache_creation_input_tokens"))
+    for field, value in zip(USAGE_FIELDS, (prompt, completion, reasoning, cache_read, cache_write)):
+        if value is not None: counts[field] = value
+    return counts
+
+def record_usage_rollup(cursor: sqlite3.Cursor, chat_id: str, model_name: Optional[str], timestamp_ms: int, usage: Dict[str, int]) -> None:
+    """Adds one LLM call's usage to the daily rollup row for its chat, character and model."""
+    cursor.execute("SELECT character_id FROM chats WHERE chat_id = ?", (chat_id,))
+    chat_row = cursor.fetchone()
+    character_id = (chat_row["character_id"] if chat_row else None) or ""
+    day = time.strftime("%Y-%m-%d", time.gmtime(timestamp_ms / 1000))
+    cursor.execute(
+        f"""INSERT INTO usage_rollups (day, chat_id, character_id, model_name, calls, {", ".join(USAGE_FIELDS)})
+            VALUES (?, ?, ?, ?, 1, {", ".join("?" for _ in USAGE_FIELDS)})
+            ON CONFLICT (day, chat_id, character_id, model_name) DO UPDATE SET
+            calls = calls + 1, {", ".join(f"{field} = {field} + excluded.{field}" for field in USAGE_FIELDS)}""",
+        (day, chat_id, character_id, model_name or "unknown", *(int(usage.get(field) or 0) for field in USAGE_FIELDS))
+    )
+
 async def _perform_generation_stream(
     chat_id: str,
     parent_message_id: str,
@@ -728,6 +1503,10 @@ async def _perform_generation_stream(
     Saves partial content if aborted by the user.
     Now emits thinking content as separate JSON events instead of inline tags.
     """
+    trace = GenerationTrace() # Span timeline, saved against the messages this generation creates
+    trace_message_ids: List[str] = []
+    glog = ContextLogger(logger, {"chat_id": chat_id, "generation_id": trace.trace_id[:8], "model": model_name})
+    generation_started_at = time.perf_counter()
     conn_check = None
     full_response_content_for_frontend = "" # For display logging, not directly used by frontend from here
     current_llm_history = []
@@ -739,6 +1518,7 @@ async def _perform_generation_stream(
     reasoning_from_api = False  # True if reasoning came from delta.reasoning (API), False if from inline <think> tags
     current_turn_content_accumulated = "" # Accumulates all text from current LLM turn (segment) - main content only
     current_turn_thinking_accumulated = "" # Accumulates thinking/reasoning content separately
+    call_usage: Dict[str, int] = {} # Token usage reported for the current LLM call
     # Custom CoT tag handling (still used for stripping from context if not preserving)
     effective_cot_start = (cot_start_tag or "").strip() or None
     effective_cot_end = (cot_end_tag or "").strip() or None
@@ -746,10 +1526,11 @@ async def _perform_generation_stream(
     active_tool_defs: List[ToolDefinition] = []
     active_tool_registry: Dict[str, Callable[..., Any]] = {}
 
+    GENERATIONS_ACTIVE.inc()
     try:
         conn_check = get_db_connection()
         cursor_check = conn_check.cursor()
-        print(f"[Gen Start] Chat: {chat_id}, Parent: {parent_message_id}, Model: {model_name}, Tools: {tools_enabled}")
+        glog.info("Generation started. Parent: %s, Tools: %s", parent_message_id, tools_enabled, extra={"phase": "setup"})
         cursor_check.execute("SELECT character_id FROM chats WHERE chat_id = ?", (chat_id,))
         chat_info = cursor_check.fetchone()
         if not chat_info:
@@ -757,11 +1538,11 @@ async def _perform_generation_stream(
 
         system_prompt_text = ""
         char_info: Optional[Dict[str, Any]] = None
+        char_settings: Dict[str, Any] = {}
         provider_hint: Optional[str] = None
         openrouter_providers_list: Optional[List[str]] = None
         if chat_info["character_id"]:
-            cursor_check.execute("SELECT sysprompt, model_name, model_provider, model_identifier, model_supports_images, preferred_model, openrouter_providers FROM characters WHERE character_id = ?", (chat_info["character_id"],))
-            char_info_row = cursor_check.fetchone()
+            char_info_row = character_cache.get(chat_info["character_id"])
             if char_info_row:
                 char_info = dict(char_info_row)
                 system_prompt_text = char_info.get("sysprompt", "") or ""
@@ -776,6 +1557,7 @@ async def _perform_generation_stream(
                 # Parse openrouter_providers if present
                 if char_info.get("openrouter_providers"):
                     openrouter_providers_list = [p.strip() for p in char_info["openrouter_providers"].split(",") if p.strip()]
+                char_settings = char_info.get("settings") or {} # Parsed once by the character cache
             else:
                 system_prompt_text = ""
 
@@ -784,9 +1566,9 @@ async def _perform_generation_stream(
         if tools_enabled:
             active_tool_defs, active_tool_registry, openai_format_tools = resolve_tools_subset(enabled_tool_names)
             if enabled_tool_names and not active_tool_defs:
-                print(f"[Gen Tools] Warning: No registered tools match requested names: {enabled_tool_names}")
+                glog.warning("No registered tools match requested names: %s", enabled_tool_names, extra={"phase": "setup"})
             if not active_tool_registry:
-                print("[Gen Tools] No active tools after filtering; disabling tool usage for this generation.")
+                glog.info("No active tools after filtering; disabling tool usage for this generation.", extra={"phase": "setup"})
                 tools_enabled = False
 
         effective_system_prompt = system_prompt_text.strip()
@@ -804,7 +1586,7 @@ async def _perform_generation_stream(
                     'model_identifier': char_info.get('model_identifier') or model_name,
                     'supports_images': bool(char_info.get('model_supports_images'))
                 }
-                print(f"[Gen Fallback] Using embedded character model config for '{model_name}' (provider={model_config['provider']}).")
+                glog.info("Using embedded character model config for '%s' (provider=%s).", model_name, model_config['provider'], extra={"phase": "setup"})
                 provider_hint = (model_config.get('provider') or provider_hint)
 
         if not provider_hint:
@@ -813,6 +1595,8 @@ async def _perform_generation_stream(
                 provider_hint = "local"
             elif model_name and (model_name.startswith('/') or model_name.startswith('~') or '\\' in model_name or model_name_lower.endswith((".gguf", ".ggml", ".bin", ".pth", ".safetensors"))):
                 provider_hint = "local"
+            elif local_models.serves(model_name): # Runtime name picked by resolve_local_runtime_model
+                provider_hint = "local"
 
         if not model_config and provider_hint == "local":
             supports_images = False
@@ -828,14 +1612,16 @@ async def _perform_generation_stream(
                 'model_identifier': model_name,
                 'supports_images': supports_images
             }
-            print(f"[Gen Fallback] Synthesized local model config for '{model_name}'.")
+            glog.debug("Synthesized local model config for '%s'.", model_name, extra={"phase": "setup"})
         if not model_config: raise ValueError(f"Configuration for model '{model_name}' not found.")
         provider = model_config.get('provider', 'openrouter').lower()
         model_identifier = model_config.get('model_identifier', model_name)
         api_details = get_llm_api_details(provider)
-        print(f"[Gen Setup] Provider: {provider}, Identifier: {model_identifier}")
+        glog = glog.bind(provider=provider)
+        glog.debug("Identifier: %s", model_identifier, extra={"phase": "setup"})
 
         _system_prompt_for_context_build = effective_system_prompt if provider not in ['google'] else None
+        context_build_started_at = time.perf_counter()
         current_llm_history = build_context_from_db(
             conn_check,
             cursor_check,
@@ -849,7 +1635,46 @@ async def _perform_generation_stream(
 
         conn_check.close(); conn_check = None; cursor_check = None
 
-        tool_call_count = 0 # For manual tool loop (currently only for non-Google)
+        # --- Context window management: trim the oldest turns that don't fit the model's window ---
+        context_limit = char_settings.get("context_length") or model_config.get("context_length")
+        context_policy = char_settings.get("context_policy") or "drop_oldest"
+        if context_policy not in CONTEXT_POLICIES:
+            glog.info("Unknown context_policy '%s', using drop_oldest.", context_policy, extra={"phase": "context"})
+            context_policy = "drop_oldest"
+        if context_limit:
+            output_reserve = gen_args.get("max_tokens") or DEFAULT_OUTPUT_TOKEN_RESERVE
+            prompt_budget = int(context_limit) - int(output_reserve)
+            if tools_enabled and openai_format_tools:
+                prompt_budget -= estimate_tokens(json.dumps(openai_format_tools))
+            if provider == 'google' and effective_system_prompt:
+                prompt_budget -= estimate_tokens(effective_system_prompt) + MESSAGE_TOKEN_OVERHEAD
+            current_llm_history, trim_stats = trim_context_to_budget(current_llm_history, prompt_budget, context_policy)
+            if trim_stats["summary"]:
+                if provider == 'google':
+                    effective_system_prompt = f"{effective_system_prompt}\n\n{trim_stats['summary']}".strip()
+                else:
+                    insert_at = next((i for i, entry in enumerate(current_llm_history) if entry.get("role") != "system"), len(current_llm_history))
+                    current_llm_history.insert(insert_at, {"role": "system", "message": trim_stats["summary"]})
+            if trim_stats["trimmed_messages"]:
+                glog.info("Trimmed %s messages (~%s tokens) to fit %s (policy=%s).", trim_stats['trimmed_messages'], trim_stats['trimmed_tokens'], context_limit, context_policy, extra={"phase": "context"})
+                yield f"data: {json.dumps({'type': 'context_trimmed', 'trimmed_tokens': trim_stats['trimmed_tokens'], 'trimmed_messages': trim_stats['trimmed_messages'], 'context_tokens': trim_stats['context_tokens'], 'context_limit': int(context_limit), 'policy': context_policy})}\n\n"
+
+        # --- Image preprocessing: drop unsupported/stale images, downscale the rest for the provider ---
+        if any(a.get("type") == "image" for entry in current_llm_history for a in entry.get("attachments") or []):
+            max_image_turns = char_settings.get("image_max_turns")
+            image_stats = await asyncio.to_thread(
+                prepare_context_images, current_llm_history, provider,
+                bool(model_config.get("supports_images")), int(max_image_turns) if max_image_turns else None
+            )
+            glog.debug("Images sent: %s, dropped: %s, saved: %s bytes", image_stats['images_sent'], image_stats['images_dropped'], image_stats['bytes_saved'], extra={"phase": "context"})
+        trace.add("context_build", context_build_started_at, time.perf_counter(), messages=len(current_llm_history))
+
+        # Prompt caching breakpoints are only sent where cache_control is understood (OpenRouter);
+        # Google's implicit context caching needs no markers and still reports cached tokens.
+        prompt_caching = bool(char_settings.get("prompt_caching")) and provider == 'openrouter'
+        message_formatter = ProviderMessageFormatter(provider) # Formats only messages appended since the last LLM call
+
+        tool_call_count = 0 # Tool calls executed so far in this generation (native or manual)
         # max_tool_calls passed from request, -1 means unlimited
 
         while max_tool_calls < 0 or tool_call_count < max_tool_calls:
@@ -857,25 +1682,31 @@ async def _perform_generation_stream(
                 stream_error = asyncio.CancelledError("Aborted before LLM call")
                 break
 
-            print(f"[Gen LLM Call {tool_call_count + 1}] Chat: {chat_id}, History Len: {len(current_llm_history)}")
+            glog.debug("LLM call %s, history len: %s", tool_call_count + 1, len(current_llm_history), extra={"phase": "llm"})
             
-            llm_messages_for_api = format_messages_for_provider(current_llm_history, provider)
+            with trace.span("format", call=tool_call_count + 1):
+                llm_messages_for_api = message_formatter.format(current_llm_history, cache_breakpoints=prompt_caching)
             
             request_url: str; llm_body: Dict[str, Any]; headers: Dict[str, str]
+            local_slot: Optional[int] = None # Slot pinned for this call, released after it (see slot_affinity.py)
 
             if provider == 'google':
-                request_url = f"{api_details['base_url'].rstrip('/')}/v1beta/models/{model_identifier}:streamGenerateContent?key={api_details['api_key']}"
+                request_url = f"{api_details['base_url'].rstrip('/')}/v1beta/models/{model_identifier}:streamGenerateContent?alt=sse"
                 llm_body = {"contents": llm_messages_for_api}
+                if tools_enabled and openai_format_tools:
+                    llm_body["tools"] = google_function_declarations(openai_format_tools)
                 google_gen_config = {}
                 if gen_args: # Map standard args to Google's generationConfig
                     if "temperature" in gen_args: google_gen_config["temperature"] = gen_args["temperature"]
                     if "max_tokens" in gen_args: google_gen_config["maxOutputTokens"] = gen_args["max_tokens"]
                     if "top_p" in gen_args: google_gen_config["topP"] = gen_args["top_p"]
                     if "top_k" in gen_args: google_gen_config["topK"] = gen_args["top_k"]
+                if model_config.get("include_thoughts"): # Thought summaries stream as `thought: true` parts
+                    google_gen_config["thinkingConfig"] = {"includeThoughts": True}
                 if google_gen_config: llm_body["generationConfig"] = google_gen_config
                 if effective_system_prompt:
                     llm_body["systemInstruction"] = {"parts": [{"text": effective_system_prompt}]}
-                headers = {'Content-Type': 'application/json'}
+                headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream', 'x-goog-api-key': api_details['api_key'] or ""}
             else: # OpenAI / OpenRouter / Local
                 request_url = f"{api_details['base_url'].rstrip('/')}/chat/completions"
                 llm_body = {"model": model_identifier, "messages": llm_messages_for_api, "stream": True, **gen_args}
@@ -887,6 +1718,13 @@ async def _perform_generation_stream(
                 # Add OpenRouter provider order if specified and using OpenRouter
                 if provider == 'openrouter' and openrouter_providers_list:
                     llm_body["provider"] = {"order": openrouter_providers_list}
+                if provider == 'openrouter':
+                    llm_body["usage"] = {"include": True} # Final chunk reports token usage incl. cache reads/writes
+                if provider == 'local' and local_slots.enabled:
+                    llm_body["cache_prompt"] = True # llama.cpp: only evaluate the prompt past the slot's cached prefix
+                    local_slot = local_slots.acquire(chat_id)
+                    if local_slot is not None: llm_body["id_slot"] = local_slot
+                llm_body.setdefault("stream_options", {"include_usage": True}) # Final chunk (empty choices) carries `usage`
                 headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream'}
                 if api_details['api_key']: headers['Authorization'] = f"Bearer {api_details['api_key']}"
             
@@ -896,103 +1734,100 @@ async def _perform_generation_stream(
             native_tool_call_accumulators: Dict[str, Dict[str, Any]] = {}
             native_tool_call_order: List[str] = []
             native_tool_call_chunk_emitted = False
+            call_usage = {}
             # is_done_signal_from_llm: Indicates the current LLM call has finished sending content.
-            # For Google, it's when ']' of the array is processed or stream ends.
+            # For Google, it's when the SSE stream ends.
             # For OpenAI, it's when "data: [DONE]" is received.
             is_done_signal_from_llm = False
+            llm_call_started_at = time.perf_counter()
+            response_at: Optional[float] = None # Response headers received
+            first_byte_at: Optional[float] = None
+            first_token_at: Optional[float] = None
+            output_chars_before_call = len(current_turn_content_accumulated) + len(current_turn_thinking_accumulated)
+            call_completed = False # Set once the stream is fully read; any other exit (e.g. client disconnect) counts as aborted
 
 
             try:
-                async with httpx.AsyncClient(timeout=600.0) as client:
+                async with provider_clients.client() as client:
                     async with client.stream("POST", request_url, json=llm_body, headers=headers) as response:
+                        response_at = time.perf_counter()
                         if response.status_code != 200:
                             error_body_bytes = await response.aread()
                             detail = f"LLM API Error ({response.status_code})"
                             try: detail += f" - {error_body_bytes.decode()}"
                             except Exception: pass
-                            print(f"LLM API Error: {detail} for URL: {request_url}")
+                            glog.error("LLM API Error: %s for URL: %s", detail, request_url, extra={"phase": "llm"})
                             raise HTTPException(status_code=response.status_code, detail=detail)
 
                         if provider == 'google':
-                            json_stream_decoder = json.JSONDecoder()
-                            buffer = ""
-                            first_bracket_parsed = False # True after '[' of the main array is consumed
-
-                            async for text_chunk in response.aiter_text(): # Iterate over text chunks for Google
+                            google_call_index = 0
+                            async for data_str in iter_sse_data(response.aiter_lines()):
+                                if first_byte_at is None: first_byte_at = time.perf_counter()
                                 if abort_event.is_set():
                                     stream_error = asyncio.CancelledError("Aborted by user during Google stream")
                                     break
-                                buffer += text_chunk
-                                
-                                if not first_bracket_parsed:
-                                    stripped_buffer = buffer.lstrip()
-                                    if stripped_buffer.startswith('['):
-                                        first_bracket_parsed = True
-                                        buffer = stripped_buffer[1:] # Consume '['
-                                    elif not stripped_buffer: # Buffer is all whitespace
-                                        buffer = "" 
+                                try:
+                                    decoded_obj = json.loads(data_str)
+                                except json.JSONDecodeError as json_err:
+                                    glog.warning("JSON decode error for Google stream: %s - Data: '%s'", json_err, data_str[:200], extra={"phase": "llm"})
+                                    continue
+                                if "error" in decoded_obj:
+                                    err_detail = decoded_obj["error"].get("message", str(decoded_obj["error"]))
+                                    stream_error = HTTPException(status_code=decoded_obj["error"].get("code", 500), detail=f"Google API Stream Error: {err_detail}")
+                                    break
+                                if decoded_obj.get("usageMetadata"):
+                                    call_usage.update(extract_usage_counts(decoded_obj["usageMetadata"]))
+
+                                candidate = (decoded_obj.get("candidates") or [{}])[0]
+                                for part in (candidate.get("content") or {}).get("parts") or []:
+                                    if first_token_at is None: first_token_at = time.perf_counter()
+                                    if "functionCall" in part:
+                                        function_call = part["functionCall"] or {}
+                                        index_key = f"tool_idx_{google_call_index}"
+                                        google_call_index += 1
+                                        # Google sends each call whole; args are kept as a single JSON chunk for the shared collector
+                                        native_tool_call_accumulators[index_key] = {
+                                            "id": function_call.get("id"),
+                                            "name": function_call.get("name"),
+                                            "arguments_chunks": [json.dumps(function_call.get("args") or {})],
+                                            "thought_signature": part.get("thoughtSignature"),
+                                        }
+                                        native_tool_call_order.append(index_key)
                                         continue
-                                    elif len(buffer) > 4096: # Safety for very long non-JSON start
-                                        stream_error = ValueError("Google stream did not start with '[' or is too large before finding it.")
-                                        break
-                                    else: # Still waiting for '[' or more data
+                                    text = part.get("text")
+                                    if not text:
                                         continue
-                                if not first_bracket_parsed: continue # Should not happen if break conditions are met
-
-                                # Process buffer for JSON objects
-                                while buffer:
-                                    obj_start_idx = 0
-                                    # Skip leading whitespace and commas before the next object
-                                    while obj_start_idx < len(buffer) and (buffer[obj_start_idx].isspace() or buffer[obj_start_idx] == ','):
-                                        obj_start_idx += 1
-                                    
-                                    if obj_start_idx >= len(buffer): buffer = ""; break # Only whitespace/commas left
-
-                                    if buffer[obj_start_idx] == ']': # End of the main array
-                                        is_done_signal_from_llm = True; buffer = buffer[obj_start_idx+1:]; break 
-
-                                    try:
-                                        # Attempt to decode one JSON object (GenerateContentResponse)
-                                        decoded_obj, consumed_length = json_stream_decoder.raw_decode(buffer, obj_start_idx)
-                                        buffer = buffer[consumed_length:] # Update buffer by removing the consumed part
-
-                                        if "error" in decoded_obj:
-                                            err_detail = decoded_obj["error"].get("message", str(decoded_obj["error"]))
-                                            raise HTTPException(status_code=decoded_obj["error"].get("code", 500), detail=f"Google API Stream Error: {err_detail}")
-
-                                        current_text_from_google_obj = ""
-                                        candidates = decoded_obj.get("candidates")
-                                        if candidates and isinstance(candidates, list) and len(candidates) > 0:
-                                            candidate = candidates[0]
-                                            if candidate.get("content") and candidate["content"].get("parts"):
-                                                text_parts = [part.get("text", "") for part in candidate["content"]["parts"] if "text" in part]
-                                                if text_parts: current_text_from_google_obj = "".join(text_parts)
-                                            # Check finishReason to see if this is the last piece of content
-                                            # if candidate.get("finishReason") in ["STOP", "MAX_TOKENS", "SAFETY", "RECITATION", "OTHER"]:
-                                            #    is_done_signal_from_llm = True # Content from this LLM call is finished.
-                                        
-                                        if current_text_from_google_obj:
-                                            yield f"data: {json.dumps({'type': 'chunk', 'data': current_text_from_google_obj})}\n\n"
-                                            full_response_content_for_frontend += current_text_from_google_obj
-                                            current_turn_content_accumulated += current_text_from_google_obj
-                                        
-                                    except json.JSONDecodeError: # Not enough data in buffer for a complete JSON object
-                                        break # Break from 'while buffer' to get more text_chunks
-                                    except HTTPException as e_http: stream_error = e_http; break # Propagate
-
-                                if stream_error or is_done_signal_from_llm : break # Break from 'while buffer' and 'aiter_text'
-                            
-                            # After Google's aiter_text loop
-                            if stream_error: pass # Will be raised later
-                            elif not is_done_signal_from_llm and first_bracket_parsed: # Stream ended without ']'
-                                if buffer.strip() and buffer.strip() != ']': # Check for unprocessed remnants
-                                    print(f"Warning: Google stream ended with unprocessed buffer: '{buffer[:200].strip()}'")
-                                is_done_signal_from_llm = True # Consider done as stream has ended
-                            elif not first_bracket_parsed and not stream_error :
-                                stream_error = ValueError("Google stream ended before '[' was found or processed.")
-                        
+                                    if part.get("thought"):
+                                        if not backend_is_streaming_reasoning:
+                                            yield f"data: {json.dumps({'type': 'thinking_start'})}\n\n"
+                                            backend_is_streaming_reasoning = True
+                                            reasoning_from_api = True
+                                        yield f"data: {json.dumps({'type': 'thinking_chunk', 'data': text})}\n\n"
+                                        current_turn_thinking_accumulated += text
+                                        continue
+                                    if backend_is_streaming_reasoning:
+                                        yield f"data: {json.dumps({'type': 'thinking_end'})}\n\n"
+                                        backend_is_streaming_reasoning = False
+                                        reasoning_from_api = False
+                                    yield f"data: {json.dumps({'type': 'chunk', 'data': text})}\n\n"
+                                    full_response_content_for_frontend += text
+                                    current_turn_content_accumulated += text
+
+                            if not stream_error:
+                                is_done_signal_from_llm = True # Google ends the SSE stream after the last candidate
+                                if backend_is_streaming_reasoning:
+                                    yield f"data: {json.dumps({'type': 'thinking_end'})}\n\n"
+                                    backend_is_streaming_reasoning = False
+                                if native_tool_call_order:
+                                    native_calls_info = collect_native_tool_calls(native_tool_call_accumulators, native_tool_call_order, active_tool_registry, glog)
+                                    if native_calls_info:
+                                        for call_info in native_calls_info:
+                                            yield f"data: {json.dumps({'type': 'tool_call', 'name': call_info['name'], 'id': call_info['id'], 'arguments': call_info['arguments']})}\n\n"
+                                        detected_tool_call_info = native_tool_call_info(native_calls_info, current_turn_content_accumulated)
+
                         else: # OpenAI / OpenRouter / Local (uses aiter_lines)
                             async for line in response.aiter_lines():
+                                if first_byte_at is None: first_byte_at = time.perf_counter()
                                 if abort_event.is_set():
                                     stream_error = asyncio.CancelledError("Aborted by user during stream")
                                     break
@@ -1014,7 +1849,13 @@ async def _perform_generation_stream(
 
                                 try:
                                     data = json.loads(data_str)
-                                    choice = data.get("choices", [{}])[0]
+                                    if data.get("usage"):
+                                        call_usage.update(extract_usage_counts(data["usage"]))
+                                    if isinstance(data.get("timings"), dict) and isinstance(data["timings"].get("cache_n"), int):
+                                        call_usage.setdefault("cache_read_tokens", data["timings"]["cache_n"]) # llama.cpp: prompt tokens reused from the slot
+                                    if detected_tool_call_info is not None:
+                                        continue # Native tool calls already collected; drain to [DONE] for the usage chunk
+                                    choice = (data.get("choices") or [{}])[0]
                                     delta = choice.get("delta", {}) if isinstance(choice, dict) else {}
                                     # Some providers use 'message' instead of 'delta' in streaming
                                     message = choice.get("message", {}) if isinstance(choice, dict) else {}
@@ -1059,14 +1900,16 @@ async def _perform_generation_stream(
                                             if index_key not in native_tool_call_order:
                                                 native_tool_call_order.append(index_key)
                                     elif potential_tool_calls is not None and not isinstance(potential_tool_calls, list):
-                                        print(f"[Gen Tool] Warning: Unexpected tool_calls payload type: {type(potential_tool_calls)}")
+                                        glog.warning("Unexpected tool_calls payload type: %s", type(potential_tool_calls), extra={"phase": "tool"})
 
                                     # Handle reasoning/thinking chunks as separate JSON events
                                     # For OpenRouter/OpenAI, reasoning comes in delta.reasoning or delta.reasoning_content
+                                    if (reasoning_chunk or content_chunk or potential_tool_calls) and first_token_at is None:
+                                        first_token_at = time.perf_counter()
                                     if reasoning_chunk:
                                         if not backend_is_streaming_reasoning:
                                             # Emit thinking_start event
-                                            print(f"[Gen Reasoning] Starting reasoning stream, first chunk len: {len(reasoning_chunk)}")
+                                            glog.debug("Starting reasoning stream, first chunk len: %s", len(reasoning_chunk), extra={"phase": "llm"})
                                             yield f"data: {json.dumps({'type': 'thinking_start'})}\n\n"
                                             backend_is_streaming_reasoning = True
                                             reasoning_from_api = True  # Mark that reasoning is from API
@@ -1209,50 +2052,8 @@ async def _perform_generation_stream(
                                     # When finish_reason is "tool_calls", process accumulated native tool calls
 
                                     if finish_reason == "tool_calls" and detected_tool_call_info is None and native_tool_call_order:
-                                        print(f"[Gen Tool] Processing {len(native_tool_call_order)} native tool calls: {native_tool_call_order}")
-                                        native_calls_info = []
-                                        raw_tag_fragments: List[str] = []
-                                        for index_key in native_tool_call_order:
-                                            accumulator = native_tool_call_accumulators.get(index_key)
-                                            if not accumulator:
-                                                print(f"[Gen Tool] Warning: No accumulator for {index_key}")
-                                                continue
-                                            # Get the actual call ID (stored from first chunk) or generate one
-                                            call_id = accumulator.get("id") or f"tool_{uuid.uuid4().hex[:8]}"
-                                            name = accumulator.get("name") or "unknown_tool"
-                                            if name == "unknown_tool":
-                                                print(f"[Gen Tool] Warning: Tool call missing name for {index_key}, accumulator: {accumulator}")
-                                                continue  # Skip tool calls without names
-                                            arguments_text = "".join(accumulator.get("arguments_chunks", []))
-                                            print(f"[Gen Tool] Native tool call: name={name}, id={call_id}, args_len={len(arguments_text)}")
-                                            parsed_args: Dict[str, Any] = {}
-                                            payload_for_raw = arguments_text
-                                            parse_error: Optional[Exception] = None
-                                            if arguments_text:
-                                                try:
-                                                    # Native OpenAI tool calls: arguments is already the direct args object
-                                                    parsed_payload_obj = json.loads(arguments_text)
-                                                    if isinstance(parsed_payload_obj, dict):
-                                                        # For native calls, arguments ARE the payload directly (not wrapped)
-                                                        parsed_args = parsed_payload_obj
-                                                    else:
-                                                        parsed_args = {"value": parsed_payload_obj}
-                                                except Exception as parse_err_native:
-                                                    parse_error = parse_err_native
-                                                    parsed_args = {}
-                                            # Generate a display tag for frontend (for compatibility with existing UI)
-                                            raw_tag_native = f'<tool_call name="{name}" id="{call_id}">{json.dumps(parsed_args)}</tool_call>'
-                                            raw_tag_fragments.append(raw_tag_native)
-                                            native_calls_info.append({
-                                                "name": name,
-                                                "id": call_id,
-                                                "arguments": parsed_args,
-                                                "raw_payload": payload_for_raw,
-                                                "raw_tag": raw_tag_native,
-                                                "parse_error": parse_error,
-                                                "enabled": name in active_tool_registry
-                                            })
-
+                                        glog.debug("Processing %s native tool calls: %s", len(native_tool_call_order), native_tool_call_order, extra={"phase": "tool"})
+                                        native_calls_info = collect_native_tool_calls(native_tool_call_accumulators, native_tool_call_order, active_tool_registry, glog)
                                         if native_calls_info:
                                             # Emit each tool call as a JSON event (not XML)
                                             if not native_tool_call_chunk_emitted:
@@ -1260,23 +2061,11 @@ async def _perform_generation_stream(
                                                     try:
                                                         yield f"data: {json.dumps({'type': 'tool_call', 'name': call_info['name'], 'id': call_info['id'], 'arguments': call_info['arguments']})}\n\n"
                                                     except Exception as emit_err:
-                                                        print(f"[Gen Tool] Warning: Failed to stream native tool_call event: {emit_err}")
+                                                        glog.warning("Failed to stream native tool_call event: %s", emit_err, extra={"phase": "tool"})
                                                 native_tool_call_chunk_emitted = True
-                                            detected_tool_call_info = {
-                                                "name": native_calls_info[0]["name"],
-                                                "arguments": native_calls_info[0]["arguments"],
-                                                "id": native_calls_info[0]["id"],
-                                                "type": "native",
-                                                "payload_raw": native_calls_info[0]["raw_payload"],
-                                                "parse_error": native_calls_info[0].get("parse_error"),
-                                                "trailing_text": "",
-                                                "enabled": native_calls_info[0]["enabled"],
-                                                "pre_text": current_turn_content_accumulated,
-                                                "calls": native_calls_info
-                                            }
-                                            break
+                                            detected_tool_call_info = native_tool_call_info(native_calls_info, current_turn_content_accumulated)
 
-                                except json.JSONDecodeError as json_err: print(f"Warning: JSON decode error for OpenAI stream: {json_err} - Data: '{data_str}'")
+                                except json.JSONDecodeError as json_err: glog.warning("JSON decode error for OpenAI stream: %s - Data: '%s'", json_err, data_str, extra={"phase": "llm"})
                                 except Exception as parse_err: stream_error = parse_err; break # from aiter_lines
 
                             # After OpenAI/OpenRouter/Local aiter_lines loop
@@ -1287,6 +2076,7 @@ async def _perform_generation_stream(
                         
                         # Common error check after specific provider stream handling
                         if stream_error: raise stream_error
+                        call_completed = True
 
             except (httpx.RequestError, HTTPException, asyncio.CancelledError, Exception) as e:
                 # This catches errors from client.stream setup, or propagated stream_error
@@ -1314,24 +2104,38 @@ async def _perform_generation_stream(
                         pass
 
                 break  # Break outer while tool_call_count loop on any stream error
+            finally:
+                local_slots.release(local_slot)
+                output_chars = len(current_turn_content_accumulated) + len(current_turn_thinking_accumulated) - output_chars_before_call
+                # GeneratorExit (client gone) skips the except above and leaves stream_error unset
+                call_error = stream_error if stream_error is not None or call_completed else asyncio.CancelledError("Stream abandoned")
+                record_llm_call_metrics(provider, model_name, llm_call_started_at, first_token_at, max(output_chars, 0), call_error, call_usage.get("completion_tokens"))
+                trace.add("llm_call", llm_call_started_at, time.perf_counter(), call=tool_call_count + 1, error=type(call_error).__name__ if call_error else None)
+                if response_at is not None: trace.add("connect", llm_call_started_at, response_at, call=tool_call_count + 1)
+                if first_byte_at is not None: trace.add("first_byte", first_byte_at, call=tool_call_count + 1)
+                if first_token_at is not None: trace.add("first_token", first_token_at, call=tool_call_count + 1)
 
             # --- Process after stream (either completed or tool detected) ---
             if not detected_tool_call_info: # No tool call, this is the final segment from LLM for this turn
                 if current_turn_content_accumulated or current_turn_thinking_accumulated:
                     # Save the entire accumulated content for this turn (segment)
                     # Thinking content is now stored separately
-                    message_id_final = create_message(
-                        chat_id=chat_id, role=MessageRole.LLM,
-                        content=current_turn_content_accumulated,
-                        parent_message_id=last_saved_message_id,
-                        model_name=model_name,
-                        thinking_content=current_turn_thinking_accumulated if current_turn_thinking_accumulated else None,
-                        commit=True
-                    )
+                    with trace.span("persist", role="llm") as persist_span:
+                        message_id_final = create_message(
+                            chat_id=chat_id, role=MessageRole.LLM,
+                            content=current_turn_content_accumulated,
+                            parent_message_id=last_saved_message_id,
+                            model_name=model_name,
+                            thinking_content=current_turn_thinking_accumulated if current_turn_thinking_accumulated else None,
+                            usage=call_usage, trace_id=trace.trace_id,
+                            commit=True
+                        )
+                        persist_span["message_id"] = message_id_final
+                    trace_message_ids.append(message_id_final)
                     last_saved_message_id = message_id_final
-                    print(f"Saved final LLM message segment: {message_id_final} (Content: {len(current_turn_content_accumulated)}, Thinking: {len(current_turn_thinking_accumulated)})")
+                    glog.debug("Saved final LLM message segment: %s (Content: %s, Thinking: %s)", message_id_final, len(current_turn_content_accumulated), len(current_turn_thinking_accumulated), extra={"phase": "persist"})
                 else:
-                    print("[Gen Info] Final LLM segment empty after full processing, not saving.")
+                    glog.debug("Final LLM segment empty after full processing, not saving.", extra={"phase": "persist"})
                 generation_completed_normally = True
                 break # Exit the outer generation (tool call) loop
             else: # Tool call(s) detected
@@ -1361,23 +2165,28 @@ async def _perform_generation_stream(
                         arguments_json_str = json.dumps(call_args)
                     except TypeError:
                         arguments_json_str = json.dumps({})
-                    db_tool_calls_data.append({
+                    db_tool_call = {
                         "id": call.get("id") or f"tool_{uuid.uuid4().hex[:8]}",
                         "type": "function",
                         "function": {
                             "name": call.get("name"),
                             "arguments": arguments_json_str
                         }
-                    })
-
-                message_id_A = create_message(
-                    chat_id=chat_id, role=MessageRole.LLM, content=content_for_assistant_msg_with_call,
-                    parent_message_id=last_saved_message_id, model_name=model_name,
-                    thinking_content=current_turn_thinking_accumulated if current_turn_thinking_accumulated else None,
-                    tool_calls=db_tool_calls_data, commit=True
-                )
+                    }
+                    if call.get("thought_signature"): db_tool_call["thought_signature"] = call["thought_signature"] # Echoed back to Google
+                    db_tool_calls_data.append(db_tool_call)
+
+                with trace.span("persist", role="llm") as persist_span:
+                    message_id_A = create_message(
+                        chat_id=chat_id, role=MessageRole.LLM, content=content_for_assistant_msg_with_call,
+                        parent_message_id=last_saved_message_id, model_name=model_name,
+                        thinking_content=current_turn_thinking_accumulated if current_turn_thinking_accumulated else None,
+                        tool_calls=db_tool_calls_data, usage=call_usage, trace_id=trace.trace_id, commit=True
+                    )
+                    persist_span["message_id"] = message_id_A
+                trace_message_ids.append(message_id_A)
                 last_saved_message_id = message_id_A
-                print(f"Saved Assistant Message (Tool Call Detected): {message_id_A}")
+                glog.debug("Saved Assistant Message (Tool Call Detected): %s", message_id_A, extra={"phase": "persist"})
 
                 thinking_for_history = current_turn_thinking_accumulated or ""
                 history_message_text = pre_text or ""
@@ -1388,6 +2197,7 @@ async def _perform_generation_stream(
                     history_message_text = f"{think_block}\n{history_message_text}" if history_message_text else think_block
 
                 assistant_msg_for_history = {
+                    "message_id": message_id_A,
                     "role": "assistant",
                     "message": history_message_text,
                     "tool_calls": db_tool_calls_data
@@ -1408,17 +2218,19 @@ async def _perform_generation_stream(
                     if not tool_function:
                         tool_error_str = f"Tool '{tool_name}' is not enabled or not available."
                     else:
-                        try:
-                            if asyncio.iscoroutinefunction(tool_function):
-                                result = await tool_function(**tool_args)
-                            else:
-                                result = await asyncio.to_thread(tool_function, **tool_args)
-                            tool_result_content_str = str(result)
-                        except Exception as e_tool:
-                            tool_error_str = f"Error executing tool '{tool_name}': {e_tool}"
-                            traceback.print_exc()
+                        with trace.span("tool", tool=tool_name, call_id=tool_call_id) as tool_span:
+                            try:
+                                result = await invoke_tool(tool_name, tool_function, tool_args)
+                                tool_result_content_str = str(result)
+                            except (ToolArgumentError, ToolTimeoutError) as e_tool: # Reported back to the model so it can correct the call
+                                tool_error_str = str(e_tool)
+                                tool_span["error"] = True
+                            except Exception as e_tool:
+                                tool_error_str = f"Error executing tool '{tool_name}': {e_tool}"
+                                tool_span["error"] = True
+                                glog.exception("Tool '%s' raised", tool_name, extra={"phase": "tool"})
                     if tool_error_str:
-                        print(f"[Gen Tool] {tool_error_str}")
+                        glog.warning("%s", tool_error_str, extra={"phase": "tool"})
 
                     # Full result for database and frontend (includes base64 images)
                     result_for_storage = tool_result_content_str if not tool_error_str else tool_error_str
@@ -1434,15 +2246,18 @@ async def _perform_generation_stream(
                             result_for_llm
                         )
 
-                    message_id_B = create_message(
-                        chat_id=chat_id, role=MessageRole.TOOL, content=result_for_storage,
-                        parent_message_id=message_id_A, model_name=None,
-                        tool_call_id=tool_call_id, commit=True
-                    )
+                    with trace.span("persist", role="tool") as persist_span:
+                        message_id_B = create_message(
+                            chat_id=chat_id, role=MessageRole.TOOL, content=result_for_storage,
+                            parent_message_id=message_id_A, model_name=None,
+                            tool_call_id=tool_call_id, trace_id=trace.trace_id, commit=True
+                        )
+                        persist_span["message_id"] = message_id_B
+                    trace_message_ids.append(message_id_B)
                     last_saved_message_id = message_id_B
-                    print(f"Saved Tool Result Message: {message_id_B}")
+                    glog.debug("Saved Tool Result Message: %s", message_id_B, extra={"phase": "persist"})
 
-                    tool_msg_for_history = {"role": "tool", "message": result_for_llm, "tool_call_id": tool_call_id}
+                    tool_msg_for_history = {"message_id": message_id_B, "role": "tool", "message": result_for_llm, "tool_call_id": tool_call_id}
                     current_llm_history.append(tool_msg_for_history)
 
                     # Emit tool result as JSON event (not XML)
@@ -1461,18 +2276,22 @@ async def _perform_generation_stream(
         stream_error = e_outer
         err_msg_outer = f"Error: {getattr(e_outer, 'detail', str(e_outer))}"
         if isinstance(e_outer, asyncio.CancelledError): err_msg_outer = "Generation stopped by user."
-        print(f"[Gen Handled Error Outer] Chat {chat_id}: {err_msg_outer}")
+        glog.warning("Generation ended: %s", err_msg_outer, extra={"phase": "finish"})
         # Avoid re-yielding general errors if specific LLM HTTP error already yielded
         if not isinstance(e_outer, (asyncio.CancelledError, HTTPException, httpx.RequestError)):
              try: yield f"data: {json.dumps({'type': 'error', 'message': err_msg_outer})}\n\n"
              except Exception: pass
     except Exception as e_unhandled:
         stream_error = e_unhandled
-        print(f"[Gen Unhandled Error Outer] Chat {chat_id}: {e_unhandled}\n{traceback.format_exc()}")
+        glog.exception("Unhandled generation error: %s", e_unhandled, extra={"phase": "finish"})
         try: yield f"data: {json.dumps({'type': 'error', 'message': 'Internal Server Error: Please check backend logs.'})}\n\n"
         except Exception: pass
     finally:
-        print(f"[Gen Finally] Chat {chat_id}. Abort: {abort_event.is_set()}, StreamError: {type(stream_error).__name__ if stream_error else 'None'}, Completed Loop: {generation_completed_normally}")
+        GENERATIONS_ACTIVE.dec()
+        GENERATION_SECONDS.observe(time.perf_counter() - generation_started_at, provider=provider or "unknown", model=model_name)
+        if stream_error and not isinstance(stream_error, asyncio.CancelledError):
+            GENERATION_ERRORS.inc(provider=provider or "unknown", model=model_name, kind=type(stream_error).__name__)
+        glog.debug("Abort: %s, StreamError: %s, Completed Loop: %s", abort_event.is_set(), type(stream_error).__name__ if stream_error else 'None', generation_completed_normally, extra={"phase": "finish"})
 
         if backend_is_streaming_reasoning: # Final safety net for thinking end event
             try:
@@ -1486,31 +2305,42 @@ async def _perform_generation_stream(
         is_aborted = isinstance(stream_error, asyncio.CancelledError) or abort_event.is_set()
         has_content_to_save = current_turn_content_accumulated or current_turn_thinking_accumulated
         if is_aborted and has_content_to_save and not generation_completed_normally:
-            print(f"[Gen Finally - Abort Save] Saving partial: Content={len(current_turn_content_accumulated)}, Thinking={len(current_turn_thinking_accumulated)} chars.")
+            glog.info("Saving partial: Content=%s, Thinking=%s chars.", len(current_turn_content_accumulated), len(current_turn_thinking_accumulated), extra={"phase": "persist"})
             try:
-                aborted_message_id = create_message(
-                    chat_id=chat_id, role=MessageRole.LLM,
-                    content=current_turn_content_accumulated,
-                    parent_message_id=last_saved_message_id, model_name=model_name,
-                    thinking_content=current_turn_thinking_accumulated if current_turn_thinking_accumulated else None,
-                    commit=True
-                )
-                print(f"[Gen Finally - Abort Save] Saved partial message ID: {aborted_message_id}")
-            except Exception as save_err: print(f"[Gen Finally - Abort Save Error] Failed to save partial: {save_err}")
+                with trace.span("persist", role="llm", aborted=True) as persist_span:
+                    aborted_message_id = create_message(
+                        chat_id=chat_id, role=MessageRole.LLM,
+                        content=current_turn_content_accumulated,
+                        parent_message_id=last_saved_message_id, model_name=model_name,
+                        thinking_content=current_turn_thinking_accumulated if current_turn_thinking_accumulated else None,
+                        usage=call_usage, trace_id=trace.trace_id,
+                        commit=True
+                    )
+                    persist_span["message_id"] = aborted_message_id
+                trace_message_ids.append(aborted_message_id)
+                glog.debug("Saved partial message ID: %s", aborted_message_id, extra={"phase": "persist"})
+            except Exception as save_err: glog.error("Failed to save partial: %s", save_err, extra={"phase": "persist"})
 
         if conn_check:
             try: conn_check.close()
             except Exception: pass
 
-        if chat_id in ACTIVE_GENERATIONS: del ACTIVE_GENERATIONS[chat_id]
-        print(f"[Gen Finish] Stream processing ended for chat {chat_id}.")
+        generation_registry.release(chat_id, abort_event)
+        timing_summary = trace.summary()
+        if trace_message_ids:
+            try: save_generation_trace(trace, chat_id, provider, model_name, trace_message_ids)
+            except Exception as trace_err: glog.warning("Failed to save generation trace: %s", trace_err, extra={"phase": "persist"})
+        glog.info("Stream processing ended in %.0f ms (first token at %s ms).", timing_summary["total_ms"], timing_summary["first_token_ms"], extra={"phase": "finish"})
 
         if generation_completed_normally and not stream_error and not abort_event.is_set():
-            try: yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            try:
+                yield f"data: {json.dumps({'type': 'timing', 'message_ids': trace_message_ids, **timing_summary})}\n\n"
+                yield f"data: {json.dumps({'type': 'done'})}\n\n"
             except Exception: pass
         else:
-            print("[Gen Finish] Skipping 'done' event due to error, abort, or incomplete tool loop.")
+            glog.debug("Skipping 'done' event due to error, abort, or incomplete tool loop.", extra={"phase": "finish"})
 
+@DB_OPERATION_SECONDS.time(operation="create_message")
 def create_message(
     chat_id: str,
     role: MessageRole,
@@ -1521,11 +2351,14 @@ def create_message(
     tool_call_id: Optional[str] = None, # ID *of the tool call* if this is a tool response msg, or ID *for the tool call* if assistant msg
     tool_calls: Optional[List[Dict[str, Any]]] = None, # The actual tool calls requested by an assistant
     thinking_content: Optional[str] = None, # CoT/reasoning content stored separately
+    usage: Optional[Dict[str, int]] = None, # Normalized provider usage counts (see extract_usage_counts)
+    trace_id: Optional[str] = None, # Generation trace this message belongs to
     commit: bool = True
 ) -> str:
     """
-    Creates a message in the database. Handles attachments, tool call data, and thinking content.
+    Creates a message in the database. Handles attachments, tool call data, thinking content and usage counts.
     """
+    usage = usage or {}
     if attachments is None: attachments = []
     message_id = str(uuid.uuid4())
     timestamp = int(time.time() * 1000)
@@ -1537,10 +2370,14 @@ def create_message(
     try:
         cursor.execute(
             """INSERT INTO messages
-               (message_id, chat_id, role, message, model_name, timestamp, parent_message_id, tool_call_id, tool_calls, thinking_content)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (message_id, chat_id, role.value, content, model_name, timestamp, parent_message_id, tool_call_id, tool_calls_str, thinking_content)
+               (message_id, chat_id, role, message, model_name, timestamp, parent_message_id, tool_call_id, tool_calls, thinking_content,
+                prompt_tokens, completion_tokens, reasoning_tokens, cache_read_tokens, cache_write_tokens, trace_id)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (message_id, chat_id, role.value, content, model_name, timestamp, parent_message_id, tool_call_id, tool_calls_str, thinking_content,
+             *(usage.get(field) for field in USAGE_FIELDS), trace_id)
         )
+        if usage and role == MessageRole.LLM:
+            record_usage_rollup(cursor, chat_id, model_name, timestamp, usage)
         for attachment in attachments:
             attachment_id = str(uuid.uuid4())
             # Ensure content is string (primarily for potential non-string data like base64)
@@ -1562,17 +2399,17 @@ def create_message(
                 # Set index to the position of the new message
                 new_idx = children_ids.index(message_id) if message_id in children_ids else len(children_ids) - 1
                 cursor.execute("UPDATE messages SET active_child_index = ? WHERE message_id = ?", (new_idx, parent_message_id))
-                print(f"Updated parent {parent_message_id} active index to {new_idx} for new child {message_id}")
+                logger.debug("Updated parent %s active index to %s for new child %s", parent_message_id, new_idx, message_id)
             except Exception as update_err:
                 # Log error but don't fail the whole message creation
-                print(f"Warning: Failed to update parent active index during message creation: {update_err}")
+                logger.warning("Failed to update parent active index during message creation: %s", update_err)
 
         if commit:
             conn.commit()
-            print(f"Committed message {message_id} (Role: {role.value})")
+            logger.debug("Committed message %s (Role: %s)", message_id, role.value)
     except sqlite3.Error as e:
         if commit: conn.rollback() # Only rollback if we intended to commit here
-        print(f"Error creating message: {e}")
+        logger.error("Error creating message: %s", e)
         # Re-raise as HTTPException for FastAPI handling if needed, or handle internally
         raise HTTPException(status_code=500, detail=f"Database error creating message: {e}")
     finally:
@@ -1603,28 +2440,86 @@ def get_message(message_id):
     except ValidationError as e: return message_dict # Return raw on validation error
 
 
-def get_chat_messages(chat_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM messages WHERE chat_id = ? ORDER BY timestamp", (chat_id,))
-    messages_data = cursor.fetchall()
+MESSAGE_COLUMNS = ("message_id", "chat_id", "role", "message", "model_name", "timestamp", "parent_message_id", "active_child_index",
+                   "tool_call_id", "tool_calls", "thinking_content", "token_count", "pinned", "cache_read_tokens", "cache_write_tokens",
+                   "trace_id", "prompt_tokens", "completion_tokens", "reasoning_tokens") # The stored fields of Message
+MESSAGE_FIELDS = ("message_id", "chat_id", "role", "message", "model_name", "timestamp", "parent_message_id", "active_child_index",
+                  "attachments", "child_message_ids", "tool_call_id", "tool_calls", "thinking_content", "token_count", "pinned",
+                  "cache_read_tokens", "cache_write_tokens", "trace_id", "prompt_tokens", "completion_tokens", "reasoning_tokens") # Message field order
+MESSAGE_ROLES = {role.value for role in MessageRole}
+
+def get_chat_messages(chat_id, conn: Optional[sqlite3.Connection] = None) -> List[Dict[str, Any]]:
+    """
+    The chat's messages as Message-shaped dicts, in two queries (messages, then all their attachments).
+    Rows are written by this API, so they are not re-validated through the Message model.
+    """
+    own_conn = conn is None
+    if own_conn: conn = get_db_connection()
+    try:
+        rows = conn.execute(f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE chat_id = ? ORDER BY timestamp", (chat_id,)).fetchall()
+        attachments: Dict[str, List[Dict[str, Any]]] = {}
+        for row in conn.execute("""SELECT a.message_id, a.type, a.content, a.name FROM attachments a
+                                   JOIN messages m ON m.message_id = a.message_id WHERE m.chat_id = ? ORDER BY a.rowid""", (chat_id,)):
+            attachments.setdefault(row["message_id"], []).append({"type": row["type"], "content": row["content"], "name": row["name"]})
+    finally:
+        if own_conn: conn.close()
     messages = []
-    for message_data in messages_data:
-        msg_id = message_data["message_id"]
-        message_dict = dict(message_data)
-        cursor.execute("SELECT type, content, name FROM attachments WHERE message_id = ?", (msg_id,))
-        attachments = [{"type": row["type"], "content": row["content"], "name": row["name"]} for row in cursor.fetchall()]
-        message_dict["attachments"] = attachments
-        cursor.execute("SELECT message_id FROM messages WHERE parent_message_id = ? ORDER BY timestamp", (msg_id,))
-        child_message_ids = [row["message_id"] for row in cursor.fetchall()]
-        message_dict["child_message_ids"] = child_message_ids
-        if message_dict.get("tool_calls"):
-            try: message_dict["tool_calls"] = json.loads(message_dict["tool_calls"])
+    children: Dict[str, List[str]] = {}
+    for row in rows:
+        if row["role"] not in MESSAGE_ROLES or row["message"] is None or row["timestamp"] is None:
+            continue # Same rows Message validation used to drop
+        stored = dict(zip(MESSAGE_COLUMNS, row))
+        stored["active_child_index"] = stored["active_child_index"] or 0
+        stored["pinned"] = bool(stored["pinned"])
+        if stored["tool_calls"]:
+            try: stored["tool_calls"] = json.loads(stored["tool_calls"])
             except json.JSONDecodeError: pass
-        try: messages.append(Message(**message_dict))
-        except ValidationError as e: pass # Skip invalid messages
-    conn.close()
-    return [msg.dict() for msg in messages]
+        stored["attachments"] = attachments.get(stored["message_id"], [])
+        stored["child_message_ids"] = children.setdefault(stored["message_id"], [])
+        messages.append({field: stored[field] for field in MESSAGE_FIELDS})
+    for row in rows: # Children in timestamp order, like the per-message child query did
+        if row["parent_message_id"] in children:
+            children[row["parent_message_id"]].append(row["message_id"])
+    return messages
+
+
+def json_bytes(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+COMPRESS_MIN_BYTES = int(os.environ.get("ZERYO_COMPRESS_MIN_BYTES", "8192")) # Smaller bodies go out uncompressed
+
+async def json_bytes_response(request: Request, body: bytes) -> Response:
+    """Prebuilt JSON, compressed with the client's preferred encoding once it is over COMPRESS_MIN_BYTES."""
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = negotiate(request.headers.get("accept-encoding")) if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        body = await asyncio.to_thread(compress, body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and (if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")))
+
+def etag_response(request: Request, body: bytes, etag: str) -> Response:
+    """JSON response with an ETag; 304 without a body when the client already has this version."""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} # no-cache: browsers revalidate with If-None-Match each time
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def asset_response(request: Request, asset: Asset, cache_control: str) -> Response:
+    """A prebuilt static file in the best encoding the client accepts, with that encoding's strong ETag."""
+    encoding = negotiate(request.headers.get("accept-encoding"), [name for name in asset.variants if name])
+    headers = {"ETag": asset.etag(encoding), "Cache-Control": cache_control}
+    if len(asset.variants) > 1: headers["Vary"] = "Accept-Encoding"
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if encoding: headers["Content-Encoding"] = encoding
+    return Response(content=asset.variants[encoding], media_type=asset.media_type, headers=headers)
 
 
 # --- NEW: Helper to get model config (enhanced with embedded character fallback) ---
@@ -1632,55 +2527,13 @@ def get_model_config(model_name: str) -> Optional[Dict[str, Any]]:
     """Resolve model configuration.
 
     Resolution order:
-      1. In-memory legacy model_configs (model_config.yaml)
-      2. Characters table embedded model_name fields
-      3. Characters table preferred_model fallback
-    Returns synthesized config dict when using embedded data.
+      1. model_config.yaml entries
+      2. Characters' embedded model_name fields
+      3. Characters' preferred_model fallback
+    Returns synthesized config dict when using embedded data. Backed by the in-memory
+    model_registry, so this is a dict lookup.
     """
-    if not model_name:
-        return None
-    target_name_lower = model_name.lower()
-    # 1. Legacy config list
-    for config in model_configs.get('models', []):
-        name = config.get('name')
-        if name and name.lower() == target_name_lower:
-            return config
-
-    # 2 & 3. Search characters for embedded definitions
-    try:
-        conn = get_db_connection(); cursor = conn.cursor()
-        # Direct model_name match
-        cursor.execute("""
-            SELECT model_name, model_provider, model_identifier, model_supports_images
-            FROM characters
-            WHERE lower(model_name) = lower(?) AND model_name IS NOT NULL AND model_name != ''
-            LIMIT 1
-        """, (model_name,))
-        row = cursor.fetchone()
-        if not row:
-            # Preferred model fallback
-            cursor.execute("""
-                SELECT preferred_model as model_name, model_provider, model_identifier, model_supports_images
-                FROM characters
-                WHERE lower(preferred_model) = lower(?) AND preferred_model IS NOT NULL AND preferred_model != ''
-                LIMIT 1
-            """, (model_name,))
-            row = cursor.fetchone()
-        conn.close()
-        if row:
-            synthesized = {
-                'name': model_name,
-                'provider': row['model_provider'] or 'openrouter',
-                'model_identifier': row['model_identifier'] or model_name,
-                'supports_images': bool(row['model_supports_images'])
-            }
-            print(f"[ModelConfig] Synthesized from character embedding for '{model_name}' (provider={synthesized['provider']}).")
-            return synthesized
-    except Exception as e:
-        try: conn.close()
-        except: pass
-        print(f"[ModelConfig] Embedded model lookup failed for '{model_name}': {e}")
-    return None
+    return model_registry.get(model_name)
 
 # --- NEW: Helper to get LLM API details ---
 def get_llm_api_details(provider: str) -> Dict[str, Any]:
@@ -1693,7 +2546,7 @@ def get_llm_api_details(provider: str) -> Dict[str, Any]:
         details["api_key"] = api_keys_config.get("openrouter")
     elif provider_lower == 'google':
         # Google doesn't have a single base URL like OpenAI spec, handled directly in request logic
-        details["base_url"] = "https://generativelanguage.googleapis.com" # Placeholder, specific path used later
+        details["base_url"] = api_keys_config.get("google_base_url", "https://generativelanguage.googleapis.com") # Overridable for mock_llm.py
         details["api_key"] = api_keys_config.get("google")
     elif provider_lower == 'local':
         details["base_url"] = api_keys_config.get("local_base_url", "http://127.0.0.1:8080")
@@ -1712,19 +2565,29 @@ def get_llm_api_details(provider: str) -> Dict[str, Any]:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: Initialize resources if needed (like connection pools)
-    print("API starting up...")
+    logger.info("API starting up (database: %s, %s model configs, tools: %s)...", DB_PATH, len(model_configs.get('models', [])), list(TOOL_REGISTRY.keys()))
+    if os.environ.get("ZERYO_LOOP_MONITOR", "1") != "0":
+        loop_monitor.start()
+    generation_registry.start()
+    character_cache.refresh() # Warm the character cache (and the model index built from it)
+    config_watcher.start()
+    local_models.start()
+    await asyncio.to_thread(static_assets.build) # Hash and compress the frontend files once
+    if os.environ.get("ZERYO_PRELOAD_TOOLS", "0") == "1":
+        await asyncio.to_thread(preload_tools) # Pay tool import costs at startup instead of on the first tool call
     yield
     # Shutdown: Cleanup resources
-    print("API shutting down...")
-    # Cancel any potentially running generation tasks (optional, good practice)
-    tasks_to_cancel = list(ACTIVE_GENERATIONS.keys())
-    for chat_id in tasks_to_cancel:
-        if chat_id in ACTIVE_GENERATIONS:
-            print(f"Cancelling generation task for chat {chat_id} on shutdown.")
-            ACTIVE_GENERATIONS[chat_id].set() # Signal task to stop
-            del ACTIVE_GENERATIONS[chat_id] # Remove from tracking
+    logger.info("API shutting down...")
+    await loop_monitor.stop()
+    # Signal this worker's running generations to stop and release their registrations
+    await generation_registry.stop()
+    await config_watcher.stop()
+    await local_models.stop()
     await asyncio.sleep(0.1) # Allow tasks a moment to react
+    await provider_clients.aclose()
 
+loop_monitor = LoopMonitor.from_env()
+app.router.lifespan_context = lifespan # The app is created before this is defined
 
 # --- API Endpoints (Rest are mostly unchanged) ---
 
@@ -1732,6 +2595,56 @@ async def lifespan(app: FastAPI):
 async def health_check():
     return {"status": "ok", "version": "1.3.0-data-api"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text-format metrics for this worker process."""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def require_admin(request: Request):
+    """Profiling endpoints are hidden unless ZERYO_ADMIN_TOKEN is set and the caller presents it."""
+    if not profile_store.enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("x-zeryo-admin-token") or request.query_params.get("token")
+    if not profile_store.check_token(token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/debug/loop")
+async def get_loop_report(request: Request, top: int = Query(20, ge=1, le=100)):
+    """Event loop lag histogram, recent stalls and the code sites that blocked the loop the longest."""
+    require_admin(request)
+    return loop_monitor.report(top)
+
+@app.get("/debug/config")
+async def get_config_status(request: Request):
+    """Watched config files and recent reloads in this worker."""
+    require_admin(request)
+    return config_watcher.status()
+
+@app.post("/config/reload")
+async def reload_config(request: Request):
+    """Reloads model_config.yaml and the key files now, and tells the other workers to do the same."""
+    require_admin(request)
+    return {"events": await config_watcher.reload(reason="POST /config/reload")}
+
+@app.get("/debug/profiles")
+async def list_profiles(request: Request):
+    """Stored profiles (on-demand and slowest-N), slowest first."""
+    require_admin(request)
+    return {"keep_slowest": profile_store.keep_slowest, "profiles": await asyncio.to_thread(profile_store.list_profiles)}
+
+@app.get("/debug/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request, format: str = Query("json", pattern="^(json|collapsed)$")):
+    """Downloads one profile; format=collapsed returns folded stacks for speedscope/flamegraph.pl."""
+    require_admin(request)
+    profile = await asyncio.to_thread(profile_store.load, profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        return Response(content=collapsed_text(profile), media_type="text/plain; charset=utf-8",
+                        headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'})
+    return Response(content=json.dumps(profile), media_type="application/json",
+                    headers={"Content-Disposition": f'attachment; filename="{profile_id}.json"'})
+
 @app.get("/config")
 async def get_config():
     config_data = {
@@ -1746,16 +2659,11 @@ async def get_config():
 @app.post("/api_keys")
 async def update_api_keys(payload: ApiKeysUpdateRequest):
     """Update api_keys.yaml without returning raw keys to the frontend."""
-    global api_keys_config
 
     existing = load_config('api_keys.yaml') or {}
 
-    new_config = {
-        "openrouter": existing.get("openrouter"),
-        "google": existing.get("google"),
-        "local_api_key": existing.get("local_api_key"),
-        "local_base_url": existing.get("local_base_url", "http://127.0.0.1:8080"),
-    }
+    new_config = dict(existing) # Keep entries this form doesn't edit (e.g. *_base_url overrides)
+    new_config.setdefault("local_base_url", "http://127.0.0.1:8080")
 
     if payload.openrouter and payload.openrouter.strip():
         new_config["openrouter"] = payload.openrouter.strip()
@@ -1766,8 +2674,11 @@ async def update_api_keys(payload: ApiKeysUpdateRequest):
     if payload.local_base_url and payload.local_base_url.strip():
         new_config["local_base_url"] = payload.local_base_url.strip()
 
+    errors = validate_api_keys(new_config)
+    if errors:
+        raise HTTPException(status_code=400, detail="; ".join(errors))
     save_config('api_keys.yaml', new_config)
-    api_keys_config = new_config
+    await config_watcher.reload(reason="POST /api_keys") # Applies it here and publishes it to the other workers
 
     return {
         "status": "ok",
@@ -1785,12 +2696,10 @@ async def generate_response(chat_id: str, request: GenerateRequest):
     Initiates server-side streaming generation for a chat.
     Returns a StreamingResponse with Server-Sent Events.
     """
-    if chat_id in ACTIVE_GENERATIONS:
+    abort_event = generation_registry.claim(chat_id)
+    if abort_event is None:
         raise HTTPException(status_code=409, detail="A generation task is already running for this chat.")
 
-    abort_event = asyncio.Event()
-    ACTIVE_GENERATIONS[chat_id] = abort_event
-
     # Filter generation args (ensure they are valid types if needed)
     # For now, pass them directly, assuming frontend sends reasonable values
     filtered_gen_args = request.generation_args or {}
@@ -1800,9 +2709,7 @@ async def generate_response(chat_id: str, request: GenerateRequest):
     char_row: Optional[Dict[str, Any]] = None
     if request.character_id:
         try:
-            conn_char = get_db_connection(); cur_char = conn_char.cursor()
-            cur_char.execute("SELECT model_name, model_provider, model_identifier, model_supports_images, preferred_model FROM characters WHERE character_id = ?", (request.character_id,))
-            fetched_char_row = cur_char.fetchone(); conn_char.close()
+            fetched_char_row = character_cache.get(request.character_id)
             if fetched_char_row:
                 char_row = dict(fetched_char_row)
                 if char_row.get('model_name'):
@@ -1810,7 +2717,7 @@ async def generate_response(chat_id: str, request: GenerateRequest):
                 elif char_row.get('preferred_model'):
                     embedded_model_override = char_row['preferred_model']
         except Exception as e:
-            print(f"[Gen] Embedded model lookup failed: {e}")
+            logger.warning("[Gen] Embedded model lookup failed: %s", e)
 
     if embedded_model_override:
         request.model_name = embedded_model_override
@@ -1826,19 +2733,10 @@ async def generate_response(chat_id: str, request: GenerateRequest):
             elif char_row and char_row.get('model_provider'):
                 provider_val = char_row.get('model_provider')
             if provider_val and provider_val.lower() == 'local':
-                import requests
-                resp = requests.get(f"{api_keys_config.get('local_base_url', 'http://127.0.0.1:8080')}/v1/models", timeout=2)
-                if resp.ok:
-                    data = resp.json()
-                    runtime_name = None
-                    if isinstance(data, dict):
-                        if 'models' in data and isinstance(data['models'], list) and data['models']:
-                            first = data['models'][0]; runtime_name = first.get('name') or first.get('model')
-                        elif 'data' in data and isinstance(data['data'], list) and data['data']:
-                            first = data['data'][0]; runtime_name = first.get('id')
-                    if runtime_name: resolved_model_name = runtime_name
+                runtime_name = local_models.runtime_model_name() # Cached by the background poller; never probes inline
+                if runtime_name: resolved_model_name = runtime_name
         except Exception as e:
-            print(f"[Gen] Runtime local model resolution failed: {e}")
+            logger.warning("[Gen] Runtime local model resolution failed: %s", e)
 
     stream_generator = _perform_generation_stream(
         chat_id=chat_id,
@@ -1854,26 +2752,34 @@ async def generate_response(chat_id: str, request: GenerateRequest):
         max_tool_calls=request.max_tool_calls
     )
 
-    return StreamingResponse(stream_generator, media_type="text/event-stream")
+    # The release also runs as a background task in case the stream is never started (client gone before the first byte)
+    return StreamingResponse(stream_generator, media_type="text/event-stream", background=BackgroundTask(generation_registry.release, chat_id, abort_event))
+
+@app.get("/local/models")
+async def list_local_models(refresh: bool = False):
+    """Models served by the local runtime at local_base_url, with its health, from the discovery cache."""
+    if refresh:
+        await local_models.refresh()
+    return {**local_models.status(), "slots": local_slots.status()}
 
 # (NEW) API Endpoint
 @app.post("/c/{chat_id}/abort_generation")
 async def abort_generation(chat_id: str):
     """Signals the backend to abort the active generation task for a chat."""
-    if chat_id not in ACTIVE_GENERATIONS:
+    # The owning worker (possibly another process) sees the flag on its next heartbeat; the task releases itself on exit
+    if not generation_registry.request_abort(chat_id):
         # It's okay if the task already finished, just inform the client
-        print(f"Received abort request for chat {chat_id}, but no active generation found.")
+        logger.info("Received abort request for chat %s, but no active generation found.", chat_id)
         return {"status": "ok", "message": "No active generation found or already stopped."}
 
-    print(f"Received abort request for chat {chat_id}. Signaling task...")
-    abort_event = ACTIVE_GENERATIONS[chat_id]
-    abort_event.set() # Signal the generator task to stop
-
-    # Remove immediately - the task will clean itself up from the dict on exit
-    # del ACTIVE_GENERATIONS[chat_id]
-
+    logger.info("Received abort request for chat %s. Signaling task...", chat_id)
     return {"status": "ok", "message": "Abort signal sent."}
 
+@app.get("/generations")
+async def list_active_generations():
+    """Generations currently running on any worker, with owner and last heartbeat."""
+    return await asyncio.to_thread(generation_registry.active)
+
 @app.post("/character", response_model=Dict[str, str])
 async def create_character_v2(character: Character):
     """Create a new character with embedded model fields (legacy preferred_model kept for compat)."""
@@ -1882,16 +2788,14 @@ async def create_character_v2(character: Character):
     try:
         # Normalize casing for model_name if provided
         model_name_norm = character.model_name or character.preferred_model
-        if model_name_norm:
-            cursor.execute("SELECT model_name, provider, model_identifier, supports_images FROM models WHERE lower(model_name) = lower(?)", (model_name_norm,))
-            found = cursor.fetchone()
-            if found and not character.model_provider:
-                # Use DB values to enrich if provider unspecified
-                character.model_name = found['model_name']
-                character.model_provider = found['provider']
-                character.model_identifier = found['model_identifier']
-                if character.model_supports_images is None:
-                    character.model_supports_images = bool(found['supports_images'])
+        found = model_registry.configured(model_name_norm)
+        if found and not character.model_provider:
+            # Use model_config.yaml values to enrich if provider unspecified
+            character.model_name = found.get('name')
+            character.model_provider = found.get('provider')
+            character.model_identifier = found.get('model_identifier')
+            if character.model_supports_images is None:
+                character.model_supports_images = bool(found.get('supports_images'))
         cursor.execute(
             """INSERT INTO characters (character_id, character_name, sysprompt, preferred_model, preferred_model_supports_images,
                 model_name, model_provider, model_identifier, model_supports_images, openrouter_providers, cot_start_tag, cot_end_tag, settings)
@@ -1912,7 +2816,9 @@ async def create_character_v2(character: Character):
                 json.dumps(character.settings or {})
             )
         )
+        bump_data_version(conn, CHARACTERS_DATA)
         conn.commit()
+        character_cache.write_through(conn, character_id)
     except sqlite3.IntegrityError as e:
         conn.rollback()
         if "UNIQUE constraint failed: characters.character_name" in str(e):
@@ -1923,65 +2829,18 @@ async def create_character_v2(character: Character):
     return {"character_id": character_id}
 
 @app.get("/characters")
-async def list_characters_v2():
-    """List all characters including embedded model data and CoT tags."""
-    conn = get_db_connection(); cursor = conn.cursor()
-    cursor.execute("""
-        SELECT character_id, character_name, sysprompt,
-               preferred_model, preferred_model_supports_images,
-               model_name, model_provider, model_identifier, model_supports_images,
-               openrouter_providers, cot_start_tag, cot_end_tag, settings
-        FROM characters ORDER BY character_name
-    """)
-    characters = []
-    for row in cursor.fetchall():
-        settings_obj = json.loads(row["settings"]) if row["settings"] else {}
-        characters.append({
-            "character_id": row["character_id"],
-            "character_name": row["character_name"],
-            "sysprompt": row["sysprompt"],
-            "preferred_model": row["preferred_model"],
-            "preferred_model_supports_images": bool(row["preferred_model_supports_images"]),
-            "model_name": row["model_name"],
-            "model_provider": row["model_provider"],
-            "model_identifier": row["model_identifier"],
-            "model_supports_images": bool(row["model_supports_images"]) if row["model_supports_images"] is not None else None,
-            "openrouter_providers": row["openrouter_providers"],
-            "cot_start_tag": row["cot_start_tag"],
-            "cot_end_tag": row["cot_end_tag"],
-            "settings": settings_obj
-        })
-    conn.close(); return characters
+async def list_characters_v2(request: Request):
+    """List all characters including embedded model data and CoT tags (served from the character cache)."""
+    body, etag = character_cache.list_response()
+    return etag_response(request, body, etag)
 
 @app.get("/character/{character_id}")
-async def get_character_v2(character_id: str):
+async def get_character_v2(character_id: str, request: Request):
     """Retrieve a single character with embedded model data."""
-    conn = get_db_connection(); cursor = conn.cursor()
-    cursor.execute("""
-        SELECT character_id, character_name, sysprompt,
-               preferred_model, preferred_model_supports_images,
-               model_name, model_provider, model_identifier, model_supports_images,
-               openrouter_providers, cot_start_tag, cot_end_tag, settings
-        FROM characters WHERE character_id = ?
-    """, (character_id,))
-    row = cursor.fetchone(); conn.close()
-    if not row:
+    cached = character_cache.response(character_id)
+    if cached is None:
         raise HTTPException(status_code=404, detail="Character not found")
-    return {
-        "character_id": row["character_id"],
-        "character_name": row["character_name"],
-        "sysprompt": row["sysprompt"],
-        "preferred_model": row["preferred_model"],
-        "preferred_model_supports_images": bool(row["preferred_model_supports_images"]),
-        "model_name": row["model_name"],
-        "model_provider": row["model_provider"],
-        "model_identifier": row["model_identifier"],
-        "model_supports_images": bool(row["model_supports_images"]) if row["model_supports_images"] is not None else None,
-        "openrouter_providers": row["openrouter_providers"],
-        "cot_start_tag": row["cot_start_tag"],
-        "cot_end_tag": row["cot_end_tag"],
-        "settings": json.loads(row["settings"]) if row["settings"] else {}
-    }
+    return etag_response(request, *cached)
 
 @app.put("/character/{character_id}")
 async def update_character_v2(character_id: str, update: UpdateCharacterRequest):
@@ -2030,7 +2889,9 @@ async def update_character_v2(character_id: str, update: UpdateCharacterRequest)
              new_model_name, new_model_provider, new_model_identifier, new_model_supports_images,
              new_openrouter_providers, new_cot_start, new_cot_end, json.dumps(new_settings or {}), character_id)
         )
+        bump_data_version(conn, CHARACTERS_DATA)
         conn.commit()
+        character_cache.write_through(conn, character_id)
     except sqlite3.IntegrityError as e:
         conn.rollback()
         if "UNIQUE constraint failed: characters.character_name" in str(e):
@@ -2049,7 +2910,9 @@ async def delete_character_v2(character_id: str):
         conn.close(); raise HTTPException(status_code=404, detail="Character not found")
     try:
         cursor.execute("DELETE FROM characters WHERE character_id = ?", (character_id,))
+        bump_data_version(conn, CHARACTERS_DATA)
         conn.commit()
+        character_cache.write_through(conn, character_id)
     except sqlite3.Error as e:
         conn.rollback(); raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
@@ -2092,19 +2955,27 @@ async def get_chats(offset: int = 0, limit: int = 50):
         chat_list.append(ChatListItem(chat_id=chat_id, preview=preview_text, timestamp_updated=row["timestamp_updated"]))
     conn.close(); return chat_list
 
+def chat_json(chat_id: str) -> Optional[bytes]:
+    """The GET /c/{chat_id} body (a Chat), serialized straight from the rows; None if there is no such chat."""
+    conn = get_db_connection()
+    try:
+        chat_data = conn.execute("SELECT chat_id, timestamp_created, timestamp_updated, character_id FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        if not chat_data: return None
+        messages = get_chat_messages(chat_id, conn)
+    finally:
+        conn.close()
+    return json_bytes({"chat_id": chat_data["chat_id"], "messages": messages, "timestamp_created": chat_data["timestamp_created"],
+                       "timestamp_updated": chat_data["timestamp_updated"], "character_id": chat_data["character_id"]})
+
 @app.get("/c/{chat_id}", response_model=Chat)
-async def get_chat(chat_id: str):
-    conn = get_db_connection(); cursor = conn.cursor()
-    cursor.execute("SELECT * FROM chats WHERE chat_id = ?", (chat_id,))
-    chat_data = cursor.fetchone()
-    if not chat_data: conn.close(); raise HTTPException(status_code=404, detail="Chat not found")
-    messages = get_chat_messages(chat_id) # Gets list of dicts
-    # Convert list of dicts back to Message models for Chat model validation
-    validated_messages = [Message(**msg_dict) for msg_dict in messages]
-    chat = Chat(chat_id=chat_data["chat_id"], timestamp_created=chat_data["timestamp_created"],
-                timestamp_updated=chat_data["timestamp_updated"], character_id=chat_data["character_id"],
-                messages=validated_messages)
-    conn.close(); return chat
+async def get_chat(chat_id: str, request: Request):
+    """
+    A chat with all its messages. The body is built by chat_json and returned as-is;
+    response_model=Chat only documents the shape in the OpenAPI schema and validates nothing.
+    """
+    body = await asyncio.to_thread(chat_json, chat_id) # Big chats take a while to read and encode; keep that off the event loop
+    if body is None: raise HTTPException(status_code=404, detail="Chat not found")
+    return await json_bytes_response(request, body)
 
 @app.delete("/c/{chat_id}")
 async def delete_chat(chat_id: str):
@@ -2114,6 +2985,7 @@ async def delete_chat(chat_id: str):
     try: cursor.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,)); conn.commit()
     except sqlite3.Error as e: conn.rollback(); raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally: conn.close()
+    local_slots.forget(chat_id)
     return {"status": "ok"}
 
 @app.post("/c/{chat_id}/set_active_character")
@@ -2160,7 +3032,7 @@ async def add_message(chat_id: str, request: AddMessageRequest):
     except HTTPException as http_exc: # Catch potential HTTP exceptions from create_message
         raise http_exc
     except Exception as e:
-        print(f"Unexpected error in add_message endpoint: {e}")
+        logger.error("Unexpected error in add_message endpoint: %s", e)
         raise HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
 
     if message_id is None: # Should not happen if no exception, but safety check
@@ -2198,7 +3070,7 @@ async def edit_message(chat_id: str, message_id: str, request: EditMessageReques
     tool_calls_str = json.dumps(request.tool_calls) if request.tool_calls else None
     try:
         timestamp = int(time.time() * 1000)
-        cursor.execute("UPDATE messages SET message = ?, model_name = ?, timestamp = ?, tool_calls = ? WHERE message_id = ?",
+        cursor.execute("UPDATE messages SET message = ?, model_name = ?, timestamp = ?, tool_calls = ?, token_count = NULL WHERE message_id = ?",
                        (request.message, request.model_name, timestamp, tool_calls_str, message_id))
         cursor.execute("DELETE FROM attachments WHERE message_id = ?", (message_id,))
         for attachment in request.attachments:
@@ -2230,6 +3102,73 @@ async def set_active_branch(chat_id: str, parent_message_id: str, request: SetAc
     finally: conn.close()
     return {"status": "ok"}
 
+@app.post("/c/{chat_id}/pin_message/{message_id}")
+async def pin_message(chat_id: str, message_id: str, request: PinMessageRequest):
+    """Pins (or unpins) a message so its turn is never dropped by context trimming."""
+    conn = get_db_connection(); cursor = conn.cursor()
+    cursor.execute("SELECT message_id FROM messages WHERE message_id = ? AND chat_id = ?", (message_id, chat_id))
+    if not cursor.fetchone(): conn.close(); raise HTTPException(status_code=404, detail="Message not found")
+    try:
+        cursor.execute("UPDATE messages SET pinned = ? WHERE message_id = ?", (1 if request.pinned else 0, message_id))
+        conn.commit()
+    except sqlite3.Error as e: conn.rollback(); raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    finally: conn.close()
+    return {"status": "ok"}
+
+@app.get("/c/{chat_id}/message/{message_id}/timing")
+async def get_message_timing(chat_id: str, message_id: str):
+    """Span timeline of the generation that produced a message."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT trace_id FROM messages WHERE message_id = ? AND chat_id = ?", (message_id, chat_id))
+        row = cursor.fetchone()
+        if not row: raise HTTPException(status_code=404, detail="Message not found")
+        if not row["trace_id"]: raise HTTPException(status_code=404, detail="No timing recorded for this message")
+        cursor.execute("SELECT * FROM generation_traces WHERE trace_id = ?", (row["trace_id"],))
+        trace_row = cursor.fetchone()
+        if not trace_row: raise HTTPException(status_code=404, detail="No timing recorded for this message")
+        trace_data = dict(trace_row)
+        trace_data["message_ids"] = json.loads(trace_data["message_ids"] or "[]")
+        trace_data["spans"] = json.loads(trace_data["spans"] or "[]")
+        return trace_data
+    finally: conn.close()
+
+USAGE_GROUP_COLUMNS = {"chat": "chat_id", "character": "character_id", "model": "model_name", "day": "day"}
+
+@app.get("/usage")
+async def get_usage(
+    group_by: str = Query("model", description="chat, character, model or day"),
+    chat_id: Optional[str] = None,
+    character_id: Optional[str] = None,
+    model_name: Optional[str] = None,
+    since: Optional[str] = Query(None, description="First UTC day to include (YYYY-MM-DD)"),
+    until: Optional[str] = Query(None, description="Last UTC day to include (YYYY-MM-DD)"),
+):
+    """Token usage totals from the daily rollups, grouped by chat, character, model or day."""
+    group_column = USAGE_GROUP_COLUMNS.get(group_by)
+    if not group_column:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(USAGE_GROUP_COLUMNS)}")
+    filters, params = [], []
+    for column, value in (("chat_id", chat_id), ("character_id", character_id), ("model_name", model_name)):
+        if value is not None: filters.append(f"u.{column} = ?"); params.append(value)
+    if since: filters.append("u.day >= ?"); params.append(since)
+    if until: filters.append("u.day <= ?"); params.append(until)
+    where_sql = f"WHERE {' AND '.join(filters)}" if filters else ""
+    sums_sql = ", ".join(f"SUM(u.{field}) AS {field}" for field in ("calls",) + USAGE_FIELDS)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT u.{group_column} AS key, {sums_sql} FROM usage_rollups u {where_sql} GROUP BY u.{group_column} ORDER BY u.{group_column}", params)
+        rows = [dict(row) for row in cursor.fetchall()]
+        if group_by == "character" and rows:
+            cursor.execute(f"SELECT character_id, character_name FROM characters WHERE character_id IN ({','.join('?' for _ in rows)})", [row["key"] for row in rows])
+            names = {row["character_id"]: row["character_name"] for row in cursor.fetchall()}
+            for row in rows: row["character_name"] = names.get(row["key"])
+        totals = {field: sum(row[field] or 0 for row in rows) for field in ("calls",) + USAGE_FIELDS}
+        return {"group_by": group_by, "rows": rows, "totals": totals}
+    finally: conn.close()
+
 # --- Tool Endpoints ---
 
 @app.get("/tools")
@@ -2249,64 +3188,70 @@ async def list_tools_openai_format(names: Optional[List[str]] = Query(default=No
     return {"tools": openai_tools}
 
 
+@app.get("/tools/imports")
+async def tool_imports():
+    """Which tool handlers this worker has imported so far, and what each import cost."""
+    return {"budget_ms": TOOL_IMPORT_BUDGET_MS, "tools": import_report()}
+
+
 @app.post("/tools/execute")
 async def execute_tool(request: ExecuteToolRequest):
     """ Executes the requested tool and returns the result. """
     tool_name = request.tool_name
     arguments = request.arguments
-    print(f"Executing tool: {tool_name} with args: {arguments}")
+    logger.info("Executing tool: %s with args: %s", tool_name, arguments)
     if tool_name not in TOOL_REGISTRY:
         raise HTTPException(status_code=404, detail=f"Tool '{tool_name}' not found.")
     tool_function = TOOL_REGISTRY[tool_name]
     try:
-        if asyncio.iscoroutinefunction(tool_function):
-            result = await tool_function(**arguments)
-        else:
-            result = await asyncio.to_thread(tool_function, **arguments)
-        print(f"Tool '{tool_name}' result: {result}")
+        result = await invoke_tool(tool_name, tool_function, arguments)
+        logger.debug("Tool '%s' result: %s", tool_name, result)
         return {"result": str(result)}
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ToolTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except TypeError as e:
          # Catch argument mismatches (e.g., wrong number, wrong names)
-         print(f"Tool execution error (TypeError): {e}")
+         logger.error("Tool execution error (TypeError): %s", e)
          # Provide a slightly more helpful error message if possible
          import inspect
          sig = inspect.signature(tool_function)
          expected_args = list(sig.parameters.keys())
          raise HTTPException(status_code=400, detail=f"Invalid arguments for tool '{tool_name}'. Expected: {expected_args}. Got: {list(arguments.keys())}. Error: {e}")
     except Exception as e:
-        print(f"Tool execution error: {e}")
+        logger.error("Tool execution error: %s", e)
         raise HTTPException(status_code=500, detail=f"Error executing tool '{tool_name}'.")
 
 # Serve index.html for /chat/{uuid} routes (SPA routing - page URLs use /chat/, API uses /c/)
-from fastapi.responses import FileResponse
+async def index_response(request: Request) -> Response:
+    if static_assets.stale(): # A frontend file was edited; rebuild so the page points at the new hashes
+        await asyncio.to_thread(static_assets.build)
+    if static_assets.index is None: raise HTTPException(status_code=404, detail="index.html not found")
+    return asset_response(request, static_assets.index, "no-cache")
 
 @app.get("/chat/{chat_id}")
-async def serve_chat_page(chat_id: str):
+async def serve_chat_page(chat_id: str, request: Request):
     """Serve the main SPA for chat URL routes."""
-    return FileResponse("index.html", media_type="text/html")
+    return await index_response(request)
 
 # Serve root index
 @app.get("/")
-async def serve_index():
+async def serve_index(request: Request):
     """Serve the main index page."""
-    return FileResponse("index.html", media_type="text/html")
+    return await index_response(request)
+
+@app.get("/assets/{name}")
+async def serve_asset(name: str, request: Request):
+    """Content-hashed frontend files (see static_assets.py); a given URL never changes content."""
+    asset = static_assets.get(name)
+    if asset is None: raise HTTPException(status_code=404, detail="Asset not found")
+    return asset_response(request, asset, "public, max-age=31536000, immutable")
 
 # Mount static files AFTER all API routes - without html=True so it won't catch API routes
 app.mount("/", StaticFiles(directory="."), name="static")
 
 if __name__ == "__main__":
-    import uvicorn
-    print("Starting Zeryo Chat Data API...")
-    print(f"Using Database: {DB_PATH}")
-    # Ensure DB init runs before starting server
-    try:
-        init_db()
-        print("Database initialized successfully.")
-    except Exception as db_err:
-        print(f"FATAL: Database initialization failed: {db_err}")
-        exit(1) # Exit if DB can't be initialized
-
-    print("Model Configs Loaded:", len(model_configs.get('models', [])))
-    print("Available Tools:", list(TOOL_REGISTRY.keys()))
-
-    uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True)
+    # `python api.py` is kept as a shortcut for serve.py; pass --dev for the auto-reloader
+    import serve
+    serve.main()
@@ -0,0 +1,175 @@
+# bench_storage.py
+"""
+Storage micro-benchmarks for the branching chat schema.
+
+Builds a synthetic SQLite database (separate from the real one) and times the storage
+paths the API relies on:
+  build_context_from_db, get_chat_messages, get_chats, create_message,
+  set_active_branch, delete_chat
+
+Each chat is a user/assistant chain `--depth` turns long. Every assistant turn has
+`--branching` regenerated siblings, and the last sibling is the active one. The
+active path continues the conversation. An attachment of `--attachment-kb` KB is
+added to every `--attachment-every`-th user message.
+
+    python bench_storage.py --chats 200 --depth 50 --branching 3
+    python bench_storage.py --chats 20 --depth 400 --branching 1 --output deep.json
+    python bench_storage.py --chats 50 --depth 20 --attachment-kb 512 --attachment-every 2
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import api
+
+
+class SyntheticChat:
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.leaf_id: Optional[str] = None # Last message on the active path
+        self.branch_points: List[tuple] = [] # (parent_message_id, child_count)
+
+
+def generate_database(path: str, chats: int, depth: int, branching: int, attachment_kb: int, attachment_every: int, seed: int) -> List[SyntheticChat]:
+    """Creates the schema at `path` and fills it with synthetic chats using bulk inserts."""
+    api.DB_PATH = path
+    api.init_db()
+    rng = random.Random(seed)
+    attachment_payload = base64.b64encode(rng.randbytes(attachment_kb * 1024)).decode() if attachment_kb else None
+    words = ("branch", "context", "token", "message", "stream", "model", "reply", "system", "window", "cache")
+    timestamp = int(time.time() * 1000) - chats * depth * (branching + 1) * 10
+    result: List[SyntheticChat] = []
+
+    conn = api.get_db_connection()
+    cursor = conn.cursor()
+    for _ in range(chats):
+        chat = SyntheticChat(str(uuid.uuid4()))
+        message_rows, attachment_rows = [], []
+        cursor.execute("INSERT INTO chats (chat_id, timestamp_created, timestamp_updated) VALUES (?, ?, ?)", (chat.chat_id, timestamp, timestamp))
+        parent_id = None
+        for turn in range(depth):
+            timestamp += 1
+            user_id = str(uuid.uuid4())
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(10, 60)))
+            message_rows.append((user_id, chat.chat_id, "user", text, None, timestamp, parent_id, branching - 1))
+            if attachment_payload and attachment_every and turn % attachment_every == 0:
+                attachment_rows.append((str(uuid.uuid4()), user_id, "image", attachment_payload, "synthetic.png"))
+            for _ in range(branching):
+                timestamp += 1
+                reply_id = str(uuid.uuid4())
+                reply = " ".join(rng.choice(words) for _ in range(rng.randint(40, 200)))
+                message_rows.append((reply_id, chat.chat_id, "llm", reply, "synthetic-model", timestamp, user_id, 0))
+            if branching > 1:
+                chat.branch_points.append((user_id, branching))
+            parent_id = reply_id # Last sibling is the active child (active_child_index = branching - 1)
+        cursor.executemany(
+            "INSERT INTO messages (message_id, chat_id, role, message, model_name, timestamp, parent_message_id, active_child_index) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            message_rows
+        )
+        cursor.executemany("INSERT INTO attachments (attachment_id, message_id, type, content, name) VALUES (?, ?, ?, ?, ?)", attachment_rows)
+        cursor.execute("UPDATE chats SET timestamp_updated = ? WHERE chat_id = ?", (timestamp, chat.chat_id))
+        chat.leaf_id = parent_id
+        result.append(chat)
+    conn.commit()
+    conn.close()
+    return result
+
+
+def time_operation(name: str, iterations: int, warmup: int, run: Callable[[int], Any]) -> Dict[str, Any]:
+    """Runs `run(i)` warmup + iterations times; returns millisecond stats for the timed runs."""
+    samples: List[float] = []
+    for i in range(warmup + iterations):
+        start = time.perf_counter()
+        run(i)
+        elapsed = (time.perf_counter() - start) * 1000
+        if i >= warmup:
+            samples.append(elapsed)
+    ordered = sorted(samples)
+    stats = {
+        "operation": name,
+        "iterations": len(samples),
+        "mean_ms": statistics.fmean(samples) if samples else None,
+        "p50_ms": ordered[len(ordered) // 2] if ordered else None,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+        "max_ms": ordered[-1] if ordered else None,
+    }
+    print(f"{name:<24} n={stats['iterations']:<5} mean {stats['mean_ms']:8.2f} ms  p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  max {stats['max_ms']:8.2f} ms")
+    return stats
+
+
+def run_benchmarks(chats: List[SyntheticChat], iterations: int, warmup: int, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    loop = asyncio.new_event_loop() # Endpoint coroutines are driven directly, without HTTP
+    picks = [rng.choice(chats) for _ in range(warmup + iterations)]
+    results = []
+
+    def build_context(i: int) -> None:
+        conn = api.get_db_connection()
+        try: api.build_context_from_db(conn, conn.cursor(), picks[i].chat_id, picks[i].leaf_id, "You are a benchmark.")
+        finally: conn.close()
+    results.append(time_operation("build_context_from_db", iterations, warmup, build_context))
+    results.append(time_operation("get_chat_messages", iterations, warmup, lambda i: api.get_chat_messages(picks[i].chat_id)))
+    results.append(time_operation("get_chats", iterations, warmup, lambda i: loop.run_until_complete(api.get_chats(offset=0, limit=50))))
+
+    def create(i: int) -> None:
+        chat = picks[i]
+        chat.leaf_id = api.create_message(chat.chat_id, api.MessageRole.USER, "benchmark follow-up message", parent_message_id=chat.leaf_id)
+    results.append(time_operation("create_message", iterations, warmup, create))
+
+    branchy = [chat for chat in chats if chat.branch_points]
+    if branchy:
+        def switch_branch(i: int) -> None:
+            chat = rng.choice(branchy)
+            parent_id, child_count = rng.choice(chat.branch_points)
+            loop.run_until_complete(api.set_active_branch(chat.chat_id, parent_id, api.SetActiveBranchRequest(child_index=rng.randrange(child_count))))
+        results.append(time_operation("set_active_branch", iterations, warmup, switch_branch))
+
+    deletable = list(chats)
+    rng.shuffle(deletable)
+    delete_runs = min(iterations, len(deletable) - warmup)
+    if delete_runs > 0:
+        results.append(time_operation("delete_chat", delete_runs, warmup, lambda i: loop.run_until_complete(api.delete_chat(deletable[i].chat_id))))
+    loop.close()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Storage micro-benchmarks on a synthetic branching-chat database")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=30, help="User turns per chat")
+    parser.add_argument("--branching", type=int, default=2, help="Assistant siblings (regenerations) per turn")
+    parser.add_argument("--attachment-kb", type=int, default=0, help="Attachment size; 0 disables attachments")
+    parser.add_argument("--attachment-every", type=int, default=5, help="Attach to every Nth user message")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--db", help="Database path (default: a temporary file, removed afterwards)")
+    parser.add_argument("--output", help="Write the results as JSON here")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="zeryo-bench-"), "bench.sqlite")
+    start = time.perf_counter()
+    chats = generate_database(db_path, args.chats, args.depth, args.branching, args.attachment_kb, args.attachment_every, args.seed)
+    size_mb = os.path.getsize(db_path) / (1024 * 1024)
+    print(f"Generated {args.chats} chats x {args.depth} turns x {args.branching} branches in {time.perf_counter() - start:.1f}s ({size_mb:.1f} MB at {db_path})")
+
+    results = run_benchmarks(chats, args.iterations, args.warmup, args.seed)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump({"config": vars(args), "db_size_mb": size_mb, "results": results}, handle, indent=2)
+    if not args.db:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix): os.remove(db_path + suffix)
+        os.rmdir(os.path.dirname(db_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# character_cache.py
+"""
+In-process cache of the characters table, shared by the character endpoints and generation.
+
+The whole table is loaded once, in the shape the /character endpoints return (settings
+parsed, flags as booleans). The character create/update/delete endpoints write
+through. After committing, each endpoint calls write_through() for the character it
+changed, and the cache re-reads that one row along with the new data version.
+
+The version is the 'characters' counter in the data_versions table. It is bumped in
+the same transaction as every character write, so other workers notice that the table
+changed within `check_interval` seconds and reload it. Serialized responses and their
+ETags are built on first request and reused until the next change.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from model_registry import CHARACTERS_DATA, read_data_version
+
+logger = logging.getLogger(__name__)
+
+CHARACTER_COLUMNS = """character_id, character_name, sysprompt, preferred_model, preferred_model_supports_images,
+    model_name, model_provider, model_identifier, model_supports_images, openrouter_providers, cot_start_tag, cot_end_tag, settings"""
+
+
+def character_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    try: settings = json.loads(row["settings"]) if row["settings"] else {}
+    except json.JSONDecodeError: settings = {}
+    return {
+        "character_id": row["character_id"],
+        "character_name": row["character_name"],
+        "sysprompt": row["sysprompt"],
+        "preferred_model": row["preferred_model"],
+        "preferred_model_supports_images": bool(row["preferred_model_supports_images"]),
+        "model_name": row["model_name"],
+        "model_provider": row["model_provider"],
+        "model_identifier": row["model_identifier"],
+        "model_supports_images": bool(row["model_supports_images"]) if row["model_supports_images"] is not None else None,
+        "openrouter_providers": row["openrouter_providers"],
+        "cot_start_tag": row["cot_start_tag"],
+        "cot_end_tag": row["cot_end_tag"],
+        "settings": settings
+    }
+
+
+def _serialize(value: Any) -> Tuple[bytes, str]:
+    body = json.dumps(value, ensure_ascii=False).encode("utf-8")
+    return body, f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+
+class CharacterCache:
+    def __init__(self, connect: Callable[[], sqlite3.Connection], check_interval: float = 1.0):
+        self.connect = connect
+        self.check_interval = check_interval
+        self.version: Optional[int] = None # data version of the cached table; None until loaded
+        self._characters: Dict[str, Dict[str, Any]] = {} # character_id -> character, in insertion (rowid) order
+        self._responses: Dict[str, Tuple[bytes, str]] = {} # character_id -> (JSON body, ETag)
+        self._list_response: Optional[Tuple[bytes, str]] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, connect: Callable[[], sqlite3.Connection]) -> "CharacterCache":
+        return cls(connect, float(os.environ.get("ZERYO_CACHE_CHECK_SECONDS", "1")))
+
+    def refresh(self) -> None:
+        """Reloads the table if another worker changed it (checked at most once per check_interval)."""
+        now = time.monotonic()
+        if self.version is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self.version is not None and now - self._checked_at < self.check_interval:
+                return
+            try:
+                conn = self.connect()
+                try:
+                    version = read_data_version(conn, CHARACTERS_DATA)
+                    if version != self.version:
+                        rows = conn.execute(f"SELECT {CHARACTER_COLUMNS} FROM characters ORDER BY rowid").fetchall()
+                        self._characters = {row["character_id"]: character_from_row(row) for row in rows}
+                        self._responses, self._list_response = {}, None
+                        self.version = version
+                        logger.debug("Character cache loaded: %s characters (version %s).", len(self._characters), version)
+                finally:
+                    conn.close()
+            except sqlite3.Error as exc:
+                logger.warning("Character cache refresh failed, serving the cached copy: %s", exc)
+            self._checked_at = now
+
+    def write_through(self, conn: sqlite3.Connection, character_id: str) -> None:
+        """Updates the cached copy of one character after its write has been committed on `conn`."""
+        row = conn.execute(f"SELECT {CHARACTER_COLUMNS} FROM characters WHERE character_id = ?", (character_id,)).fetchone()
+        version = read_data_version(conn, CHARACTERS_DATA)
+        with self._lock:
+            if self.version is None or version != self.version + 1:
+                self.version = None # Other writes happened in between; reload everything on next use
+                return
+            if row is None:
+                self._characters.pop(character_id, None)
+            else:
+                self._characters[character_id] = character_from_row(row)
+            self._responses.pop(character_id, None)
+            self._list_response = None
+            self.version = version
+
+    # --- Reads (returned dicts are shared; callers must not modify them) ---
+    def get(self, character_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not character_id:
+            return None
+        self.refresh()
+        return self._characters.get(character_id)
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Characters in insertion order."""
+        self.refresh()
+        return list(self._characters.values())
+
+    def list_response(self) -> Tuple[bytes, str]:
+        """JSON body and ETag for /characters (ordered by name)."""
+        self.refresh()
+        response = self._list_response
+        if response is None:
+            response = self._list_response = _serialize(sorted(self._characters.values(), key=lambda character: character["character_name"]))
+        return response
+
+    def response(self, character_id: str) -> Optional[Tuple[bytes, str]]:
+        """JSON body and ETag for /character/{id}, or None if there is no such character."""
+        character = self.get(character_id)
+        if character is None:
+            return None
+        response = self._responses.get(character_id)
+        if response is None:
+            response = self._responses[character_id] = _serialize(character)
+        return response
@@ -0,0 +1,55 @@
+# compression.py
+"""
+Content-Encoding negotiation and compression for response bodies built in memory.
+
+gzip is always available. br is offered when the optional `brotli` package is
+installed. Output is deterministic (no gzip timestamp), so a compressed variant can
+carry its own strong ETag.
+"""
+import gzip
+from typing import Dict, Iterable, Optional
+
+try:
+    import brotli # Optional: enables Content-Encoding: br
+except ImportError:
+    brotli = None
+
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",) # Server preference when the client rates them equally
+
+
+def compress(body: bytes, encoding: str, best: bool = False) -> bytes:
+    """best=True for bodies compressed once and served many times (static assets)."""
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=9 if best else 5, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(body, quality=11 if best else 5)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def accepted_encodings(header: Optional[str]) -> Dict[str, float]:
+    """Accept-Encoding as {coding: q}, e.g. 'gzip, br;q=0.8' -> {'gzip': 1.0, 'br': 0.8}."""
+    accepted: Dict[str, float] = {}
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try: q = float(value)
+                except ValueError: q = 0.0
+        accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def negotiate(header: Optional[str], available: Iterable[str] = ENCODINGS) -> Optional[str]:
+    """Best of `available` that the client accepts, or None for the uncompressed body."""
+    accepted = accepted_encodings(header)
+    wildcard = accepted.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in available: # In preference order, so ties keep the earlier one
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
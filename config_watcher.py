@@ -0,0 +1,224 @@
+# config_watcher.py
+"""
+Hot reload of the YAML config files (model_config.yaml, api_keys.yaml, search_api_keys.yaml).
+
+Every worker polls the watched files' mtime and size every ZERYO_CONFIG_POLL_SECONDS
+(default 2; 0 turns polling off). When a file changes, it is parsed and validated in
+a worker thread. Only a file that passes validation is handed to its apply callback,
+on the event loop, which swaps in the new config in one assignment. A file that fails
+validation is logged and the previous config stays in effect.
+
+A reload triggered through the API (POST /config/reload, POST /api_keys) bumps the
+'config' counter in data_versions. That publishes the event: each worker sees the
+counter change on its next poll and re-reads every file, even one whose mtime did not
+visibly change. Content identical to what is already applied is ignored, so a change
+noticed by both routes is applied once.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import yaml
+
+from model_registry import bump_data_version, read_data_version
+
+logger = logging.getLogger(__name__)
+
+CONFIG_DATA = "config"
+MAX_EVENTS = 20
+PROVIDERS = ("openrouter", "google", "local")
+
+
+# --- Validators (return a list of problems; empty means valid) ---
+def validate_model_config(data: Any) -> List[str]:
+    if not isinstance(data, dict):
+        return ["top level must be a mapping with a 'models' list"]
+    models = data.get("models")
+    if not isinstance(models, list):
+        return ["'models' must be a list"]
+    errors = []
+    for index, model in enumerate(models):
+        if not isinstance(model, dict):
+            errors.append(f"models[{index}]: must be a mapping")
+            continue
+        if not isinstance(model.get("name"), str) or not model["name"].strip():
+            errors.append(f"models[{index}]: 'name' is required")
+        if (model.get("provider") or "").lower() not in PROVIDERS:
+            errors.append(f"models[{index}] ({model.get('name')}): provider must be one of {', '.join(PROVIDERS)}")
+        if model.get("context_length") is not None and (not isinstance(model["context_length"], int) or model["context_length"] <= 0):
+            errors.append(f"models[{index}] ({model.get('name')}): context_length must be a positive integer")
+    return errors
+
+
+def validate_api_keys(data: Any) -> List[str]:
+    if not isinstance(data, dict):
+        return ["top level must be a mapping"]
+    errors = [f"{key}: must be a string" for key, value in data.items() if value is not None and not isinstance(value, str)]
+    errors.extend(
+        f"{key}: must be an http(s) URL" for key, value in data.items()
+        if key.endswith("_base_url") and isinstance(value, str) and not value.startswith(("http://", "https://"))
+    )
+    return errors
+
+
+def validate_search_keys(data: Any) -> List[str]:
+    if not isinstance(data, dict):
+        return ["top level must be a mapping"]
+    return [f"{key}: must be a string" for key, value in data.items() if value is not None and not isinstance(value, str)]
+
+
+class WatchedFile:
+    def __init__(self, name: str, path: str, validate: Callable[[Any], List[str]], apply: Callable[[Dict[str, Any]], None], required: bool):
+        self.name = name
+        self.path = path
+        self.validate = validate
+        self.apply = apply
+        self.required = required # A missing required file is rejected; a missing optional one applies as {}
+        self.signature: Optional[Tuple[int, int]] = None # (mtime_ns, size) of the last file read
+        self.applied: Optional[Dict[str, Any]] = None # Content currently in effect
+        self.loaded_at: Optional[float] = None
+
+
+def _signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+class ConfigWatcher:
+    def __init__(self, connect: Callable[[], sqlite3.Connection], poll_interval: float = 2.0):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.files: Dict[str, WatchedFile] = {}
+        self.version: Optional[int] = None # Last 'config' data version seen
+        self.events: List[Dict[str, Any]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, connect: Callable[[], sqlite3.Connection]) -> "ConfigWatcher":
+        return cls(connect, float(os.environ.get("ZERYO_CONFIG_POLL_SECONDS", "2")))
+
+    def watch(self, name: str, path: str, current: Dict[str, Any], validate: Callable[[Any], List[str]], apply: Callable[[Dict[str, Any]], None], required: bool = True) -> None:
+        """Registers a file whose contents (`current`) were already loaded at startup."""
+        watched = WatchedFile(name, path, validate, apply, required)
+        watched.signature, watched.applied, watched.loaded_at = _signature(path), current, time.time()
+        self.files[name] = watched
+
+    # --- Reading (worker thread) ---
+    def _read(self, watched: WatchedFile) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+        if not os.path.exists(watched.path):
+            return ({}, []) if not watched.required else (None, ["file not found"])
+        try:
+            with open(watched.path, "r", encoding="utf-8") as handle:
+                data = yaml.safe_load(handle)
+        except (OSError, yaml.YAMLError) as exc:
+            return None, [f"could not parse: {exc}"]
+        data = {} if data is None else data
+        errors = watched.validate(data)
+        return (None, errors) if errors else (data, [])
+
+    def _scan(self, force: bool) -> Tuple[Optional[int], List[Tuple[WatchedFile, Optional[Dict[str, Any]], List[str]]]]:
+        """Reads the published version and every file that changed (all of them if forced or the version moved)."""
+        version = None
+        try:
+            conn = self.connect()
+            try: version = read_data_version(conn, CONFIG_DATA)
+            finally: conn.close()
+        except sqlite3.Error as exc:
+            logger.warning("Could not read the config version: %s", exc)
+        force = force or (version is not None and self.version is not None and version != self.version)
+        results = []
+        for watched in self.files.values():
+            signature = _signature(watched.path)
+            if force or signature != watched.signature:
+                watched.signature = signature
+                results.append((watched, *self._read(watched)))
+        return version, results
+
+    # --- Applying (event loop) ---
+    def _apply(self, results: List[Tuple[WatchedFile, Optional[Dict[str, Any]], List[str]]], reason: str) -> List[Dict[str, Any]]:
+        events = []
+        for watched, data, errors in results:
+            if data is not None and data == watched.applied:
+                continue
+            event = {"at": time.time(), "file": watched.name, "path": watched.path, "reason": reason, "worker": os.getpid()}
+            if errors:
+                event.update(outcome="rejected", errors=errors)
+                logger.error("Not reloading %s (%s); keeping the previous config: %s", watched.path, reason, "; ".join(errors))
+            else:
+                try:
+                    watched.apply(data)
+                    watched.applied, watched.loaded_at = data, time.time()
+                    event["outcome"] = "applied"
+                    logger.info("Reloaded %s (%s).", watched.path, reason)
+                except Exception as exc:
+                    event.update(outcome="failed", errors=[str(exc)])
+                    logger.exception("Applying %s failed; keeping the previous config", watched.path)
+            events.append(event)
+        self.events.extend(events)
+        del self.events[:-MAX_EVENTS]
+        return events
+
+    async def reload(self, publish: bool = True, reason: str = "requested") -> List[Dict[str, Any]]:
+        """Re-reads every watched file now; with publish, also tells the other workers to reload."""
+        version, results = await asyncio.to_thread(self._scan, True)
+        events = self._apply(results, reason)
+        if publish:
+            try: self.version = await asyncio.to_thread(self._publish)
+            except sqlite3.Error as exc: logger.warning("Could not publish the config reload: %s", exc)
+        elif version is not None:
+            self.version = version
+        return events
+
+    def _publish(self) -> int:
+        conn = self.connect()
+        try:
+            bump_data_version(conn, CONFIG_DATA)
+            conn.commit()
+            return read_data_version(conn, CONFIG_DATA)
+        finally:
+            conn.close()
+
+    async def _poll_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                previous = self.version
+                version, results = await asyncio.to_thread(self._scan, False)
+                if results:
+                    self._apply(results, "published by another worker" if version != previous and previous is not None else "file changed")
+                if version is not None:
+                    self.version = version
+            except Exception:
+                logger.exception("Config poll failed")
+
+    def start(self) -> None:
+        if self.poll_interval <= 0 or (self._task is not None and not self._task.done()):
+            return
+        try:
+            conn = self.connect()
+            try: self.version = read_data_version(conn, CONFIG_DATA)
+            finally: conn.close()
+        except sqlite3.Error as exc:
+            logger.warning("Could not read the config version: %s", exc)
+        self._task = asyncio.get_running_loop().create_task(self._poll_loop(), name="config-watcher")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "poll_interval_seconds": self.poll_interval,
+            "version": self.version,
+            "files": {name: {"path": watched.path, "loaded_at": watched.loaded_at} for name, watched in self.files.items()},
+            "recent_events": list(reversed(self.events)),
+        }
@@ -0,0 +1,137 @@
+# generation_registry.py
+"""
+Cross-process registry of running generations, stored in the chat database.
+
+Each uvicorn worker owns the generations it streams. Every heartbeat interval, a
+worker refreshes `heartbeat_at` on its rows and picks up any abort flags that other
+workers set. This lets the "already running" check and /abort_generation work no
+matter which worker receives the request. A row whose heartbeat is older than
+`stale_after` belongs to a dead or wedged worker, and the next claim for that chat
+reclaims it.
+
+The active_generations table is created by api.init_db().
+"""
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationRegistry:
+    def __init__(self, connect: Callable[[], sqlite3.Connection], heartbeat_interval: float = 1.0, stale_after: float = 15.0):
+        self.connect = connect
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local: Dict[str, Tuple[str, asyncio.Event]] = {} # chat_id -> (generation_id, abort event)
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, connect: Callable[[], sqlite3.Connection]) -> "GenerationRegistry":
+        return cls(connect, float(os.environ.get("ZERYO_GENERATION_HEARTBEAT_SECONDS", "1")), float(os.environ.get("ZERYO_GENERATION_STALE_SECONDS", "15")))
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        conn = self.connect()
+        try:
+            cursor = conn.execute(sql, params)
+            conn.commit()
+            return cursor
+        finally:
+            conn.close()
+
+    # --- Ownership ---
+    def claim(self, chat_id: str) -> Optional[asyncio.Event]:
+        """Registers a generation for chat_id owned by this worker. Returns its abort event, or None if another live generation holds the chat."""
+        generation_id = str(uuid.uuid4())
+        now = time.time()
+        # One statement, so two workers racing for the same chat cannot both win; a stale row is taken over
+        cursor = self._execute(
+            """INSERT INTO active_generations (chat_id, generation_id, owner, started_at, heartbeat_at, abort_requested)
+               VALUES (?, ?, ?, ?, ?, 0)
+               ON CONFLICT (chat_id) DO UPDATE SET generation_id = excluded.generation_id, owner = excluded.owner,
+                   started_at = excluded.started_at, heartbeat_at = excluded.heartbeat_at, abort_requested = 0
+               WHERE active_generations.heartbeat_at < ?""",
+            (chat_id, generation_id, self.owner, now, now, now - self.stale_after)
+        )
+        if cursor.rowcount == 0:
+            return None
+        abort_event = asyncio.Event()
+        self._local[chat_id] = (generation_id, abort_event)
+        return abort_event
+
+    def release(self, chat_id: str, abort_event: Optional[asyncio.Event] = None) -> None:
+        """Removes this worker's registration for chat_id (called when its stream ends); with abort_event, only if it is still that generation's."""
+        entry = self._local.get(chat_id)
+        if entry is None or (abort_event is not None and entry[1] is not abort_event):
+            return
+        del self._local[chat_id]
+        try: self._execute("DELETE FROM active_generations WHERE chat_id = ? AND generation_id = ?", (chat_id, entry[0]))
+        except sqlite3.Error as exc: logger.warning("Could not release generation for chat %s: %s", chat_id, exc)
+
+    def request_abort(self, chat_id: str) -> bool:
+        """Flags the chat's generation for abort on whichever worker owns it. Returns False if none is running."""
+        local = self._local.get(chat_id)
+        if local:
+            local[1].set() # Owned here: abort immediately instead of waiting for the next heartbeat
+        cursor = self._execute("UPDATE active_generations SET abort_requested = 1 WHERE chat_id = ? AND heartbeat_at >= ?", (chat_id, time.time() - self.stale_after))
+        return bool(local) or cursor.rowcount > 0
+
+    def active(self) -> List[Dict[str, Any]]:
+        """All live registrations across workers."""
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT * FROM active_generations WHERE heartbeat_at >= ? ORDER BY started_at", (time.time() - self.stale_after,)).fetchall()
+            return [dict(row) for row in rows]
+        finally:
+            conn.close()
+
+    # --- Heartbeat ---
+    def _beat(self) -> List[str]:
+        """Refreshes this worker's rows and returns chats whose generation was flagged for abort elsewhere."""
+        conn = self.connect()
+        try:
+            conn.execute("UPDATE active_generations SET heartbeat_at = ? WHERE owner = ?", (time.time(), self.owner))
+            conn.execute("DELETE FROM active_generations WHERE heartbeat_at < ?", (time.time() - self.stale_after,)) # Reclaim dead workers' rows
+            aborted = [row[0] for row in conn.execute("SELECT chat_id FROM active_generations WHERE owner = ? AND abort_requested = 1", (self.owner,))]
+            conn.commit()
+            return aborted
+        finally:
+            conn.close()
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self._local:
+                continue
+            try:
+                aborted = await asyncio.to_thread(self._beat)
+            except sqlite3.Error as exc:
+                logger.warning("Generation heartbeat failed: %s", exc)
+                continue
+            for chat_id in aborted:
+                local = self._local.get(chat_id)
+                if local and not local[1].is_set():
+                    logger.info("Abort for chat %s requested via another worker.", chat_id)
+                    local[1].set()
+
+    def start(self) -> None:
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat_loop(), name="generation-heartbeat")
+
+    async def stop(self) -> None:
+        """Signals local generations to stop and drops their registrations."""
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            try: await self._heartbeat_task
+            except asyncio.CancelledError: pass
+            self._heartbeat_task = None
+        for chat_id in list(self._local):
+            logger.info("Cancelling generation task for chat %s on shutdown.", chat_id)
+            self._local[chat_id][1].set()
+            self.release(chat_id)
@@ -0,0 +1,190 @@
+# loadgen.py
+"""
+Load generator for /c/{chat_id}/generate.
+
+Drives N concurrent chats against a running API (typically with the `local` provider
+pointed at mock_llm.py) and reports time to first token, inter-token latency,
+throughput and error rate. Results are written as JSON and can be compared against
+a previous run.
+
+    python mock_llm.py --tokens-per-sec 100 --latency-ms 100 &
+    python api.py &
+    python loadgen.py --model local --concurrency 16 --turns 4 --output results.json
+    python loadgen.py --model local --concurrency 16 --turns 4 --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values) if values else None,
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+async def run_generation(client: httpx.AsyncClient, chat_id: str, parent_id: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Streams one generation and returns its timings (seconds) and outcome."""
+    body = {"parent_message_id": parent_id, "model_name": args.model, "tools_enabled": args.tools, "generation_args": {}}
+    if args.max_tokens: body["generation_args"]["max_tokens"] = args.max_tokens
+    result: Dict[str, Any] = {"ok": False, "ttft": None, "inter_token": [], "tokens": 0, "chars": 0, "duration": None, "error": None}
+    started = time.perf_counter()
+    last_token_at = None
+    try:
+        async with client.stream("POST", f"/c/{chat_id}/generate", json=body) as response:
+            if response.status_code != 200:
+                result["error"] = f"HTTP {response.status_code}"
+                return result
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[5:])
+                event_type = event.get("type")
+                if event_type in ("chunk", "thinking_chunk"):
+                    now = time.perf_counter()
+                    if last_token_at is None:
+                        result["ttft"] = now - started
+                    else:
+                        result["inter_token"].append(now - last_token_at)
+                    last_token_at = now
+                    result["tokens"] += 1
+                    result["chars"] += len(event.get("data") or "")
+                elif event_type == "error":
+                    result["error"] = event.get("message") or "error event"
+                elif event_type == "done":
+                    result["ok"] = result["error"] is None
+    except httpx.HTTPError as exc:
+        result["error"] = f"{type(exc).__name__}: {exc}"
+    finally:
+        result["duration"] = time.perf_counter() - started
+    if not result["ok"] and result["error"] is None:
+        result["error"] = "stream ended without 'done'"
+    return result
+
+
+async def run_chat(client: httpx.AsyncClient, worker: int, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    try:
+        response = await client.post("/c/new_chat", json={"character_id": args.character_id})
+        response.raise_for_status()
+        chat_id = response.json()["chat_id"]
+    except httpx.HTTPError as exc:
+        return [{"ok": False, "error": f"new_chat failed: {exc}", "ttft": None, "inter_token": [], "tokens": 0, "chars": 0, "duration": None}]
+    parent_id = None
+    for turn in range(args.turns):
+        response = await client.post(f"/c/{chat_id}/add_message", json={"role": "user", "message": f"{args.prompt} (worker {worker}, turn {turn})", "parent_message_id": parent_id})
+        parent_id = response.json()["message_id"]
+        result = await run_generation(client, chat_id, parent_id, args)
+        results.append(result)
+        if not result["ok"]:
+            break
+        chat = (await client.get(f"/c/{chat_id}")).json()
+        parent_id = chat["messages"][-1]["message_id"] if chat.get("messages") else parent_id
+    if not args.keep_chats:
+        await client.delete(f"/c/{chat_id}")
+    return results
+
+
+async def run_load(args: argparse.Namespace) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        per_chat = await asyncio.gather(*(run_chat(client, worker, args) for worker in range(args.concurrency)))
+        wall = time.perf_counter() - started
+    generations = [result for chat in per_chat for result in chat]
+    ok = [result for result in generations if result["ok"]]
+    errors: Dict[str, int] = {}
+    for result in generations:
+        if result["error"]:
+            errors[result["error"][:120]] = errors.get(result["error"][:120], 0) + 1
+    total_tokens = sum(result["tokens"] for result in ok)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "wall_seconds": wall,
+        "generations": len(generations),
+        "errors": len(generations) - len(ok),
+        "error_rate": (len(generations) - len(ok)) / len(generations) if generations else 0.0,
+        "error_samples": errors,
+        "ttft_seconds": summarize([result["ttft"] for result in ok if result["ttft"] is not None]),
+        "inter_token_seconds": summarize([gap for result in ok for gap in result["inter_token"]]),
+        "generation_seconds": summarize([result["duration"] for result in ok]),
+        "throughput": {
+            "generations_per_second": len(ok) / wall if wall else None,
+            "token_events_per_second": total_tokens / wall if wall else None,
+            "chars_per_second": sum(result["chars"] for result in ok) / wall if wall else None,
+        },
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    def fmt(value: Optional[float], scale: float = 1000, unit: str = "ms") -> str:
+        return "n/a" if value is None else f"{value * scale:.1f}{unit}"
+
+    def delta(section: str, key: str) -> str:
+        if not baseline:
+            return ""
+        old, new = (baseline.get(section) or {}).get(key), report[section].get(key)
+        if not old or new is None:
+            return ""
+        return f" ({(new - old) / old * 100:+.1f}%)"
+
+    print(f"Generations: {report['generations']}  errors: {report['errors']} ({report['error_rate'] * 100:.1f}%)  wall: {report['wall_seconds']:.1f}s")
+    for section, label in (("ttft_seconds", "TTFT"), ("inter_token_seconds", "Inter-token"), ("generation_seconds", "Generation")):
+        stats = report[section]
+        print(f"{label:<12} p50 {fmt(stats['p50'])}{delta(section, 'p50')}  p90 {fmt(stats['p90'])}{delta(section, 'p90')}  p99 {fmt(stats['p99'])}{delta(section, 'p99')}")
+    throughput = report["throughput"]
+    print(f"Throughput   {fmt(throughput['generations_per_second'], 1, ' gen/s')}  {fmt(throughput['token_events_per_second'], 1, ' tok/s')}{delta('throughput', 'token_events_per_second')}")
+    for message, count in report["error_samples"].items():
+        print(f"  {count}x {message}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent chat load generator for the Zeryo API")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--model", default="local", help="model_name sent to /generate")
+    parser.add_argument("--character-id", help="Character for the new chats")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of chats driven in parallel")
+    parser.add_argument("--turns", type=int, default=3, help="User turns (generations) per chat")
+    parser.add_argument("--prompt", default="Tell me something interesting.")
+    parser.add_argument("--max-tokens", type=int)
+    parser.add_argument("--tools", action="store_true", help="Send tools_enabled=true")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--keep-chats", action="store_true", help="Do not delete the chats afterwards")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--baseline", help="Previous JSON report to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as handle:
+            baseline = json.load(handle)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# local_models.py
+"""
+Background discovery of the models served by the local runtime (llama.cpp, Ollama, or
+any OpenAI-compatible server at local_base_url).
+
+A poller fetches `{local_base_url}/v1/models` every ZERYO_LOCAL_MODELS_POLL_SECONDS
+(default 30) and caches the model list together with the endpoint's health. Readers get
+the cached snapshot and never wait on the network. A snapshot older than
+ZERYO_LOCAL_MODELS_TTL_SECONDS (default 120), or one taken for a different base URL,
+counts as stale: readers then get nothing and a refresh starts in the background.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+from provider_clients import ProviderClientPool
+
+logger = logging.getLogger(__name__)
+
+PROBE_TIMEOUT = 2.0
+
+
+def parse_model_list(data: Any) -> List[Dict[str, Any]]:
+    """Model entries from an OpenAI-style {"data": [...]} or llama.cpp/Ollama-style {"models": [...]} listing."""
+    models = []
+    if isinstance(data, dict):
+        for entry in data.get("data") or []:
+            if isinstance(entry, dict) and entry.get("id"):
+                models.append({"id": entry["id"], "owned_by": entry.get("owned_by"), "meta": entry.get("meta")})
+        if not models:
+            for entry in data.get("models") or []:
+                name = isinstance(entry, dict) and (entry.get("name") or entry.get("model"))
+                if name:
+                    models.append({"id": name, "owned_by": None, "meta": entry.get("details")})
+    return models
+
+
+class LocalModelDiscovery:
+    def __init__(self, clients: ProviderClientPool, settings: Callable[[], Dict[str, Any]], poll_interval: float = 30.0, ttl: float = 120.0):
+        self.clients = clients
+        self.settings = settings # Returns the current api_keys config (local_base_url, local_api_key)
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.snapshot: Dict[str, Any] = {"base_url": None, "healthy": None, "models": [], "error": None, "checked_at": None, "latency_ms": None}
+        self._task: Optional[asyncio.Task] = None
+        self._refreshing: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, clients: ProviderClientPool, settings: Callable[[], Dict[str, Any]]) -> "LocalModelDiscovery":
+        return cls(clients, settings, float(os.environ.get("ZERYO_LOCAL_MODELS_POLL_SECONDS", "30")), float(os.environ.get("ZERYO_LOCAL_MODELS_TTL_SECONDS", "120")))
+
+    def _base_url(self) -> str:
+        return ((self.settings() or {}).get("local_base_url") or "http://127.0.0.1:8080").rstrip("/")
+
+    async def _probe(self) -> Dict[str, Any]:
+        base_url = self._base_url()
+        api_key = (self.settings() or {}).get("local_api_key")
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        started = time.perf_counter()
+        snapshot = {"base_url": base_url, "healthy": False, "models": [], "error": None, "checked_at": time.time(), "latency_ms": None}
+        try:
+            async with self.clients.client() as client:
+                response = await client.get(f"{base_url}/v1/models", headers=headers, timeout=PROBE_TIMEOUT)
+            snapshot["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            if response.status_code != 200:
+                snapshot["error"] = f"HTTP {response.status_code}"
+            else:
+                snapshot["models"] = parse_model_list(response.json())
+                snapshot["healthy"] = True
+        except (httpx.HTTPError, ValueError) as exc:
+            snapshot["error"] = f"{type(exc).__name__}: {exc}"
+        if snapshot["healthy"] != self.snapshot.get("healthy"):
+            log = logger.info if snapshot["healthy"] else logger.warning
+            log("Local runtime at %s is %s%s", base_url, "up" if snapshot["healthy"] else "unreachable", f" ({snapshot['error']})" if snapshot["error"] else f", serving {[model['id'] for model in snapshot['models']]}")
+        return snapshot
+
+    async def refresh(self) -> Dict[str, Any]:
+        """Probes the runtime now (joining a probe already in flight) and returns the new snapshot."""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.get_running_loop().create_task(self._probe(), name="local-models-probe")
+        self.snapshot = await asyncio.shield(self._refreshing)
+        return self.snapshot
+
+    def _refresh_in_background(self) -> None:
+        if self._refreshing is None or self._refreshing.done():
+            asyncio.get_running_loop().create_task(self.refresh())
+
+    def fresh(self) -> bool:
+        checked_at = self.snapshot.get("checked_at")
+        return checked_at is not None and time.time() - checked_at < self.ttl and self.snapshot.get("base_url") == self._base_url()
+
+    def runtime_model_name(self) -> Optional[str]:
+        """First model the local runtime reports, from the cache; None (and a background refresh) if unknown or stale."""
+        if not self.fresh():
+            self._refresh_in_background()
+            return None
+        models = self.snapshot.get("models") or []
+        return models[0]["id"] if models else None
+
+    def serves(self, model_name: Optional[str]) -> bool:
+        """True if the last snapshot listed model_name (a runtime name resolved earlier)."""
+        return bool(model_name) and any(model["id"] == model_name for model in self.snapshot.get("models") or [])
+
+    def status(self) -> Dict[str, Any]:
+        checked_at = self.snapshot.get("checked_at")
+        return {**self.snapshot, "age_seconds": round(time.time() - checked_at, 1) if checked_at else None, "stale": not self.fresh(), "poll_interval_seconds": self.poll_interval}
+
+    def invalidate(self) -> None:
+        """Called when local_base_url may have changed; probes again right away."""
+        self.snapshot = {**self.snapshot, "checked_at": None}
+        self._refresh_in_background()
+
+    async def _poll_loop(self) -> None:
+        while True:
+            try: await self.refresh()
+            except Exception: logger.exception("Local model discovery failed")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self) -> None:
+        if self.poll_interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._poll_loop(), name="local-models")
+
+    async def stop(self) -> None:
+        for task in (self._task, self._refreshing):
+            if task and not task.done():
+                task.cancel()
+                try: await task
+                except asyncio.CancelledError: pass
+        self._task = self._refreshing = None
@@ -0,0 +1,115 @@
+# logging_setup.py
+"""
+Logging configuration shared by api.py and tools.py.
+
+Records are handed to a QueueHandler, and a QueueListener thread does the actual
+stdout I/O, so logging from the event loop (e.g. inside the generation stream)
+never blocks on a terminal or pipe.
+
+Environment variables:
+  ZERYO_LOG_LEVEL   Default level for all modules (default: INFO)
+  ZERYO_LOG_LEVELS  Per-module overrides, e.g. "api=DEBUG,tools=WARNING"
+  ZERYO_LOG_FORMAT  "text" (default) or "json"
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Any, Dict, Optional
+
+# Structured fields attached via `extra=` (or ContextLogger) and rendered by the formatters
+STRUCTURED_FIELDS = ("chat_id", "generation_id", "provider", "model", "phase")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class StructuredTextFormatter(logging.Formatter):
+    """Renders `time LEVEL logger: message key=value ...` with any structured fields present."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"{self.formatTime(record, '%H:%M:%S')}.{int(record.msecs):03d} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        fields = " ".join(f"{name}={getattr(record, name)}" for name in STRUCTURED_FIELDS if getattr(record, name, None) is not None)
+        if fields:
+            line = f"{line} [{fields}]"
+        if record.exc_info:
+            line = f"{line}\n{self.formatException(record.exc_info)}"
+        return line
+
+
+class StructuredJsonFormatter(logging.Formatter):
+    """Renders one JSON object per line, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for name in STRUCTURED_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                payload[name] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+class ContextLogger(logging.LoggerAdapter):
+    """
+    LoggerAdapter carrying bound structured fields (chat_id, generation_id, ...).
+    Unlike the stdlib adapter, per-call `extra` is merged with the bound fields.
+    """
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **(kwargs.get("extra") or {})}
+        return msg, kwargs
+
+    def bind(self, **fields: Any) -> "ContextLogger":
+        return ContextLogger(self.logger, {**self.extra, **fields})
+
+
+def _parse_levels(spec: str) -> Dict[str, int]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+def configure_logging() -> None:
+    """Installs the queue-based handler on the root logger. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter: logging.Formatter = StructuredJsonFormatter() if os.environ.get("ZERYO_LOG_FORMAT", "text").lower() == "json" else StructuredTextFormatter()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.getLevelName(os.environ.get("ZERYO_LOG_LEVEL", "INFO").upper()))
+    for name, level in _parse_levels(os.environ.get("ZERYO_LOG_LEVELS", "")).items():
+        logging.getLogger(name).setLevel(level)
+    # Third-party clients log every request at INFO; keep them quiet unless asked for
+    for noisy in ("httpx", "httpcore"):
+        if noisy not in os.environ.get("ZERYO_LOG_LEVELS", ""):
+            logging.getLogger(noisy).setLevel(logging.WARNING)
+
+
+def shutdown_logging() -> None:
+    """Flushes queued records and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,188 @@
+# loop_monitor.py
+"""
+Event loop stall detector.
+
+A heartbeat coroutine sleeps for ZERYO_LOOP_INTERVAL_MS and records how late it woke
+up as loop lag. A watchdog thread watches the heartbeat. When the loop is more than
+ZERYO_LOOP_LAG_THRESHOLD_MS overdue, the thread captures the loop thread's stack
+*while it is still blocked*, along with the asyncio task that is running. When the
+heartbeat resumes, the stall is attributed to the innermost frame from this project,
+for example a sync sqlite call in api.py. The stall is then folded into a table of
+worst offenders.
+
+Set ZERYO_LOOP_MONITOR=0 to disable it.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from metrics import LOOP_LAG_SECONDS, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+MAX_OFFENDERS = 100
+MAX_RECENT_STALLS = 50
+
+
+def _is_project_file(filename: str) -> bool:
+    return filename.startswith(PROJECT_DIR) and "site-packages" not in filename and filename != __file__
+
+
+def _describe_stack(frame) -> List[str]:
+    """Innermost-last stack, like a traceback."""
+    lines = []
+    while frame is not None:
+        code = frame.f_code
+        lines.append(f"{code.co_filename}:{frame.f_lineno} in {code.co_name}")
+        frame = frame.f_back
+    return list(reversed(lines))
+
+
+def _blocking_site(frame) -> str:
+    """Innermost project frame of the stack (falls back to the innermost frame)."""
+    innermost = None
+    while frame is not None:
+        code = frame.f_code
+        label = f"{os.path.basename(code.co_filename)}:{frame.f_lineno} in {code.co_name}"
+        innermost = innermost or label
+        if _is_project_file(code.co_filename):
+            return label
+        frame = frame.f_back
+    return innermost or "unknown"
+
+
+def _task_name(task: Optional[asyncio.Task]) -> Optional[str]:
+    if task is None:
+        return None
+    coro = task.get_coro()
+    return f"{task.get_name()} ({getattr(coro, '__qualname__', type(coro).__name__)})"
+
+
+class LoopMonitor:
+    def __init__(self, interval_ms: float = 50, threshold_ms: float = 100):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._tick = 0
+        self._tick_due = 0.0 # perf_counter() when the current sleep should end
+        self._pending: Optional[Dict[str, Any]] = None # Stack captured during the current stall
+        self._max_lag = 0.0
+        self._stall_count = 0
+        self.offenders: Dict[str, Dict[str, Any]] = {}
+        self.recent: List[Dict[str, Any]] = []
+
+    @classmethod
+    def from_env(cls) -> "LoopMonitor":
+        return cls(float(os.environ.get("ZERYO_LOOP_INTERVAL_MS", "50")), float(os.environ.get("ZERYO_LOOP_LAG_THRESHOLD_MS", "100")))
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """Starts the heartbeat on the running loop and the watchdog thread."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._tick_due = time.perf_counter() + self.interval
+        self._task = self._loop.create_task(self._heartbeat(), name="loop-monitor")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-monitor-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+        self._task = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - self._tick_due)
+            with self._lock: # Tick and due time change together so the watchdog never pairs a new tick with an old deadline
+                pending, self._pending = self._pending, None
+                self._tick += 1
+                self._tick_due = now + self.interval
+            LOOP_LAG_SECONDS.observe(lag)
+            self._max_lag = max(self._max_lag, lag)
+            if lag >= self.threshold:
+                self._record_stall(lag, pending)
+
+    def _watch(self) -> None:
+        captured_tick = -1
+        poll = min(self.interval, self.threshold) / 2
+        while not self._stop.wait(poll):
+            with self._lock:
+                tick, overdue = self._tick, time.perf_counter() - self._tick_due
+            if overdue < self.threshold or captured_tick == tick:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            try: task = asyncio.tasks._current_tasks.get(self._loop) # Read-only peek from another thread
+            except AttributeError: task = None
+            capture = {"site": _blocking_site(frame), "stack": _describe_stack(frame), "task": _task_name(task), "overdue_ms": round(overdue * 1000, 1)}
+            with self._lock:
+                if self._tick != tick:
+                    continue # The loop unblocked while the stack was being read
+                captured_tick = tick
+                self._pending = capture
+
+    def _record_stall(self, lag: float, capture: Optional[Dict[str, Any]]) -> None:
+        LOOP_STALLS.inc()
+        lag_ms = round(lag * 1000, 1)
+        # Without a capture the loop unblocked before the watchdog polled; only the lag is known
+        site = capture["site"] if capture else "unattributed"
+        stall = {"at": time.time(), "lag_ms": lag_ms, "site": site, "task": capture["task"] if capture else None}
+        logger.warning("Event loop blocked for %.0f ms at %s (task %s)", lag_ms, site, stall["task"])
+        with self._lock:
+            self._stall_count += 1
+            self.recent.append(stall)
+            del self.recent[:-MAX_RECENT_STALLS]
+            entry = self.offenders.get(site)
+            if entry is None:
+                if len(self.offenders) >= MAX_OFFENDERS:
+                    del self.offenders[min(self.offenders, key=lambda key: self.offenders[key]["total_ms"])]
+                entry = self.offenders[site] = {"site": site, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "task": None, "stack": None}
+            entry["count"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + lag_ms, 1)
+            entry["last_at"] = stall["at"]
+            if lag_ms >= entry["max_ms"]:
+                entry["max_ms"] = lag_ms
+                if capture:
+                    entry["task"], entry["stack"] = capture["task"], capture["stack"]
+
+    def report(self, top: int = 20) -> Dict[str, Any]:
+        lag = LOOP_LAG_SECONDS.snapshot()
+        with self._lock:
+            offenders = sorted(self.offenders.values(), key=lambda entry: entry["total_ms"], reverse=True)[:top]
+            recent = list(reversed(self.recent))
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag": {
+                "histogram_seconds": lag["buckets"],
+                "count": lag["count"],
+                "mean_ms": round(lag["sum"] / lag["count"] * 1000, 2) if lag["count"] else None,
+                "max_ms": round(self._max_lag * 1000, 1),
+            },
+            "stalls": self._stall_count,
+            "offenders": offenders,
+            "recent_stalls": recent,
+        }
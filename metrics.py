@@ -0,0 +1,220 @@
+# metrics.py
+"""
+Minimal in-process metrics registry rendered in the Prometheus text exposition format.
+
+Recording is a dict lookup plus a bucket bisect under a per-metric lock; nothing is
+formatted until /metrics is scraped. Metrics are per process, so with several uvicorn
+workers each worker reports its own series.
+"""
+import bisect
+import threading
+import time
+from contextlib import ContextDecorator
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_REGISTRY: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram: "Histogram", labels: Dict[str, str]):
+        self._histogram = histogram
+        self._labels = labels
+
+    def _recreate_cm(self):
+        return _Timer(self._histogram, self._labels) # Fresh start time per decorated call
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+        return False
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts (last slot is +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels: str) -> _Timer:
+        """Context manager / decorator observing the wall time of the wrapped block."""
+        return _Timer(self, labels)
+
+    def snapshot(self, **labels: str) -> Dict[str, object]:
+        """Cumulative bucket counts, sum and count of one series, for JSON endpoints."""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            counts, total, count = (list(series[0]), series[1], series[2]) if series else ([0] * (len(self.buckets) + 1), 0.0, 0)
+        buckets, cumulative = {}, 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            buckets[_format_value(float(bound))] = cumulative
+        return {"buckets": buckets, "sum": total, "count": count}
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(series[0]), series[1], series[2]) for key, series in self._series.items()]
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(float(bound))))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    """Renders every registered metric in the Prometheus text format (version 0.0.4)."""
+    lines: List[str] = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Application metrics ---
+HTTP_REQUESTS = Counter("zeryo_http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status"))
+HTTP_REQUEST_SECONDS = Histogram("zeryo_http_request_duration_seconds", "HTTP request duration until the response body completes.", ("method", "route"))
+
+GENERATIONS_ACTIVE = Gauge("zeryo_generations_active", "Generation streams currently running in this process.")
+GENERATIONS_ACTIVE.set(0)
+GENERATION_SECONDS = Histogram("zeryo_generation_duration_seconds", "Total generation stream duration, including tool calls.", ("provider", "model"))
+GENERATION_ERRORS = Counter("zeryo_generation_errors_total", "Generations that ended with an error.", ("provider", "model", "kind"))
+LLM_REQUESTS = Counter("zeryo_llm_requests_total", "Upstream LLM calls by outcome (ok, error, aborted).", ("provider", "model", "outcome"))
+LLM_TTFT_SECONDS = Histogram("zeryo_llm_time_to_first_token_seconds", "Time from sending an LLM request to the first content or reasoning token.", ("provider", "model"))
+LLM_TOKENS_PER_SECOND = Histogram("zeryo_llm_tokens_per_second", "Output tokens per second after the first token.", ("provider", "model"), buckets=RATE_BUCKETS)
+LLM_OUTPUT_TOKENS = Counter("zeryo_llm_output_tokens_total", "Output tokens from LLM calls (provider-reported, else a ~4 chars/token estimate).", ("provider", "model"))
+
+DB_OPERATION_SECONDS = Histogram("zeryo_db_operation_duration_seconds", "Duration of instrumented database operations.", ("operation",))
+
+TOOL_CALLS = Counter("zeryo_tool_calls_total", "Tool invocations by outcome (ok, error, invalid, timeout, cached).", ("tool", "outcome"))
+TOOL_SECONDS = Histogram("zeryo_tool_duration_seconds", "Tool execution duration.", ("tool",))
+
+LOOP_LAG_SECONDS = Histogram("zeryo_event_loop_lag_seconds", "How late the event loop monitor's periodic wake-ups ran.", buckets=LAG_BUCKETS)
+LOOP_STALLS = Counter("zeryo_event_loop_stalls_total", "Event loop stalls longer than the monitor threshold.")
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts and durations per route template (streams are timed to completion)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = {"code": 500}
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            if recorded:
+                return
+            recorded = True
+            route = getattr(scope.get("route"), "path", None) or "static"
+            HTTP_REQUESTS.inc(method=scope["method"], route=route, status=str(status["code"]))
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=scope["method"], route=route)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                record()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            record()
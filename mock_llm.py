@@ -0,0 +1,198 @@
+# mock_llm.py
+"""
+Mock streaming LLM server for load testing, speaking both the OpenAI-compatible and
+the Google Generative Language streaming protocols.
+
+Point the `local` provider at it (api_keys.yaml: local_base_url: http://127.0.0.1:8080)
+or Google at it (google_base_url: http://127.0.0.1:8080) and every generation is
+served from scripted replies at a controlled pace instead of a real model.
+
+    python mock_llm.py --port 8080 --tokens-per-sec 50 --latency-ms 300 --reasoning-tokens 20
+
+A script file is a JSON list of replies, used in rotation:
+    [{"reasoning": "Let me add.", "tool_calls": [{"name": "add", "arguments": {"a": 1, "b": 2}}]},
+     {"content": "The answer is 3."}]
+A reply with tool_calls is only played when the request offers that tool and the
+conversation does not already end with a tool result, so tool loops terminate.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+FILLER_WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do", "eiusmod", "tempor")
+
+
+class MockSettings:
+    def __init__(self, tokens_per_sec: float = 50.0, latency_ms: float = 200.0, jitter_ms: float = 0.0,
+                 reply_tokens: int = 64, reasoning_tokens: int = 0, model_id: str = "mock-model",
+                 script: Optional[List[Dict[str, Any]]] = None, seed: Optional[int] = None):
+        self.tokens_per_sec = tokens_per_sec
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.reply_tokens = reply_tokens
+        self.reasoning_tokens = reasoning_tokens
+        self.model_id = model_id
+        self.script = script or []
+        self._script_cycle = itertools.cycle(self.script) if self.script else None
+        self.random = random.Random(seed)
+
+    def next_reply(self, offered_tools: List[str], after_tool_result: bool) -> Dict[str, Any]:
+        if self._script_cycle:
+            for _ in range(len(self.script)):
+                reply = next(self._script_cycle)
+                calls = reply.get("tool_calls") or []
+                if not calls or (not after_tool_result and all(call.get("name") in offered_tools for call in calls)):
+                    return reply
+        return {
+            "reasoning": self._filler(self.reasoning_tokens) if self.reasoning_tokens else "",
+            "content": self._filler(self.reply_tokens),
+        }
+
+    def _filler(self, count: int) -> str:
+        return " ".join(self.random.choice(FILLER_WORDS) for _ in range(count))
+
+    async def first_byte_delay(self) -> None:
+        delay_ms = self.latency_ms + (self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+
+    async def token_delay(self) -> None:
+        if self.tokens_per_sec > 0:
+            await asyncio.sleep(1 / self.tokens_per_sec)
+
+
+def split_tokens(text: str) -> List[str]:
+    """Splits text into word-sized deltas, keeping the leading space on each word like real tokenizers do."""
+    if not text:
+        return []
+    words = text.split(" ")
+    return [words[0]] + [f" {word}" for word in words[1:]]
+
+
+def create_mock_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI(title="Mock LLM")
+
+    @app.get("/v1/models")
+    @app.get("/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": settings.model_id, "object": "model", "owned_by": "mock"}]}
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages") or []
+        offered = [tool.get("function", {}).get("name") for tool in body.get("tools") or []]
+        reply = settings.next_reply(offered, bool(messages) and messages[-1].get("role") == "tool")
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in messages) // 4
+        return StreamingResponse(_openai_stream(settings, reply, body.get("model") or settings.model_id, include_usage, prompt_tokens), media_type="text/event-stream")
+
+    @app.post("/v1beta/models/{model_action:path}")
+    async def google_stream(model_action: str, request: Request):
+        body = await request.json()
+        contents = body.get("contents") or []
+        offered = [decl.get("name") for tool in body.get("tools") or [] for decl in tool.get("functionDeclarations") or []]
+        last_parts = contents[-1].get("parts", []) if contents else []
+        reply = settings.next_reply(offered, any("functionResponse" in part for part in last_parts))
+        prompt_tokens = sum(len(str(part.get("text") or "")) for content in contents for part in content.get("parts", [])) // 4
+        sse = request.query_params.get("alt") == "sse"
+        return StreamingResponse(_google_stream(settings, reply, prompt_tokens, sse), media_type="text/event-stream" if sse else "application/json")
+
+    return app
+
+
+async def _openai_stream(settings: MockSettings, reply: Dict[str, Any], model: str, include_usage: bool, prompt_tokens: int):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, **extra: Any) -> str:
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                   "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+        return f"data: {json.dumps(payload)}\n\n"
+
+    await settings.first_byte_delay()
+    yield chunk({"role": "assistant", "content": ""})
+    reasoning_tokens = split_tokens(reply.get("reasoning") or "")
+    content_tokens = split_tokens(reply.get("content") or "")
+    for token in reasoning_tokens:
+        yield chunk({"reasoning_content": token})
+        await settings.token_delay()
+    for token in content_tokens:
+        yield chunk({"content": token})
+        await settings.token_delay()
+    tool_calls = reply.get("tool_calls") or []
+    for index, call in enumerate(tool_calls):
+        arguments = json.dumps(call.get("arguments") or {})
+        half = len(arguments) // 2
+        yield chunk({"tool_calls": [{"index": index, "id": f"call_{uuid.uuid4().hex[:8]}", "type": "function", "function": {"name": call["name"], "arguments": arguments[:half]}}]})
+        await settings.token_delay()
+        yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[half:]}}]})
+    yield chunk({}, "tool_calls" if tool_calls else "stop")
+    if include_usage:
+        completion_tokens = len(reasoning_tokens) + len(content_tokens) + 10 * len(tool_calls)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                 "completion_tokens_details": {"reasoning_tokens": len(reasoning_tokens)}}
+        yield f"data: {json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model, 'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def _google_stream(settings: MockSettings, reply: Dict[str, Any], prompt_tokens: int, sse: bool):
+    reasoning_tokens = split_tokens(reply.get("reasoning") or "")
+    content_tokens = split_tokens(reply.get("content") or "")
+    tool_calls = reply.get("tool_calls") or []
+    pieces = [{"text": token, "thought": True} for token in reasoning_tokens] + [{"text": token} for token in content_tokens]
+    pieces += [{"functionCall": {"name": call["name"], "args": call.get("arguments") or {}}} for call in tool_calls]
+
+    await settings.first_byte_delay()
+    if not sse:
+        yield "["
+    for index, part in enumerate(pieces):
+        response = {"candidates": [{"content": {"role": "model", "parts": [part]}, "index": 0}]}
+        if index == len(pieces) - 1:
+            response["candidates"][0]["finishReason"] = "STOP"
+            response["usageMetadata"] = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(content_tokens) + 10 * len(tool_calls),
+                                         "thoughtsTokenCount": len(reasoning_tokens)}
+        if sse:
+            yield f"data: {json.dumps(response)}\r\n\r\n"
+        else:
+            yield ("," if index else "") + "\r\n" + json.dumps(response)
+        await settings.token_delay()
+    if not sse:
+        yield "]"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock OpenAI/Google-compatible streaming LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="Streaming rate per response (0 = as fast as possible)")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Delay before the first byte of each response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform +/- jitter added to --latency-ms")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="Length of generated filler replies")
+    parser.add_argument("--reasoning-tokens", type=int, default=0, help="Length of generated filler reasoning")
+    parser.add_argument("--model-id", default="mock-model", help="Model id reported by /v1/models")
+    parser.add_argument("--script", help="JSON file with a list of scripted replies (see module docstring)")
+    parser.add_argument("--seed", type=int, help="Seed for filler text and jitter")
+    args = parser.parse_args()
+
+    script = None
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as handle:
+            script = json.load(handle)
+    settings = MockSettings(args.tokens_per_sec, args.latency_ms, args.jitter_ms, args.reply_tokens, args.reasoning_tokens,
+                            args.model_id, script, args.seed)
+    uvicorn.run(create_mock_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# model_registry.py
+"""
+In-memory index of model configurations, keyed by normalized model name.
+
+Models come from two places. The first is the `models` list in model_config.yaml. The
+second is the embedded model fields of character rows (model_name, else preferred_model);
+get() synthesizes a config from those the same way get_model_config always has. A
+lookup is a dict access.
+
+The character part of the index comes from the CharacterCache (character_cache.py) and
+is rebuilt whenever the cache's data version changes. The character endpoints bump that
+version in the same transaction as their write (see bump_data_version). Other workers
+notice the new version within the cache's check interval.
+
+The data_versions table is created by api.init_db().
+"""
+import logging
+import sqlite3
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+if TYPE_CHECKING:
+    from character_cache import CharacterCache
+
+logger = logging.getLogger(__name__)
+
+CHARACTERS_DATA = "characters"
+
+
+def normalize_model_name(name: Optional[str]) -> str:
+    return (name or "").strip().lower()
+
+
+def read_data_version(conn: sqlite3.Connection, name: str) -> int:
+    row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_data_version(conn: sqlite3.Connection, name: str) -> None:
+    """Marks `name` as changed; call inside the transaction that changes it."""
+    conn.execute("INSERT INTO data_versions (name, version) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET version = version + 1", (name,))
+
+
+class ModelRegistry:
+    def __init__(self, characters: "CharacterCache"):
+        self.characters = characters
+        self._configs: Dict[str, Dict[str, Any]] = {} # model_config.yaml entries
+        self._embedded: Dict[str, Dict[str, Any]] = {} # character model_name, then preferred_model
+        self._characters_version: Optional[int] = None # Cache version the character index was built from
+
+    def load_configs(self, model_configs: Dict[str, Any]) -> None:
+        """Indexes the parsed model_config.yaml; the first entry wins when names collide, as with a linear scan."""
+        configs: Dict[str, Dict[str, Any]] = {}
+        for config in model_configs.get("models") or []:
+            key = normalize_model_name(config.get("name"))
+            if key:
+                configs.setdefault(key, config)
+        self._configs = configs
+
+    def _refresh(self) -> None:
+        self.characters.refresh() # Reloads the cache first if another worker changed characters
+        if self.characters.version == self._characters_version and self._characters_version is not None:
+            return
+        characters = self.characters.all() # Copied only when the index has to be rebuilt
+        by_model_name: Dict[str, Dict[str, Any]] = {}
+        by_preferred: Dict[str, Dict[str, Any]] = {}
+        for character in characters:
+            embedded = {"provider": character["model_provider"], "model_identifier": character["model_identifier"], "supports_images": character["model_supports_images"]}
+            if normalize_model_name(character["model_name"]):
+                by_model_name.setdefault(normalize_model_name(character["model_name"]), embedded)
+            if normalize_model_name(character["preferred_model"]):
+                by_preferred.setdefault(normalize_model_name(character["preferred_model"]), embedded)
+        self._embedded = {**by_preferred, **by_model_name} # A model_name match beats a preferred_model one
+        self._characters_version = self.characters.version
+        logger.debug("Model registry rebuilt: %s configured, %s from characters (version %s).", len(self._configs), len(self._embedded), self._characters_version)
+
+    # --- Lookup ---
+    def configured(self, model_name: Optional[str]) -> Optional[Dict[str, Any]]:
+        """The model_config.yaml entry for model_name, if any."""
+        return self._configs.get(normalize_model_name(model_name))
+
+    def get(self, model_name: Optional[str]) -> Optional[Dict[str, Any]]:
+        """model_config.yaml entry, else a config synthesized from a character's embedded model fields."""
+        key = normalize_model_name(model_name)
+        if not key:
+            return None
+        config = self._configs.get(key)
+        if config is not None:
+            return config
+        self._refresh()
+        embedded = self._embedded.get(key)
+        if embedded is None:
+            return None
+        return {
+            "name": model_name,
+            "provider": embedded["provider"] or "openrouter",
+            "model_identifier": embedded["model_identifier"] or model_name,
+            "supports_images": bool(embedded["supports_images"]),
+        }
@@ -0,0 +1,317 @@
+# profiling.py
+"""
+On-demand request profiling.
+
+A request carrying the admin token in the `X-Zeryo-Profile` header (or a `profile=<token>`
+query parameter) runs under a sampling CPU profiler and tracemalloc until its response
+body completes. For /generate that is the whole generation stream. The profile is saved
+to ZERYO_PROFILE_DIR and its id is returned in the `X-Zeryo-Profile-Id` response header.
+
+With ZERYO_PROFILE_SLOWEST=N, every request is CPU-sampled (without tracemalloc) and the
+profiles of the N slowest are kept. Faster ones are discarded when they finish.
+
+Finished profiles are aggregated and written by a background writer thread, off the
+event loop, so a profile can appear a moment after its response. The limits (N slowest,
+MAX_EXPLICIT_PROFILES on-demand) apply to the directory, so profiles left by earlier
+runs or by other workers count towards them and are pruned too.
+
+The sampler reads the event loop thread's stack from a background thread every
+ZERYO_PROFILE_INTERVAL_MS. Every in-flight profile receives each sample. Profiles are
+therefore exact for a request that runs alone and approximate under concurrency.
+Work handed to worker threads (asyncio.to_thread) shows up as the awaiting frame.
+
+Environment variables:
+  ZERYO_ADMIN_TOKEN          Enables profiling; required to request profiles and read them
+  ZERYO_PROFILE_DIR          Where profiles are stored (default: profiles)
+  ZERYO_PROFILE_SLOWEST      Keep profiles of the N slowest requests (default: 0, off)
+  ZERYO_PROFILE_INTERVAL_MS  Sampling interval (default: 5)
+"""
+import hmac
+import heapq
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+MAX_STACK_DEPTH = 64
+MAX_EXPLICIT_PROFILES = 50 # Oldest on-demand profiles are deleted beyond this
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 25
+_SNAPSHOT_FILTERS = (tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)) # Hide the profiler's own allocations
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _collapse_stack(frame) -> str:
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, allocations: bool):
+        self.profile_id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.allocations = allocations
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.ended: Optional[float] = None # Set when the response completes; finish() may run later
+        self.stacks: Counter = Counter()
+        self.snapshot_before: Optional[tracemalloc.Snapshot] = _take_snapshot() if allocations else None
+        self.result: Optional[Dict[str, Any]] = None
+
+    def add_sample(self, stack: str) -> None:
+        self.stacks[stack] += 1
+
+    def finish(self, status: int) -> Dict[str, Any]:
+        duration_ms = ((self.ended or time.perf_counter()) - self.started) * 1000
+        total = sum(self.stacks.values())
+        self_counts: Counter = Counter()
+        cumulative: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            for label in set(frames):
+                cumulative[label] += count
+        self.result = {
+            "profile_id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "status": status,
+            "started_at": self.started_at,
+            "duration_ms": round(duration_ms, 2),
+            "samples": total,
+            "top_self": [{"frame": label, "samples": count, "pct": round(100 * count / total, 1)} for label, count in self_counts.most_common(TOP_FUNCTIONS)] if total else [],
+            "top_cumulative": [{"frame": label, "samples": count, "pct": round(100 * count / total, 1)} for label, count in cumulative.most_common(TOP_FUNCTIONS)] if total else [],
+            "collapsed_stacks": dict(self.stacks), # Brendan Gregg "collapsed" format, loadable in speedscope/flamegraph.pl
+        }
+        if self.snapshot_before is not None and tracemalloc.is_tracing():
+            snapshot_after = _take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            self.result["memory"] = {
+                "traced_current_kb": round(current / 1024, 1),
+                "traced_peak_kb": round(peak / 1024, 1),
+                "top_allocations": [
+                    {"site": str(stat.traceback), "size_diff_kb": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff}
+                    for stat in snapshot_after.compare_to(self.snapshot_before, "lineno")[:TOP_ALLOCATIONS]
+                ],
+            }
+            self.snapshot_before = None
+        return self.result
+
+
+class ProfileStore:
+    def __init__(self, admin_token: Optional[str], directory: str, keep_slowest: int, interval_ms: float):
+        self.admin_token = admin_token or None
+        self.directory = directory
+        self.keep_slowest = keep_slowest
+        self.interval = max(interval_ms, 1) / 1000
+        self._lock = threading.Lock()
+        self._active: Set[RequestProfile] = set()
+        self._sampler: Optional[threading.Thread] = None
+        self._sampler_stop: Optional[threading.Event] = None # Each sampler thread gets its own stop event
+        self._loop_thread_id: Optional[int] = None
+        self._tracemalloc_users = 0
+        self._writer: Optional[threading.Thread] = None
+        self._finished: "queue.Queue[tuple]" = queue.Queue() # (profile, status, explicit) waiting for the writer
+        self._slowest: Optional[List[float]] = None # min-heap of stored slowest-N durations; loaded from disk on first use
+
+    @classmethod
+    def from_env(cls) -> "ProfileStore":
+        return cls(
+            os.environ.get("ZERYO_ADMIN_TOKEN"),
+            os.environ.get("ZERYO_PROFILE_DIR", "profiles"),
+            int(os.environ.get("ZERYO_PROFILE_SLOWEST", "0") or 0),
+            float(os.environ.get("ZERYO_PROFILE_INTERVAL_MS", "5") or 5),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.admin_token is not None
+
+    def check_token(self, token: Optional[str]) -> bool:
+        return bool(self.admin_token and token and hmac.compare_digest(token, self.admin_token))
+
+    def requested(self, scope) -> bool:
+        """True if the request carries a valid profiling flag."""
+        token = dict(scope.get("headers") or []).get(b"x-zeryo-profile", b"").decode("latin-1") or None
+        if token is None and scope.get("query_string"):
+            token = (parse_qs(scope["query_string"].decode("latin-1")).get("profile") or [None])[0]
+        return self.check_token(token)
+
+    # --- Lifecycle ---
+    def begin(self, method: str, path: str, explicit: bool) -> RequestProfile:
+        with self._lock:
+            if explicit:
+                if self._tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start(5)
+                self._tracemalloc_users += 1
+            profile = RequestProfile(method, path, allocations=explicit)
+            self._active.add(profile)
+            if self._sampler is None or not self._sampler.is_alive():
+                self._loop_thread_id = threading.get_ident() # begin() runs on the event loop thread
+                self._sampler_stop = threading.Event()
+                self._sampler = threading.Thread(target=self._sample_loop, args=(self._sampler_stop,), name="zeryo-profiler", daemon=True)
+                self._sampler.start()
+        return profile
+
+    def end(self, profile: RequestProfile, status: int, explicit: bool) -> None:
+        """Called on the event loop when the response completes; aggregation and storage happen on the writer thread."""
+        profile.ended = time.perf_counter()
+        with self._lock:
+            self._active.discard(profile)
+            if not self._active and self._sampler_stop is not None:
+                self._sampler_stop.set()
+                self._sampler = self._sampler_stop = None
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="zeryo-profile-writer", daemon=True)
+                self._writer.start()
+        self._finished.put((profile, status, explicit))
+
+    def _write_loop(self) -> None:
+        while True:
+            profile, status, explicit = self._finished.get()
+            try: self._store(profile, status, explicit)
+            except Exception: logger.exception("Could not store profile %s", profile.profile_id)
+
+    def _store(self, profile: RequestProfile, status: int, explicit: bool) -> None:
+        try:
+            result = profile.finish(status)
+        finally:
+            if explicit:
+                with self._lock:
+                    self._tracemalloc_users -= 1
+                    if self._tracemalloc_users == 0 and tracemalloc.is_tracing():
+                        tracemalloc.stop()
+        if explicit:
+            self._save(result, "explicit")
+            self._prune("explicit", MAX_EXPLICIT_PROFILES, "started_at")
+        elif self.keep_slowest:
+            if self._slowest is None:
+                self._slowest = [item.get("duration_ms") or 0 for item in self._prune("slowest", self.keep_slowest, "duration_ms")]
+                heapq.heapify(self._slowest)
+            if len(self._slowest) >= self.keep_slowest and result["duration_ms"] <= self._slowest[0]:
+                return
+            self._save(result, "slowest")
+            self._slowest = [item.get("duration_ms") or 0 for item in self._prune("slowest", self.keep_slowest, "duration_ms")]
+            heapq.heapify(self._slowest)
+
+    def _prune(self, kind: str, keep: int, order_key: str) -> List[Dict[str, Any]]:
+        """Deletes stored profiles of `kind` beyond the `keep` highest by order_key (any worker's); returns the rest."""
+        stored = sorted((item for item in self.list_profiles() if item.get("kind") == kind), key=lambda item: item.get(order_key) or 0, reverse=True)
+        for item in stored[keep:]:
+            self._delete(item["profile_id"])
+        return stored[:keep]
+
+    def _sample_loop(self, stop: threading.Event) -> None:
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = _collapse_stack(frame)
+            with self._lock:
+                for profile in self._active:
+                    profile.add_sample(stack)
+
+    # --- Storage ---
+    def _path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def _save(self, result: Dict[str, Any], kind: str) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(result["profile_id"]), "w", encoding="utf-8") as handle:
+                json.dump({**result, "kind": kind}, handle)
+        except OSError as exc:
+            logger.warning("Could not save profile %s: %s", result["profile_id"], exc)
+
+    def _delete(self, profile_id: str) -> None:
+        try: os.remove(self._path(profile_id))
+        except OSError: pass
+
+    def load(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        if not profile_id.isalnum():
+            return None
+        try:
+            with open(self._path(profile_id), "r", encoding="utf-8") as handle:
+                return json.load(handle)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        """Summaries of stored profiles, slowest first."""
+        summaries = []
+        if not os.path.isdir(self.directory):
+            return summaries
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            data = self.load(name[:-5])
+            if data:
+                summaries.append({key: data.get(key) for key in ("profile_id", "kind", "method", "path", "status", "started_at", "duration_ms", "samples")})
+        return sorted(summaries, key=lambda item: item.get("duration_ms") or 0, reverse=True)
+
+
+def collapsed_text(profile: Dict[str, Any]) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in (profile.get("collapsed_stacks") or {}).items())
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles flagged requests (and all requests in slowest-N mode) until their body completes."""
+
+    def __init__(self, app, store: ProfileStore):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.store.enabled:
+            await self.app(scope, receive, send)
+            return
+        explicit = self.store.requested(scope)
+        if not explicit and not self.store.keep_slowest:
+            await self.app(scope, receive, send)
+            return
+
+        profile = self.store.begin(scope["method"], scope["path"], explicit)
+        status = {"code": 500}
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if not finished:
+                finished = True
+                self.store.end(profile, status["code"], explicit)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if explicit:
+                    message = {**message, "headers": list(message.get("headers") or []) + [(b"x-zeryo-profile-id", profile.profile_id.encode())]}
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
@@ -0,0 +1,78 @@
+# provider_clients.py
+"""
+Shared httpx client for LLM provider requests.
+
+Creating an httpx.AsyncClient builds an SSL context, which blocked the event loop for
+150-300 ms on every LLM call when each call made its own client. One client is now
+shared by all generations in a worker. It is built in a worker thread and keeps its
+connection pool between calls.
+
+rebuild() (called when api_keys.yaml is reloaded) swaps in a fresh client for new
+calls. Streams already running keep the client they started with, and that client is
+closed once its last user finishes.
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderClientPool:
+    def __init__(self, timeout: float = 600.0, max_connections: int = 100):
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=20)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._users: Dict[httpx.AsyncClient, int] = {}
+        self._retired: set = set()
+        self._build_lock: Optional[asyncio.Lock] = None
+
+    def _new_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+
+    async def _current(self) -> httpx.AsyncClient:
+        if self._client is None:
+            if self._build_lock is None:
+                self._build_lock = asyncio.Lock()
+            async with self._build_lock:
+                if self._client is None:
+                    self._client = await asyncio.to_thread(self._new_client) # SSL setup off the event loop
+                    self._users[self._client] = 0
+        return self._client
+
+    @asynccontextmanager
+    async def client(self) -> AsyncIterator[httpx.AsyncClient]:
+        """The current shared client, held for the duration of the block."""
+        client = await self._current()
+        self._users[client] += 1
+        try:
+            yield client
+        finally:
+            self._users[client] -= 1
+            if client in self._retired and self._users[client] == 0:
+                await self._close(client)
+
+    async def _close(self, client: httpx.AsyncClient) -> None:
+        self._retired.discard(client)
+        self._users.pop(client, None)
+        try: await client.aclose()
+        except Exception as exc: logger.debug("Error closing retired provider client: %s", exc)
+
+    def rebuild(self) -> None:
+        """New calls get a fresh client; the old one is closed when its in-flight streams finish."""
+        client, self._client = self._client, None
+        if client is None:
+            return
+        self._retired.add(client)
+        if self._users.get(client, 0) == 0:
+            asyncio.get_running_loop().create_task(self._close(client))
+        logger.info("Provider HTTP client rebuilt (%s in-flight calls keep the previous one).", self._users.get(client, 0))
+
+    async def aclose(self) -> None:
+        clients = set(self._users) | self._retired
+        self._client = None
+        for client in clients:
+            await self._close(client)
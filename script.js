@@ -369,6 +369,12 @@ function openCharacterEditor(existing=null) {
     supportsImagesLabel.appendChild(supportsImagesCheckbox);
     supportsImagesLabel.appendChild(document.createTextNode(' Supports Images'));
     
+    // Checkbox for provider prompt caching (stored in character settings)
+    const promptCachingLabel = document.createElement('label'); promptCachingLabel.className='checkbox-inline';
+    const promptCachingCheckbox = document.createElement('input'); promptCachingCheckbox.type='checkbox'; promptCachingCheckbox.checked = !!existing?.settings?.prompt_caching;
+    promptCachingLabel.appendChild(promptCachingCheckbox);
+    promptCachingLabel.appendChild(document.createTextNode(' Prompt Caching (OpenRouter)'));
+    
     // OpenRouter providers input (only shown when provider is openrouter)
     const openrouterProvidersInput = document.createElement('input');
     openrouterProvidersInput.type = 'text';
@@ -398,6 +404,7 @@ function openCharacterEditor(existing=null) {
     body.appendChild(openrouterProvidersGroup);
     body.appendChild(providersHint);
     body.appendChild(supportsImagesLabel);
+    body.appendChild(promptCachingLabel);
     
     // Actions footer
     const actions = document.createElement('div'); actions.className='form-actions';
@@ -418,7 +425,8 @@ function openCharacterEditor(existing=null) {
             openrouter_providers: openrouterProvidersValue || null,
             cot_start_tag: null,
             cot_end_tag: null,
-            settings: {}
+            // Keep settings not edited in this form (e.g. context_length, context_policy)
+            settings: { ...(existing?.settings || {}), prompt_caching: promptCachingCheckbox.checked }
         };
         try {
             let resp;
@@ -4246,6 +4254,12 @@ async function streamFromBackend(chatId, parentMessageId, modelName, generationA
                                     console.error("Backend generation error:", eventData.message);
                                     streamEndedSuccessfully = false;
                                     throw new Error(eventData.message || "Unknown backend generation error");
+                                case 'context_trimmed':
+                                    console.info(`Context trimmed: ${eventData.trimmed_messages} messages (~${eventData.trimmed_tokens} tokens) dropped to fit ${eventData.context_limit} tokens (policy: ${eventData.policy}).`);
+                                    break;
+                                case 'timing':
+                                    console.info(`Generation timing: ${eventData.total_ms} ms total, first token at ${eventData.first_token_ms ?? 'n/a'} ms`, eventData.spans_ms);
+                                    break;
                                 case 'done':
                                     console.log("Received 'done' event from backend.");
                                     streamEndedSuccessfully = true;
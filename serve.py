@@ -0,0 +1,71 @@
+# serve.py
+"""
+Production entry point for the API.
+
+    python serve.py --workers 4 --port 8000
+    python serve.py --dev                    # single process with the auto-reloader
+
+Every option can also be set through the environment (command-line flags win):
+  ZERYO_HOST, ZERYO_PORT, ZERYO_WORKERS, ZERYO_LOOP (auto|asyncio|uvloop),
+  ZERYO_HTTP (auto|h11|httptools), ZERYO_KEEP_ALIVE, ZERYO_GRACEFUL_TIMEOUT,
+  ZERYO_DB_PATH, ZERYO_ACCESS_LOG (0/1), ZERYO_DEV (0/1)
+
+"auto" picks uvloop/httptools when they are installed. Worker processes read
+ZERYO_DB_PATH when they import api.py. With several workers, running generations are
+coordinated through the database (see generation_registry.py).
+"""
+import argparse
+import importlib.util
+import os
+
+import uvicorn
+
+
+def _env_flag(name: str, default: bool = False) -> bool:
+    return os.environ.get(name, "1" if default else "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Serve the Zeryo Chat Data API")
+    parser.add_argument("--host", default=os.environ.get("ZERYO_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("ZERYO_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("ZERYO_WORKERS", "1")), help="Worker processes (ignored in --dev)")
+    parser.add_argument("--loop", choices=("auto", "asyncio", "uvloop"), default=os.environ.get("ZERYO_LOOP", "auto"))
+    parser.add_argument("--http", choices=("auto", "h11", "httptools"), default=os.environ.get("ZERYO_HTTP", "auto"))
+    parser.add_argument("--keep-alive", type=int, default=int(os.environ.get("ZERYO_KEEP_ALIVE", "5")), help="Idle keep-alive timeout in seconds")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.environ.get("ZERYO_GRACEFUL_TIMEOUT", "30")), help="Seconds to let running streams finish on shutdown")
+    parser.add_argument("--db-path", default=os.environ.get("ZERYO_DB_PATH"), help="SQLite database file (default: chat_db_branching_v2.sqlite)")
+    parser.add_argument("--access-log", action=argparse.BooleanOptionalAction, default=_env_flag("ZERYO_ACCESS_LOG", True))
+    parser.add_argument("--dev", action="store_true", default=_env_flag("ZERYO_DEV"), help="Single process with auto-reload on code changes")
+    return parser
+
+
+def main() -> None:
+    parser = build_parser()
+    args = parser.parse_args()
+    for option, module in (("loop", "uvloop"), ("http", "httptools")):
+        if getattr(args, option) == module and importlib.util.find_spec(module) is None:
+            parser.error(f"--{option} {module} requested but {module} is not installed (pip install {module})")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.dev and args.workers > 1:
+        parser.error("--dev runs a single reloading process; drop --workers")
+    if args.db_path:
+        os.environ["ZERYO_DB_PATH"] = args.db_path # Inherited by worker processes before they import api
+
+    uvicorn.run(
+        "api:app",
+        host=args.host,
+        port=args.port,
+        workers=None if args.dev else args.workers,
+        reload=args.dev,
+        loop=args.loop,
+        http=args.http,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        access_log=args.access_log,
+    )
+
+
+if __name__ == "__main__":
+    main()
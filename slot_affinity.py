@@ -0,0 +1,92 @@
+# slot_affinity.py
+"""
+Pins chats to llama.cpp server slots so the local runtime can reuse its KV cache.
+
+llama-server keeps the KV cache of the last prompt each slot processed. With
+`cache_prompt: true`, only the part of a new prompt after the longest common prefix
+with that cache is evaluated again. The saving only happens if the request reaches the
+slot that holds the chat's previous prompt. When the server picks the slot itself,
+regenerates, branch switches and tool-loop steps often land on a cold slot and the
+whole conversation is processed again.
+
+With ZERYO_LOCAL_SLOTS set to the server's slot count (its `--parallel`/`-np`), each
+chat is pinned to one slot through `id_slot`. Branches of a chat share their history
+up to the fork, so keeping them on the chat's slot reuses that prefix too. Once every
+slot is taken, a new chat takes the slot of the least recently used chat that is not
+generating. If every slot is busy, the request goes out without `id_slot` and the
+server picks a slot. ZERYO_LOCAL_SLOTS=0 (the default) turns this off.
+
+The assignment table is per worker. With several workers, give each its own
+llama-server, or expect chats from different workers to evict each other's slots.
+"""
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SlotAffinity:
+    def __init__(self, slots: int = 0):
+        self.slots = max(int(slots), 0)
+        self._assigned: "OrderedDict[str, int]" = OrderedDict() # chat_id -> slot, least recently used first
+        self._busy: Dict[int, int] = {} # slot -> LLM calls in flight
+        self.stats = {"hits": 0, "assigned": 0, "evicted": 0, "unpinned": 0}
+
+    @classmethod
+    def from_env(cls) -> "SlotAffinity":
+        return cls(int(os.environ.get("ZERYO_LOCAL_SLOTS", "0") or 0))
+
+    @property
+    def enabled(self) -> bool:
+        return self.slots > 0
+
+    def acquire(self, chat_id: str) -> Optional[int]:
+        """Slot to send chat_id's next local call to, or None to let the server choose. Pair with release()."""
+        if not self.enabled:
+            return None
+        slot = self._assigned.get(chat_id)
+        if slot is not None:
+            self._assigned.move_to_end(chat_id)
+            self.stats["hits"] += 1
+        else:
+            slot = self._free_slot(chat_id)
+            if slot is None:
+                self.stats["unpinned"] += 1
+                logger.debug("All %s local slots are busy; chat %s goes unpinned.", self.slots, chat_id)
+                return None
+            self._assigned[chat_id] = slot
+            self.stats["assigned"] += 1
+        self._busy[slot] = self._busy.get(slot, 0) + 1
+        return slot
+
+    def _free_slot(self, chat_id: str) -> Optional[int]:
+        used = set(self._assigned.values())
+        unused = next((slot for slot in range(self.slots) if slot not in used), None)
+        if unused is not None:
+            return unused
+        for victim, slot in self._assigned.items(): # Least recently used first
+            if not self._busy.get(slot):
+                del self._assigned[victim]
+                self.stats["evicted"] += 1
+                logger.debug("Local slot %s reassigned from chat %s to chat %s.", slot, victim, chat_id)
+                return slot
+        return None
+
+    def release(self, slot: Optional[int]) -> None:
+        if slot is None:
+            return
+        remaining = self._busy.get(slot, 0) - 1
+        if remaining > 0: self._busy[slot] = remaining
+        else: self._busy.pop(slot, None)
+
+    def forget(self, chat_id: str) -> None:
+        """Frees the chat's slot for others (e.g. after the chat is deleted)."""
+        self._assigned.pop(chat_id, None)
+
+    def status(self) -> Dict[str, Any]:
+        assignments: List[Dict[str, Any]] = [
+            {"chat_id": chat_id, "slot": slot, "busy": self._busy.get(slot, 0)} for chat_id, slot in reversed(self._assigned.items())
+        ]
+        return {"enabled": self.enabled, "slots": self.slots, "assignments": assignments, **self.stats}
@@ -0,0 +1,157 @@
+# static_assets.py
+"""
+Content-hashed, precompressed copies of the frontend files.
+
+At startup, script.js, style.css and the favicon are read into memory and renamed
+after their content hash (script.js -> /assets/script.<hash>.js). The text files are
+also compressed once with gzip, and with brotli when it is installed. index.html is
+rewritten to point at the hashed names. A hashed URL never changes content, so it is
+served with `Cache-Control: immutable` and a one-year max-age. index.html itself is
+revalidated on each load through its ETag. Each encoding of a file has its own strong
+ETag.
+
+Page loads check the source files' mtimes and rebuild when one changed, so an edited
+script.js is picked up without a restart. `python static_assets.py` prints the
+manifest and the compressed sizes. `python static_assets.py --out DIR` writes the
+hashed files and their .gz/.br variants for a CDN or reverse proxy.
+"""
+import argparse
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from compression import ENCODINGS, compress
+
+logger = logging.getLogger(__name__)
+
+ASSETS = ("script.js", "style.css", "xr_hehe.jpg")
+COMPRESSIBLE = (".js", ".css", ".html", ".svg", ".json")
+ASSETS_PREFIX = "/assets/"
+FILE_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+
+class Asset:
+    def __init__(self, name: str, media_type: str, body: bytes, digest: str, compressible: bool):
+        self.name = name # Served name (hashed for assets, index.html for the page)
+        self.media_type = media_type
+        self.digest = digest
+        self.variants: Dict[Optional[str], bytes] = {None: body} # Content-Encoding (None = identity) -> body
+        if compressible:
+            for encoding in ENCODINGS:
+                compressed = compress(body, encoding, best=True)
+                if len(compressed) < len(body):
+                    self.variants[encoding] = compressed
+
+    def etag(self, encoding: Optional[str]) -> str:
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+def _signature(paths: List[str]) -> Tuple:
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+def _digest(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()[:12]
+
+
+class StaticAssets:
+    def __init__(self, root: str = ".", index: str = "index.html", assets: Tuple[str, ...] = ASSETS):
+        self.root = root
+        self.index_name = index
+        self.asset_names = assets
+        self.index: Optional[Asset] = None
+        self.assets: Dict[str, Asset] = {} # hashed name -> asset
+        self.manifest: Dict[str, str] = {} # source name -> hashed URL
+        self._signature: Optional[Tuple] = None
+        self._lock = threading.Lock()
+
+    def _paths(self) -> List[str]:
+        return [os.path.join(self.root, name) for name in (self.index_name, *self.asset_names)]
+
+    def stale(self) -> bool:
+        return _signature(self._paths()) != self._signature
+
+    def build(self) -> None:
+        """Re-reads, hashes and compresses every file; the new set replaces the old one in one step."""
+        with self._lock:
+            signature = _signature(self._paths())
+            if signature == self._signature:
+                return
+            assets: Dict[str, Asset] = {}
+            manifest: Dict[str, str] = {}
+            for name in self.asset_names:
+                try:
+                    with open(os.path.join(self.root, name), "rb") as handle:
+                        body = handle.read()
+                except OSError as exc:
+                    logger.warning("Static asset %s not hashed (%s); it is served unversioned.", name, exc)
+                    continue
+                stem, extension = os.path.splitext(name)
+                digest = _digest(body)
+                hashed = f"{stem}.{digest[:10]}{extension}"
+                media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                assets[hashed] = Asset(hashed, media_type, body, digest, extension in COMPRESSIBLE)
+                manifest[name] = ASSETS_PREFIX + hashed
+            try:
+                with open(os.path.join(self.root, self.index_name), "r", encoding="utf-8") as handle:
+                    body = self.rewrite(handle.read(), manifest).encode("utf-8")
+                self.index = Asset(self.index_name, "text/html; charset=utf-8", body, _digest(body), True)
+            except OSError as exc:
+                logger.warning("No %s to serve (%s).", self.index_name, exc)
+                self.index = None
+            self.assets, self.manifest, self._signature = assets, manifest, signature
+            logger.info("Static assets built: %s", ", ".join(f"{name} -> {url}" for name, url in manifest.items()))
+
+    @staticmethod
+    def rewrite(html: str, manifest: Dict[str, str]) -> str:
+        """Points src/href attributes that name a source file at its hashed URL."""
+        def replace(match: "re.Match[str]") -> str:
+            url = manifest.get(match.group(3).removeprefix("./").removeprefix("/"))
+            return f"{match.group(1)}{match.group(2)}{url}{match.group(2)}" if url else match.group(0)
+        return re.sub(r"""(\b(?:src|href)=)(["'])([^"'#?]+)\2""", replace, html)
+
+    def get(self, name: str) -> Optional[Asset]:
+        return self.assets.get(name)
+
+    def report(self) -> List[Dict[str, object]]:
+        """Per source file: its hashed URL and the size of each encoding."""
+        report = []
+        for name, url in self.manifest.items():
+            variants = self.assets[url.removeprefix(ASSETS_PREFIX)].variants
+            report.append({"name": name, "url": url, **{encoding or "identity": len(body) for encoding, body in variants.items()}})
+        return report
+
+    def write(self, out_dir: str) -> None:
+        """Writes the hashed files, their compressed variants and the rewritten index.html to out_dir."""
+        os.makedirs(os.path.join(out_dir, ASSETS_PREFIX.strip("/")), exist_ok=True)
+        for asset in [*self.assets.values(), *([self.index] if self.index else [])]:
+            base = os.path.join(out_dir, asset.name if asset is self.index else os.path.join(ASSETS_PREFIX.strip("/"), asset.name))
+            for encoding, body in asset.variants.items():
+                with open(base + FILE_SUFFIXES.get(encoding, ""), "wb") as handle:
+                    handle.write(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the hashed, precompressed frontend assets")
+    parser.add_argument("--root", default=".", help="Directory holding index.html and the assets")
+    parser.add_argument("--out", help="Also write the built files to this directory")
+    args = parser.parse_args()
+    static = StaticAssets(args.root)
+    static.build()
+    print(f"{'file':<14}{'identity':>10}{'gzip':>10}{'br':>10}  url")
+    for entry in static.report():
+        print(f"{entry['name']:<14}{entry['identity']:>10}{entry.get('gzip', '-'):>10}{entry.get('br', '-'):>10}  {entry['url']}")
+    if args.out:
+        static.write(args.out)
+        print(f"Written to {args.out}")
@@ -1,259 +1,291 @@
+# tools.py
+"""
+Tool registry.
+
+TOOL_SPECS holds lightweight metadata only. Each handler is named as "module:function"
+and imported on first use by LazyHandler, so importing this module (and api.py) does
+not pull in requests, bs4 or trafilatura. Installed packages can add tools through the
+"zeryo.tools" entry point group; an entry point resolves to a list of spec dicts in the
+same format, and should live in a module that is cheap to import.
+
+import_report() (GET /tools/imports, or `python tools.py`) shows what importing each
+tool's handler cost. Imports slower than ZERYO_TOOL_IMPORT_BUDGET_MS are logged.
+
+Each spec is compiled into a ToolSpec when this module loads. A ToolSpec holds a
+validator for the tool's JSON-schema parameters and the tool's execution limits:
+  timeout           Seconds allowed, including the wait for a concurrency slot
+  max_concurrency   Calls of this tool that may run at once in this worker
+  cacheable         Identical arguments reuse an earlier result for cache_ttl seconds (None: no expiry)
+  max_output_chars  Longer results are truncated (inline images are kept)
+api.invoke_tool enforces them, both in the generation tool loop and in /tools/execute.
+"""
+import asyncio
+import importlib
+import inspect
 import json
+import logging
 import os
-from typing import List, Dict, Union, Callable, Any
-
-import requests
-import yaml
-
-from bs4 import BeautifulSoup
-import trafilatura
-
-
-def _load_yaml_file(path: str) -> Dict[str, Any]:
-    if not os.path.exists(path):
-        return {}
-    try:
-        with open(path, "r", encoding="utf-8") as handle:
-            data = yaml.safe_load(handle) or {}
-            return data if isinstance(data, dict) else {}
-    except Exception as exc:
-        print(f"Warning: Failed to load YAML file {path}: {exc}")
-        return {}
-
-
-API_KEYS = _load_yaml_file(os.environ.get("API_KEYS_PATH", "api_keys.yaml"))
-SEARCH_KEYS = _load_yaml_file(os.environ.get("SEARCH_API_KEYS_PATH", "search_api_keys.yaml"))
-
-
-def _extract_key(data: Dict[str, Any], *candidates: str) -> str | None:
-    for key in candidates:
-        if key in data and data[key]:
-            return data[key]
-        lower_key = key.lower()
-        if lower_key in data and data[lower_key]:
-            return data[lower_key]
-    return None
-
-
-GOOGLE_SEARCH_API_KEY = _extract_key(
-    SEARCH_KEYS,
-    "SEARCH_API_KEY",
-    "GOOGLE_CUSTOM_SEARCH_API_KEY",
-    "GOOGLE_SEARCH_API_KEY",
-)
-GOOGLE_SEARCH_ENGINE_ID = _extract_key(
-    SEARCH_KEYS,
-    "SEARCH_ENGINE_ID",
-    "GOOGLE_CUSTOM_SEARCH_CX",
-    "GOOGLE_SEARCH_ENGINE_ID",
-)
-
-if not GOOGLE_SEARCH_API_KEY:
-    GOOGLE_SEARCH_API_KEY = _extract_key(
-        API_KEYS,
-        "SEARCH_API_KEY",
-        "GOOGLE_CUSTOM_SEARCH_API_KEY",
-        "GOOGLE_SEARCH_API_KEY",
-        "GOOGLE",
-    )
-
-if not GOOGLE_SEARCH_ENGINE_ID:
-    GOOGLE_SEARCH_ENGINE_ID = _extract_key(
-        API_KEYS,
-        "SEARCH_ENGINE_ID",
-        "GOOGLE_CUSTOM_SEARCH_CX",
-        "GOOGLE_SEARCH_ENGINE_ID",
-    )
-
-def search(query: str, *, max_results: int = 5, safe_search: str = "off") -> str:
-    """Perform a Google Custom Search query and format the top results."""
-    if not query or not query.strip():
-        return "Error: Search query must be a non-empty string."
-
-    if not GOOGLE_SEARCH_API_KEY or not GOOGLE_SEARCH_ENGINE_ID:
-        return (
-            "Error: Google Custom Search credentials are missing. "
-            "Populate SEARCH_API_KEY and SEARCH_ENGINE_ID in search_api_keys.yaml (or set SEARCH_API_KEYS_PATH)."
-        )
-
-    params = {
-        "key": GOOGLE_SEARCH_API_KEY,
-        "cx": GOOGLE_SEARCH_ENGINE_ID,
-        "q": query.strip(),
-        "num": max(1, min(int(max_results), 10)),
-    }
-    if safe_search:
-        params["safe"] = safe_search
-
-    try:
-        response = requests.get("https://www.googleapis.com/customsearch/v1", params=params, timeout=10)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as exc:
-        print(f"Error during Google Custom Search request for '{query}': {exc}")
-        return f"Search results for '{query}':\n\nError performing search: {exc}"
-
-    data = response.json()
-    items = data.get("items", [])
-    if not items:
-        error_message = data.get("error", {}).get("message")
-        if error_message:
-            return f"Search results for '{query}':\n\nError from Google Custom Search API: {error_message}"
-        return f"Search results for '{query}':\n\nNo results found."
-
-    results_lines = [f"Search results for '{query}':", ""]
-    for index, item in enumerate(items[: params["num"]], start=1):
-        title = item.get("title") or "(No title provided)"
-        link = item.get("link") or item.get("formattedUrl") or "(No link provided)"
-        snippet = (item.get("snippet") or item.get("htmlSnippet") or "").replace("\n", " ").strip()
-        results_lines.append(f"{index}. {title}")
-        results_lines.append(f"   URL: {link}")
-        if snippet:
-            results_lines.append(f"   Snippet: {snippet}")
-        results_lines.append("")
-
-    return "\n".join(results_lines).strip()
-
-
-def scrape(url: str) -> str:
-    """Download and extract cleaned text content from a webpage using trafilatura."""
-    if not url or not isinstance(url, str):
-        return "Error: URL must be a non-empty string."
-
-    if trafilatura is None:
-        return "Error: trafilatura is not installed. Please add it to your environment to use the scrape tool."
-
-    try:
-        # Use requests with 10s timeout, then pass HTML to trafilatura
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        downloaded = response.text
-    except requests.exceptions.Timeout:
-        return "Error: Request timed out (10 second limit)."
-    except requests.exceptions.RequestException as exc:
-        print(f"Error fetching URL '{url}': {exc}")
-        return f"Error fetching URL: {exc}"
-
-    if not downloaded:
-        return "Error: Unable to download the requested page."
-
-    try:
-        result = trafilatura.bare_extraction(downloaded)
-    except Exception as exc:
-        print(f"Error extracting content from '{url}': {exc}")
-        return f"Error extracting content: {exc}"
-
-    def _normalize_extraction(data: Any) -> tuple[str, str]:
-        text_value = ""
-        description_value = ""
-
-        if isinstance(data, dict):
-            text_value = (data.get("text") or "").strip()
-            description_value = (
-                data.get("description")
-                or data.get("title")
-                or ""
-            ).strip()
-        elif isinstance(data, str):
-            text_value = data.strip()
-        elif data is not None and hasattr(data, "text_content"):
-            try:
-                text_value = data.text_content().strip()
-            except Exception:
-                text_value = ""
-
-        return text_value, description_value
-
-    text, description = _normalize_extraction(result)
-
-    if not text:
-        try:
-            json_payload = trafilatura.extract(
-                downloaded,
-                output_format="json",
-                include_comments=False,
-                include_tables=False,
-            )
-        except Exception as exc:
-            print(f"Fallback JSON extraction failed for '{url}': {exc}")
-            json_payload = None
-
-        if json_payload:
-            try:
-                json_data = json.loads(json_payload)
-            except json.JSONDecodeError:
-                json_data = None
-
-            if isinstance(json_data, dict):
-                text, metadata_description = _normalize_extraction(json_data)
-                if metadata_description:
-                    description = description or metadata_description
-
-    if not text:
-        try:
-            fallback_text = trafilatura.extract(downloaded)
-            if isinstance(fallback_text, str):
-                text = fallback_text.strip()
-        except Exception as exc:
-            print(f"Fallback plain extraction failed for '{url}': {exc}")
-
-    if not text:
-        return "No extractable content found at the provided URL."
-
-    if len(text) <= 8192:
-        return text
-
-    # Provide a short summary when the content exceeds the maximum length.
-    excerpt = text[:8192].strip()
-    summary_lines = [
-        "Summary (content truncated because it exceeded 8192 characters)."
-    ]
-    if description:
-        summary_lines.append(f"Description: {description}")
-    if excerpt:
-        summary_lines.append(f"Excerpt: {excerpt}...")
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from importlib.metadata import entry_points
+from typing import List, Dict, Union, Callable, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+TOOL_IMPORT_BUDGET_MS = float(os.environ.get("ZERYO_TOOL_IMPORT_BUDGET_MS", "200"))
+TOOL_ENTRY_POINT_GROUP = "zeryo.tools"
+DEFAULT_TOOL_TIMEOUT = 60.0
+DEFAULT_TOOL_CONCURRENCY = 4
+DEFAULT_CACHE_TTL = 300.0
+DEFAULT_MAX_OUTPUT_CHARS = 32000
+TOOL_CACHE_ENTRIES = 128 # Per tool, least recently used evicted first
+IMAGE_BLOCK_PATTERN = re.compile(r'\[IMAGE:base64:[A-Za-z0-9+/=]+\]')
+
+
+class LazyHandler:
+    """Callable stand-in for a handler given as "module:function"; the module is imported on first use."""
+
+    def __init__(self, tool_name: str, target: str):
+        self.tool_name = tool_name
+        self.target = target
+        self.module_name, _, self.attribute = target.partition(":")
+        self.import_ms: Optional[float] = None
+        self.modules_loaded: Optional[int] = None # New sys.modules entries; modules shared with earlier tools count once
+        self._function: Optional[Callable[..., Any]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._function is not None
+
+    def resolve(self) -> Callable[..., Any]:
+        if self._function is None:
+            with self._lock:
+                if self._function is None:
+                    modules_before = len(sys.modules)
+                    start = time.perf_counter()
+                    function = getattr(importlib.import_module(self.module_name), self.attribute)
+                    self.import_ms = round((time.perf_counter() - start) * 1000, 1)
+                    self.modules_loaded = len(sys.modules) - modules_before
+                    if self.import_ms > TOOL_IMPORT_BUDGET_MS:
+                        logger.warning("Importing tool '%s' (%s) took %.0f ms, over the %.0f ms budget (%s new modules).", self.tool_name, self.target, self.import_ms, TOOL_IMPORT_BUDGET_MS, self.modules_loaded)
+                    else:
+                        logger.debug("Imported tool '%s' (%s) in %.1f ms.", self.tool_name, self.target, self.import_ms)
+                    self._function = function
+        return self._function
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        return self.resolve()(*args, **kwargs)
+
+    @property
+    def __signature__(self) -> inspect.Signature: # Lets inspect.signature() report the real handler's parameters
+        return inspect.signature(self.resolve())
+
+
+class ToolArgumentError(ValueError):
+    """Arguments that do not match the tool's parameter schema; raised before the handler runs."""
+
+    def __init__(self, tool_name: str, errors: List[str]):
+        self.tool_name = tool_name
+        self.errors = errors
+        super().__init__(f"Invalid arguments for tool '{tool_name}': {'; '.join(errors)}")
+
+
+class ToolTimeoutError(TimeoutError):
+    def __init__(self, tool_name: str, timeout: float, stage: str = "running"):
+        self.tool_name = tool_name
+        self.timeout = timeout
+        super().__init__(f"Tool '{tool_name}' timed out after {timeout:g}s ({stage}).")
+
+
+# --- Parameter schemas ---
+_JSON_TYPES: Dict[str, Callable[[Any], bool]] = {
+    "string": lambda value: isinstance(value, str),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "integer": lambda value: (isinstance(value, int) and not isinstance(value, bool)) or (isinstance(value, float) and value.is_integer()),
+    "boolean": lambda value: isinstance(value, bool),
+    "array": lambda value: isinstance(value, list),
+    "object": lambda value: isinstance(value, dict),
+    "null": lambda value: value is None,
+}
 
-    return "\n".join(summary_lines)
 
+def _json_type_name(value: Any) -> str:
+    for name in ("null", "boolean", "integer", "number", "string", "array", "object"):
+        if _JSON_TYPES[name](value):
+            return name
+    return type(value).__name__
 
-def get_lesswrong_post(url: str) -> str:
-    """Fetch the main LessWrong post content (title and body) without comments or sidebar."""
-    if not url or not isinstance(url, str):
-        return "Error: URL must be a non-empty string."
 
-    if BeautifulSoup is None:
-        return "Error: BeautifulSoup (bs4) is not installed."
+def parameters_schema(parameters: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Builds the JSON schema of a tool's arguments from its spec parameters.
+    A parameter is required unless it is marked "optional" or has a "default"; the internal
+    "optional" marker is dropped and every other JSON-schema keyword is kept.
+    """
+    properties = {name: {key: value for key, value in info.items() if key != "optional"} for name, info in parameters.items()}
+    for prop in properties.values():
+        prop.setdefault("type", "string")
+    required = [name for name, info in parameters.items() if not info.get("optional", False) and "default" not in info]
+    return {"type": "object", "properties": properties, "required": required}
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-    }
 
+def compile_schema(schema: Dict[str, Any]) -> Callable[[Any, str], List[str]]:
+    """
+    Compiles the JSON-schema subset used for tool parameters (type, enum, minimum/maximum,
+    minLength/maxLength, items, minItems/maxItems, properties, required) into a checker that
+    returns error messages. Object schemas reject unknown properties.
+    """
+    type_names = [schema["type"]] if isinstance(schema.get("type"), str) else list(schema.get("type") or [])
+    type_checks = [_JSON_TYPES[name] for name in type_names if name in _JSON_TYPES]
+    enum = schema.get("enum")
+    minimum, maximum = schema.get("minimum"), schema.get("maximum")
+    min_length, max_length = schema.get("minLength"), schema.get("maxLength")
+    min_items, max_items = schema.get("minItems"), schema.get("maxItems")
+    item_check = compile_schema(schema["items"]) if isinstance(schema.get("items"), dict) else None
+    property_checks = {name: compile_schema(prop) for name, prop in (schema.get("properties") or {}).items()}
+    required = list(schema.get("required") or [])
+
+    def check(value: Any, path: str) -> List[str]:
+        label = path or "arguments"
+        if type_checks and not any(type_check(value) for type_check in type_checks):
+            return [f"{label}: expected {' or '.join(type_names)}, got {_json_type_name(value)}"]
+        errors: List[str] = []
+        if enum is not None and value not in enum:
+            errors.append(f"{label}: must be one of {enum}")
+        if _JSON_TYPES["number"](value):
+            if minimum is not None and value < minimum: errors.append(f"{label}: must be >= {minimum}")
+            if maximum is not None and value > maximum: errors.append(f"{label}: must be <= {maximum}")
+        elif isinstance(value, str):
+            if min_length is not None and len(value) < min_length: errors.append(f"{label}: must be at least {min_length} characters")
+            if max_length is not None and len(value) > max_length: errors.append(f"{label}: must be at most {max_length} characters")
+        elif isinstance(value, list):
+            if min_items is not None and len(value) < min_items: errors.append(f"{label}: needs at least {min_items} items")
+            if max_items is not None and len(value) > max_items: errors.append(f"{label}: allows at most {max_items} items")
+            if item_check:
+                for index, item in enumerate(value):
+                    errors.extend(item_check(item, f"{label}[{index}]"))
+        elif isinstance(value, dict) and (property_checks or required):
+            errors.extend(f"{path + '.' if path else ''}{name}: required" for name in required if name not in value)
+            for name, item in value.items():
+                item_path = f"{path}.{name}" if path else name
+                if name not in property_checks:
+                    errors.append(f"{item_path}: unknown parameter (expected {', '.join(property_checks)})")
+                else:
+                    errors.extend(property_checks[name](item, item_path))
+        return errors
+
+    return check
+
+
+def _coerce_scalar(value: Any, type_name: str) -> Any:
+    """Models often quote numbers and booleans; convert such strings before validating."""
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as exc:
-        print(f"Error fetching LessWrong post '{url}': {exc}")
-        return f"Error fetching LessWrong post: {exc}"
-
-    soup = BeautifulSoup(response.text, "html.parser")
-
-    title_elem = soup.find("h1", class_="PostsPageTitle-title")
-    title = title_elem.get_text(strip=True) if title_elem else ""
-
-    post_content = soup.find("div", class_=lambda value: value and "PostsPage-postContent" in value)
-    if not post_content:
-        post_content = soup.find("div", class_="PostsPage-postBody")
-
-    if not post_content:
-        return "Error: Could not find post content on the LessWrong page."
-
-    body = post_content.get_text(separator="\n\n", strip=True)
-
-    if title:
-        return f"{title}\n\n{body}" if body else title
-    return body or "Error: Post content was empty."
+        if type_name == "integer": return int(text)
+        if type_name == "number": return float(text) if any(char in text for char in ".eE") else int(text)
+    except ValueError:
+        return value
+    if type_name == "boolean" and text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    return value
+
+
+class ToolSpec:
+    """A registered tool: metadata, the compiled argument validator and its execution limits."""
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        parameters: Dict[str, Dict[str, Any]],
+        handler: Union[str, Callable[..., Any]],
+        timeout: float = DEFAULT_TOOL_TIMEOUT,
+        max_concurrency: int = DEFAULT_TOOL_CONCURRENCY,
+        cacheable: bool = False,
+        cache_ttl: Optional[float] = DEFAULT_CACHE_TTL,
+        max_output_chars: Optional[int] = DEFAULT_MAX_OUTPUT_CHARS,
+    ):
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.handler = LazyHandler(name, handler) if isinstance(handler, str) else handler
+        self.timeout = float(timeout)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.cacheable = cacheable
+        self.cache_ttl = cache_ttl
+        self.max_output_chars = max_output_chars
+        self.schema = parameters_schema(parameters)
+        self.openai_format = {"type": "function", "function": {"name": name, "description": description, "parameters": self.schema}}
+        self._check = compile_schema(self.schema)
+        self._coercions = {param: info["type"] for param, info in parameters.items() if info.get("type") in ("integer", "number", "boolean")}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict() # canonical arguments -> (expires_at, result)
+        self._cache_lock = threading.Lock()
+
+    @classmethod
+    def from_dict(cls, spec: Dict[str, Any]) -> "ToolSpec":
+        return cls(**spec)
+
+    def validate(self, arguments: Any) -> Dict[str, Any]:
+        """Returns the arguments with quoted scalars converted, or raises ToolArgumentError."""
+        if not isinstance(arguments, dict):
+            raise ToolArgumentError(self.name, [f"arguments: expected object, got {_json_type_name(arguments)}"])
+        arguments = {key: _coerce_scalar(value, self._coercions[key]) if key in self._coercions else value for key, value in arguments.items()}
+        errors = self._check(arguments, "")
+        if errors:
+            raise ToolArgumentError(self.name, errors)
+        return arguments
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    # --- Result cache ---
+    def _cache_key(self, arguments: Dict[str, Any]) -> str:
+        return json.dumps(arguments, sort_keys=True, default=str)
+
+    def cached(self, arguments: Dict[str, Any]) -> Optional[str]:
+        if not self.cacheable:
+            return None
+        key = self._cache_key(arguments)
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry[1]
+
+    def remember(self, arguments: Dict[str, Any], result: str) -> None:
+        if not self.cacheable or result.startswith("Error"): # Handlers report failures as "Error: ..." strings; those are retried
+            return
+        expires_at = time.monotonic() + self.cache_ttl if self.cache_ttl is not None else None
+        with self._cache_lock:
+            self._cache[self._cache_key(arguments)] = (expires_at, result)
+            self._cache.move_to_end(self._cache_key(arguments))
+            while len(self._cache) > TOOL_CACHE_ENTRIES:
+                self._cache.popitem(last=False)
+
+    def cap_output(self, text: str) -> str:
+        """Truncates text beyond max_output_chars; [IMAGE:base64:...] blocks don't count and are kept."""
+        limit = self.max_output_chars
+        if not limit or len(text) <= limit:
+            return text
+        images = IMAGE_BLOCK_PATTERN.findall(text)
+        body = IMAGE_BLOCK_PATTERN.sub("", text) if images else text
+        if len(body) <= limit:
+            return text
+        return body[:limit] + f"\n[... output truncated, {len(body) - limit} more characters]" + "".join(f"\n{image}" for image in images)
 
 
 def tool_add(a: Union[float, str], b: Union[float, str]) -> str:
@@ -275,231 +307,6 @@ def tool_add(a: Union[float, str], b: Union[float, str]) -> str:
         return f"Error performing addition: {exc}"
 
 
-def python_interpreter(code: str) -> str:
-    """
-    Execute Python code in a REPL-like environment and return the output.
-    
-    The last expression in the code will be automatically returned as output,
-    similar to a Jupyter notebook or Python REPL. Images (matplotlib plots, PIL images)
-    are automatically captured and returned as base64-encoded data.
-    
-    Arguments:
-        code (str): The Python code to execute.
-    
-    Returns:
-        str: The output from executing the code. Can include:
-             - The value of the last expression
-             - Any printed output (stdout)
-             - Base64-encoded images prefixed with [IMAGE:base64:...]
-             - Error messages if execution fails
-    """
-    import subprocess
-    import sys
-    import tempfile
-    import os
-    
-    if not code or not isinstance(code, str):
-        return "Error: Code must be a non-empty string."
-    
-    code = code.strip()
-    if not code:
-        return "Error: Code cannot be empty."
-    
-    # Create temp directory for our files
-    temp_dir = tempfile.mkdtemp()
-    user_code_file = os.path.join(temp_dir, 'user_code.py')
-    wrapper_file = os.path.join(temp_dir, 'wrapper.py')
-    
-    try:
-        # Write user code to a separate file
-        with open(user_code_file, 'w', encoding='utf-8') as f:
-            f.write(code)
-        
-        # Wrapper script that reads and executes the user code
-        wrapper_code = f'''
-import sys
-import io
-import base64
-import ast
-import traceback
-
-# Redirect stdout to capture prints
-_stdout_capture = io.StringIO()
-_original_stdout = sys.stdout
-sys.stdout = _stdout_capture
-
-_result = None
-_images = []
-
-def _capture_matplotlib():
-    """Capture any matplotlib figures as base64 images."""
-    try:
-        import matplotlib
-        matplotlib.use('Agg')  # Use non-interactive backend
-        import matplotlib.pyplot as plt
-        figs = [plt.figure(i) for i in plt.get_fignums()]
-        for fig in figs:
-            buf = io.BytesIO()
-            fig.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-            buf.seek(0)
-            img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-            _images.append(img_base64)
-            buf.close()
-        plt.close('all')
-    except ImportError:
-        pass
-    except Exception as e:
-        print(f"[Warning: Could not capture matplotlib figure: {{e}}]", file=_original_stdout)
-
-def _encode_pil_image(img):
-    """Encode a PIL image to base64."""
-    try:
-        buf = io.BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
-        return base64.b64encode(buf.read()).decode('utf-8')
-    except Exception as e:
-        return None
-
-def _is_pil_image(obj):
-    """Check if an object is a PIL Image."""
-    try:
-        from PIL import Image
-        return isinstance(obj, Image.Image)
-    except ImportError:
-        return False
-
-try:
-    # Read the user code from file
-    with open({repr(user_code_file)}, 'r', encoding='utf-8') as f:
-        _user_code = f.read()
-    
-    try:
-        _tree = ast.parse(_user_code)
-    except SyntaxError as e:
-        print(f"SyntaxError: {{e}}", file=_original_stdout)
-        sys.exit(1)
-    
-    # Check if last statement is an expression (not assignment, etc.)
-    _last_expr = None
-    if _tree.body and isinstance(_tree.body[-1], ast.Expr):
-        _last_expr = _tree.body.pop()
-    
-    # Execute all statements except the last expression
-    _exec_code = compile(ast.Module(body=_tree.body, type_ignores=[]), '<code>', 'exec')
-    _globals = {{'__name__': '__main__', '__builtins__': __builtins__}}
-    exec(_exec_code, _globals)
-    
-    # Evaluate the last expression if it exists
-    if _last_expr is not None:
-        _eval_code = compile(ast.Expression(body=_last_expr.value), '<expr>', 'eval')
-        _result = eval(_eval_code, _globals)
-    
-    # Check for matplotlib figures - but only if result is not already a figure
-    # (to avoid duplicate capture when user returns fig explicitly)
-    _is_mpl_figure = False
-    try:
-        import matplotlib.figure
-        _is_mpl_figure = isinstance(_result, matplotlib.figure.Figure)
-    except ImportError:
-        pass
-    
-    if not _is_mpl_figure:
-        _capture_matplotlib()
-    
-except Exception as e:
-    sys.stdout = _original_stdout
-    traceback.print_exc()
-    sys.exit(1)
-
-# Restore stdout
-sys.stdout = _original_stdout
-
-# Build output
-_output_parts = []
-
-# Add captured stdout
-_stdout_text = _stdout_capture.getvalue()
-if _stdout_text:
-    _output_parts.append(_stdout_text.rstrip())
-
-# Add images
-for img_b64 in _images:
-    _output_parts.append(f"[IMAGE:base64:{{img_b64}}]")
-
-# Add last expression result
-if _result is not None:
-    if _is_pil_image(_result):
-        img_b64 = _encode_pil_image(_result)
-        if img_b64:
-            _output_parts.append(f"[IMAGE:base64:{{img_b64}}]")
-        else:
-            _output_parts.append(repr(_result))
-    else:
-        # Check if result is a matplotlib figure
-        try:
-            import matplotlib.figure
-            if isinstance(_result, matplotlib.figure.Figure):
-                buf = io.BytesIO()
-                _result.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-                buf.seek(0)
-                img_b64 = base64.b64encode(buf.read()).decode('utf-8')
-                _output_parts.append(f"[IMAGE:base64:{{img_b64}}]")
-                buf.close()
-            else:
-                _output_parts.append(repr(_result))
-        except ImportError:
-            _output_parts.append(repr(_result))
-
-if _output_parts:
-    print("\\n".join(_output_parts))
-else:
-    print("(No output)")
-'''
-        
-        # Write wrapper code
-        with open(wrapper_file, 'w', encoding='utf-8') as f:
-            f.write(wrapper_code)
-        
-        # Run the wrapper code with a timeout
-        result = subprocess.run(
-            [sys.executable, wrapper_file],
-            capture_output=True,
-            text=True,
-            timeout=30,  # 30 second timeout
-            cwd=temp_dir
-        )
-        
-        output_parts = []
-        if result.stdout:
-            output_parts.append(result.stdout)
-        if result.stderr:
-            output_parts.append(f"STDERR:\n{result.stderr}")
-        
-        output = "\n".join(output_parts).strip()
-        
-        if not output:
-            output = "(No output)"
-        
-        if result.returncode != 0 and "Error" not in output and "Traceback" not in output:
-            output = f"Exit code: {result.returncode}\n{output}"
-        
-        return output
-        
-    except subprocess.TimeoutExpired:
-        return "Error: Code execution timed out (30 second limit)."
-    except Exception as exc:
-        return f"Error executing Python code: {exc}"
-    finally:
-        # Clean up temporary files
-        import shutil
-        try:
-            if 'temp_dir' in locals():
-                shutil.rmtree(temp_dir, ignore_errors=True)
-        except:
-            pass
-
-
 TOOL_SPECS: List[Dict[str, Any]] = [
     {
         "name": "add",
@@ -508,7 +315,10 @@ TOOL_SPECS: List[Dict[str, Any]] = [
             "a": {"type": "number", "description": "First addend."},
             "b": {"type": "number", "description": "Second addend."}
         },
-        "handler": tool_add,
+        "handler": "tools:tool_add",
+        "timeout": 5,
+        "cacheable": True,
+        "cache_ttl": None,
     },
     {
         "name": "search",
@@ -516,7 +326,10 @@ TOOL_SPECS: List[Dict[str, Any]] = [
         "parameters": {
             "query": {"type": "string", "description": "Search query string."}
         },
-        "handler": search,
+        "handler": "tools_web:search",
+        "timeout": 20,
+        "cacheable": True,
+        "max_output_chars": 8000,
     },
     {
         "name": "scrape",
@@ -524,7 +337,33 @@ TOOL_SPECS: List[Dict[str, Any]] = [
         "parameters": {
             "url": {"type": "string", "description": "Fully qualified URL to scrape."}
         },
-        "handler": scrape,
+        "handler": "tools_web:scrape",
+        "timeout": 30,
+        "cacheable": True,
+        "max_output_chars": 12000,
+    },
+    {
+        "name": "scrape_many",
+        "description": "Fetches and extracts readable text from several webpages in parallel (up to 10 URLs per call). Prefer this over repeated scrape calls.",
+        "parameters": {
+            "urls": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 10, "description": "Fully qualified URLs to scrape."}
+        },
+        "handler": "tools_web:scrape_many",
+        "timeout": 60,
+        "max_concurrency": 2,
+        "cacheable": True,
+    },
+    {
+        "name": "search_and_read",
+        "description": "Runs a Google Custom Search query and returns the extracted text of the top result pages, fetched in parallel.",
+        "parameters": {
+            "query": {"type": "string", "description": "Search query string."},
+            "top_k": {"type": "integer", "description": "Number of result pages to read (1-10, default 3).", "minimum": 1, "maximum": 10, "optional": True}
+        },
+        "handler": "tools_web:search_and_read",
+        "timeout": 60,
+        "max_concurrency": 2,
+        "cacheable": True,
     },
     {
         "name": "get_lesswrong_post",
@@ -532,7 +371,10 @@ TOOL_SPECS: List[Dict[str, Any]] = [
         "parameters": {
             "url": {"type": "string", "description": "Fully qualified LessWrong post URL."}
         },
-        "handler": get_lesswrong_post,
+        "handler": "tools_web:get_lesswrong_post",
+        "timeout": 30,
+        "cacheable": True,
+        "cache_ttl": 3600,
     },
     {
         "name": "python_interpreter",
@@ -557,23 +399,51 @@ Use for: calculations, data analysis, generating charts/plots, image manipulatio
         "parameters": {
             "code": {"type": "string", "description": "The Python code to execute. The last expression's value is returned."}
         },
-        "handler": python_interpreter,
+        "handler": "tools_python:python_interpreter",
+        "timeout": 45, # The sandbox subprocess has its own 30 s limit
+        "max_concurrency": 2,
+        "max_output_chars": 20000,
     },
 ]
 
 
-TOOL_REGISTRY: Dict[str, Callable[..., Union[str, Dict[str, Any]]]] = {
-    spec["name"]: spec["handler"] for spec in TOOL_SPECS
-}
+def _discover_plugin_specs() -> List[Dict[str, Any]]:
+    """Tool specs contributed by installed packages through the zeryo.tools entry point group."""
+    specs: List[Dict[str, Any]] = []
+    for entry_point in entry_points(group=TOOL_ENTRY_POINT_GROUP):
+        try:
+            loaded = entry_point.load()
+            specs.extend(loaded() if callable(loaded) else loaded)
+        except Exception as exc:
+            logger.warning("Skipping tool plugin '%s': %s", entry_point.name, exc)
+    return specs
+
+
+def _build_tools() -> Dict[str, ToolSpec]:
+    tools: Dict[str, ToolSpec] = {}
+    for spec in TOOL_SPECS + _discover_plugin_specs():
+        if spec.get("name") in tools:
+            logger.warning("Ignoring duplicate tool '%s'.", spec.get("name"))
+            continue
+        try:
+            tools[spec["name"]] = ToolSpec.from_dict(spec)
+        except (KeyError, TypeError, ValueError) as exc:
+            logger.warning("Skipping invalid tool spec '%s': %s", spec.get("name"), exc)
+    return tools
+
+
+TOOLS: Dict[str, ToolSpec] = _build_tools()
+
+TOOL_REGISTRY: Dict[str, Callable[..., Union[str, Dict[str, Any]]]] = {name: tool.handler for name, tool in TOOLS.items()}
 
 
 TOOL_DEFINITIONS: List[Dict[str, Any]] = [
     {
-        "name": spec["name"],
-        "description": spec["description"],
-        "parameters": spec["parameters"],
+        "name": tool.name,
+        "description": tool.description,
+        "parameters": tool.parameters,
     }
-    for spec in TOOL_SPECS
+    for tool in TOOLS.values()
 ]
 
 
@@ -607,56 +477,57 @@ def convert_tools_to_openai_format(tool_definitions: List[Dict[str, Any]]) -> Li
             }
         }
     }
+
+    Parameters marked "optional" or given a "default" are left out of "required".
     """
-    openai_tools = []
-    
-    for tool_def in tool_definitions:
-        name = tool_def.get("name", "")
-        description = tool_def.get("description", "")
-        params = tool_def.get("parameters", {})
-        
-        # Build OpenAI-style parameters schema
-        properties = {}
-        required = []
-        
-        for param_name, param_info in params.items():
-            param_type = param_info.get("type", "string")
-            param_desc = param_info.get("description", "")
-            
-            properties[param_name] = {
-                "type": param_type,
-                "description": param_desc
-            }
-            
-            # Assume all parameters are required unless marked optional
-            if not param_info.get("optional", False):
-                required.append(param_name)
-        
-        openai_tool = {
+    return [
+        {
             "type": "function",
             "function": {
-                "name": name,
-                "description": description,
-                "parameters": {
-                    "type": "object",
-                    "properties": properties,
-                    "required": required
-                }
+                "name": tool_def.get("name", ""),
+                "description": tool_def.get("description", ""),
+                "parameters": parameters_schema(tool_def.get("parameters", {})),
             }
         }
-        
-        openai_tools.append(openai_tool)
-    
-    return openai_tools
+        for tool_def in tool_definitions
+    ]
 
 
 # Pre-computed OpenAI format tools for efficiency
-TOOLS_OPENAI_FORMAT: List[Dict[str, Any]] = convert_tools_to_openai_format(TOOL_DEFINITIONS)
+TOOLS_OPENAI_FORMAT: List[Dict[str, Any]] = [tool.openai_format for tool in TOOLS.values()]
+
+
+def preload_tools(names: Optional[List[str]] = None) -> None:
+    """Imports tool handlers ahead of time (e.g. at worker startup) instead of on first call."""
+    for name, handler in TOOL_REGISTRY.items():
+        if isinstance(handler, LazyHandler) and (names is None or name in names):
+            try: handler.resolve()
+            except Exception as exc: logger.warning("Could not preload tool '%s': %s", name, exc)
+
+
+def import_report() -> List[Dict[str, Any]]:
+    """Import cost of each tool handler loaded so far in this process."""
+    report = []
+    for name, handler in TOOL_REGISTRY.items():
+        if not isinstance(handler, LazyHandler):
+            report.append({"name": name, "handler": getattr(handler, "__qualname__", repr(handler)), "loaded": True, "import_ms": None, "modules_loaded": None, "over_budget": False})
+            continue
+        report.append({
+            "name": name,
+            "handler": handler.target,
+            "loaded": handler.loaded,
+            "import_ms": handler.import_ms,
+            "modules_loaded": handler.modules_loaded,
+            "over_budget": bool(handler.import_ms and handler.import_ms > TOOL_IMPORT_BUDGET_MS),
+        })
+    return report
 
 
-# Example usage (optional, for testing)
 if __name__ == "__main__":
-    search_query = "what is a capybara"
-    print(search(search_query))
-    print("-" * 20)
-    print(tool_add(2, 3))
\ No newline at end of file
+    # Cold import cost per tool, in registry order; modules shared between tools are charged to the first one
+    preload_tools()
+    print(f"{'tool':<22}{'import ms':>10}{'new modules':>13}  handler")
+    for entry in import_report():
+        import_ms = "-" if entry["import_ms"] is None else f"{entry['import_ms']:.1f}"
+        modules = "-" if entry["modules_loaded"] is None else str(entry["modules_loaded"])
+        print(f"{entry['name']:<22}{import_ms:>10}{modules:>13}  {entry['handler']}{'  (over budget)' if entry['over_budget'] else ''}")
@@ -0,0 +1,230 @@
+# tools_python.py
+"""
+python_interpreter tool handler: runs code in a subprocess and returns the REPL-style
+result, stdout and captured images.
+"""
+
+
+def python_interpreter(code: str) -> str:
+    """
+    Execute Python code in a REPL-like environment and return the output.
+    
+    The last expression in the code will be automatically returned as output,
+    similar to a Jupyter notebook or Python REPL. Images (matplotlib plots, PIL images)
+    are automatically captured and returned as base64-encoded data.
+    
+    Arguments:
+        code (str): The Python code to execute.
+    
+    Returns:
+        str: The output from executing the code. Can include:
+             - The value of the last expression
+             - Any printed output (stdout)
+             - Base64-encoded images prefixed with [IMAGE:base64:...]
+             - Error messages if execution fails
+    """
+    import subprocess
+    import sys
+    import tempfile
+    import os
+    
+    if not code or not isinstance(code, str):
+        return "Error: Code must be a non-empty string."
+    
+    code = code.strip()
+    if not code:
+        return "Error: Code cannot be empty."
+    
+    # Create temp directory for our files
+    temp_dir = tempfile.mkdtemp()
+    user_code_file = os.path.join(temp_dir, 'user_code.py')
+    wrapper_file = os.path.join(temp_dir, 'wrapper.py')
+    
+    try:
+        # Write user code to a separate file
+        with open(user_code_file, 'w', encoding='utf-8') as f:
+            f.write(code)
+        
+        # Wrapper script that reads and executes the user code
+        wrapper_code = f'''
+import sys
+import io
+import base64
+import ast
+import traceback
+
+# Redirect stdout to capture prints
+_stdout_capture = io.StringIO()
+_original_stdout = sys.stdout
+sys.stdout = _stdout_capture
+
+_result = None
+_images = []
+
+def _capture_matplotlib():
+    """Capture any matplotlib figures as base64 images."""
+    try:
+        import matplotlib
+        matplotlib.use('Agg')  # Use non-interactive backend
+        import matplotlib.pyplot as plt
+        figs = [plt.figure(i) for i in plt.get_fignums()]
+        for fig in figs:
+            buf = io.BytesIO()
+            fig.savefig(buf, format='png', bbox_inches='tight', dpi=100)
+            buf.seek(0)
+            img_base64 = base64.b64encode(buf.read()).decode('utf-8')
+            _images.append(img_base64)
+            buf.close()
+        plt.close('all')
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"[Warning: Could not capture matplotlib figure: {{e}}]", file=_original_stdout)
+
+def _encode_pil_image(img):
+    """Encode a PIL image to base64."""
+    try:
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        buf.seek(0)
+        return base64.b64encode(buf.read()).decode('utf-8')
+    except Exception as e:
+        return None
+
+def _is_pil_image(obj):
+    """Check if an object is a PIL Image."""
+    try:
+        from PIL import Image
+        return isinstance(obj, Image.Image)
+    except ImportError:
+        return False
+
+try:
+    # Read the user code from file
+    with open({repr(user_code_file)}, 'r', encoding='utf-8') as f:
+        _user_code = f.read()
+    
+    try:
+        _tree = ast.parse(_user_code)
+    except SyntaxError as e:
+        print(f"SyntaxError: {{e}}", file=_original_stdout)
+        sys.exit(1)
+    
+    # Check if last statement is an expression (not assignment, etc.)
+    _last_expr = None
+    if _tree.body and isinstance(_tree.body[-1], ast.Expr):
+        _last_expr = _tree.body.pop()
+    
+    # Execute all statements except the last expression
+    _exec_code = compile(ast.Module(body=_tree.body, type_ignores=[]), '<code>', 'exec')
+    _globals = {{'__name__': '__main__', '__builtins__': __builtins__}}
+    exec(_exec_code, _globals)
+    
+    # Evaluate the last expression if it exists
+    if _last_expr is not None:
+        _eval_code = compile(ast.Expression(body=_last_expr.value), '<expr>', 'eval')
+        _result = eval(_eval_code, _globals)
+    
+    # Check for matplotlib figures - but only if result is not already a figure
+    # (to avoid duplicate capture when user returns fig explicitly)
+    _is_mpl_figure = False
+    try:
+        import matplotlib.figure
+        _is_mpl_figure = isinstance(_result, matplotlib.figure.Figure)
+    except ImportError:
+        pass
+    
+    if not _is_mpl_figure:
+        _capture_matplotlib()
+    
+except Exception as e:
+    sys.stdout = _original_stdout
+    traceback.print_exc()
+    sys.exit(1)
+
+# Restore stdout
+sys.stdout = _original_stdout
+
+# Build output
+_output_parts = []
+
+# Add captured stdout
+_stdout_text = _stdout_capture.getvalue()
+if _stdout_text:
+    _output_parts.append(_stdout_text.rstrip())
+
+# Add images
+for img_b64 in _images:
+    _output_parts.append(f"[IMAGE:base64:{{img_b64}}]")
+
+# Add last expression result
+if _result is not None:
+    if _is_pil_image(_result):
+        img_b64 = _encode_pil_image(_result)
+        if img_b64:
+            _output_parts.append(f"[IMAGE:base64:{{img_b64}}]")
+        else:
+            _output_parts.append(repr(_result))
+    else:
+        # Check if result is a matplotlib figure
+        try:
+            import matplotlib.figure
+            if isinstance(_result, matplotlib.figure.Figure):
+                buf = io.BytesIO()
+                _result.savefig(buf, format='png', bbox_inches='tight', dpi=100)
+                buf.seek(0)
+                img_b64 = base64.b64encode(buf.read()).decode('utf-8')
+                _output_parts.append(f"[IMAGE:base64:{{img_b64}}]")
+                buf.close()
+            else:
+                _output_parts.append(repr(_result))
+        except ImportError:
+            _output_parts.append(repr(_result))
+
+if _output_parts:
+    print("\\n".join(_output_parts))
+else:
+    print("(No output)")
+'''
+        
+        # Write wrapper code
+        with open(wrapper_file, 'w', encoding='utf-8') as f:
+            f.write(wrapper_code)
+        
+        # Run the wrapper code with a timeout
+        result = subprocess.run(
+            [sys.executable, wrapper_file],
+            capture_output=True,
+            text=True,
+            timeout=30,  # 30 second timeout
+            cwd=temp_dir
+        )
+        
+        output_parts = []
+        if result.stdout:
+            output_parts.append(result.stdout)
+        if result.stderr:
+            output_parts.append(f"STDERR:\n{result.stderr}")
+        
+        output = "\n".join(output_parts).strip()
+        
+        if not output:
+            output = "(No output)"
+        
+        if result.returncode != 0 and "Error" not in output and "Traceback" not in output:
+            output = f"Exit code: {result.returncode}\n{output}"
+        
+        return output
+        
+    except subprocess.TimeoutExpired:
+        return "Error: Code execution timed out (30 second limit)."
+    except Exception as exc:
+        return f"Error executing Python code: {exc}"
+    finally:
+        # Clean up temporary files
+        import shutil
+        try:
+            if 'temp_dir' in locals():
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        except:
+            pass
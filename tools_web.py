@@ -0,0 +1,374 @@
+# tools_web.py
+"""
+Web tool handlers: Google Custom Search, page scraping (trafilatura) and LessWrong posts.
+
+Imported lazily through the tool registry in tools.py on the first call to one of these
+tools, so requests, bs4 and trafilatura are not loaded by workers that never use them.
+"""
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Union, Any, Optional
+
+import requests
+import yaml
+
+from bs4 import BeautifulSoup
+import trafilatura
+
+logger = logging.getLogger(__name__)
+
+
+def _load_yaml_file(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as handle:
+            data = yaml.safe_load(handle) or {}
+            return data if isinstance(data, dict) else {}
+    except Exception as exc:
+        logger.warning("Failed to load YAML file %s: %s", path, exc)
+        return {}
+
+
+API_KEYS_PATH = os.environ.get("API_KEYS_PATH", "api_keys.yaml")
+SEARCH_KEYS_PATH = os.environ.get("SEARCH_API_KEYS_PATH", "search_api_keys.yaml")
+
+
+def _extract_key(data: Dict[str, Any], *candidates: str) -> str | None:
+    for key in candidates:
+        if key in data and data[key]:
+            return data[key]
+        lower_key = key.lower()
+        if lower_key in data and data[lower_key]:
+            return data[lower_key]
+    return None
+
+
+def load_keys(api_keys: Optional[Dict[str, Any]] = None, search_keys: Optional[Dict[str, Any]] = None) -> None:
+    """(Re)loads the search credentials; the config watcher passes freshly validated file contents."""
+    global API_KEYS, SEARCH_KEYS, GOOGLE_SEARCH_API_KEY, GOOGLE_SEARCH_ENGINE_ID
+    api_keys = _load_yaml_file(API_KEYS_PATH) if api_keys is None else api_keys
+    search_keys = _load_yaml_file(SEARCH_KEYS_PATH) if search_keys is None else search_keys
+    api_key = (
+        _extract_key(search_keys, "SEARCH_API_KEY", "GOOGLE_CUSTOM_SEARCH_API_KEY", "GOOGLE_SEARCH_API_KEY")
+        or _extract_key(api_keys, "SEARCH_API_KEY", "GOOGLE_CUSTOM_SEARCH_API_KEY", "GOOGLE_SEARCH_API_KEY", "GOOGLE")
+    )
+    engine_id = (
+        _extract_key(search_keys, "SEARCH_ENGINE_ID", "GOOGLE_CUSTOM_SEARCH_CX", "GOOGLE_SEARCH_ENGINE_ID")
+        or _extract_key(api_keys, "SEARCH_ENGINE_ID", "GOOGLE_CUSTOM_SEARCH_CX", "GOOGLE_SEARCH_ENGINE_ID")
+    )
+    API_KEYS, SEARCH_KEYS, GOOGLE_SEARCH_API_KEY, GOOGLE_SEARCH_ENGINE_ID = api_keys, search_keys, api_key, engine_id
+
+
+API_KEYS: Dict[str, Any] = {}
+SEARCH_KEYS: Dict[str, Any] = {}
+GOOGLE_SEARCH_API_KEY: Optional[str] = None
+GOOGLE_SEARCH_ENGINE_ID: Optional[str] = None
+load_keys()
+
+def _google_search_items(query: str, max_results: int, safe_search: str) -> tuple[List[Dict[str, Any]], str | None]:
+    """Run a Google Custom Search query. Returns (items, error_message)."""
+    api_key, engine_id = GOOGLE_SEARCH_API_KEY, GOOGLE_SEARCH_ENGINE_ID # One consistent pair even if load_keys() runs meanwhile
+    if not api_key or not engine_id:
+        return [], (
+            "Error: Google Custom Search credentials are missing. "
+            "Populate SEARCH_API_KEY and SEARCH_ENGINE_ID in search_api_keys.yaml (or set SEARCH_API_KEYS_PATH)."
+        )
+
+    params = {
+        "key": api_key,
+        "cx": engine_id,
+        "q": query.strip(),
+        "num": max(1, min(int(max_results), 10)),
+    }
+    if safe_search:
+        params["safe"] = safe_search
+
+    try:
+        response = requests.get("https://www.googleapis.com/customsearch/v1", params=params, timeout=10)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as exc:
+        logger.error("Error during Google Custom Search request for '%s': %s", query, exc)
+        return [], f"Search results for '{query}':\n\nError performing search: {exc}"
+
+    data = response.json()
+    items = data.get("items", [])
+    if not items:
+        error_message = data.get("error", {}).get("message")
+        if error_message:
+            return [], f"Search results for '{query}':\n\nError from Google Custom Search API: {error_message}"
+        return [], f"Search results for '{query}':\n\nNo results found."
+    return items[: params["num"]], None
+
+
+def search(query: str, *, max_results: int = 5, safe_search: str = "off") -> str:
+    """Perform a Google Custom Search query and format the top results."""
+    if not query or not query.strip():
+        return "Error: Search query must be a non-empty string."
+
+    items, error = _google_search_items(query, max_results, safe_search)
+    if error:
+        return error
+
+    results_lines = [f"Search results for '{query}':", ""]
+    for index, item in enumerate(items, start=1):
+        title = item.get("title") or "(No title provided)"
+        link = item.get("link") or item.get("formattedUrl") or "(No link provided)"
+        snippet = (item.get("snippet") or item.get("htmlSnippet") or "").replace("\n", " ").strip()
+        results_lines.append(f"{index}. {title}")
+        results_lines.append(f"   URL: {link}")
+        if snippet:
+            results_lines.append(f"   Snippet: {snippet}")
+        results_lines.append("")
+
+    return "\n".join(results_lines).strip()
+
+
+def scrape(url: str, *, timeout: float = 10, max_chars: int = 8192) -> str:
+    """Download and extract cleaned text content from a webpage using trafilatura."""
+    if not url or not isinstance(url, str):
+        return "Error: URL must be a non-empty string."
+
+    if trafilatura is None:
+        return "Error: trafilatura is not installed. Please add it to your environment to use the scrape tool."
+
+    try:
+        # Use requests with a bounded timeout, then pass HTML to trafilatura
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+        }
+        response = requests.get(url, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        downloaded = response.text
+    except requests.exceptions.Timeout:
+        return f"Error: Request timed out ({timeout:g} second limit)."
+    except requests.exceptions.RequestException as exc:
+        logger.error("Error fetching URL '%s': %s", url, exc)
+        return f"Error fetching URL: {exc}"
+
+    if not downloaded:
+        return "Error: Unable to download the requested page."
+
+    try:
+        result = trafilatura.bare_extraction(downloaded)
+    except Exception as exc:
+        logger.error("Error extracting content from '%s': %s", url, exc)
+        return f"Error extracting content: {exc}"
+
+    def _normalize_extraction(data: Any) -> tuple[str, str]:
+        text_value = ""
+        description_value = ""
+
+        if isinstance(data, dict):
+            text_value = (data.get("text") or "").strip()
+            description_value = (
+                data.get("description")
+                or data.get("title")
+                or ""
+            ).strip()
+        elif isinstance(data, str):
+            text_value = data.strip()
+        elif data is not None and hasattr(data, "text_content"):
+            try:
+                text_value = data.text_content().strip()
+            except Exception:
+                text_value = ""
+
+        return text_value, description_value
+
+    text, description = _normalize_extraction(result)
+
+    if not text:
+        try:
+            json_payload = trafilatura.extract(
+                downloaded,
+                output_format="json",
+                include_comments=False,
+                include_tables=False,
+            )
+        except Exception as exc:
+            logger.debug("Fallback JSON extraction failed for '%s': %s", url, exc)
+            json_payload = None
+
+        if json_payload:
+            try:
+                json_data = json.loads(json_payload)
+            except json.JSONDecodeError:
+                json_data = None
+
+            if isinstance(json_data, dict):
+                text, metadata_description = _normalize_extraction(json_data)
+                if metadata_description:
+                    description = description or metadata_description
+
+    if not text:
+        try:
+            fallback_text = trafilatura.extract(downloaded)
+            if isinstance(fallback_text, str):
+                text = fallback_text.strip()
+        except Exception as exc:
+            logger.debug("Fallback plain extraction failed for '%s': %s", url, exc)
+
+    if not text:
+        return "No extractable content found at the provided URL."
+
+    if len(text) <= max_chars:
+        return text
+
+    # Provide a short summary when the content exceeds the maximum length.
+    excerpt = text[:max_chars].strip()
+    summary_lines = [
+        f"Summary (content truncated because it exceeded {max_chars} characters)."
+    ]
+    if description:
+        summary_lines.append(f"Description: {description}")
+    if excerpt:
+        summary_lines.append(f"Excerpt: {excerpt}...")
+
+    return "\n".join(summary_lines)
+
+
+MAX_BATCH_URLS = 10
+
+
+def _normalize_url_list(urls: Union[List[str], str]) -> List[str]:
+    """Accept a list of URLs or a comma/newline separated string; drop blanks and duplicates."""
+    if isinstance(urls, str):
+        urls = urls.replace(",", "\n").splitlines()
+    if not isinstance(urls, list):
+        return []
+    seen = set()
+    normalized = []
+    for url in urls:
+        if not isinstance(url, str):
+            continue
+        url = url.strip()
+        if url and url not in seen:
+            seen.add(url)
+            normalized.append(url)
+    return normalized
+
+
+def _scrape_concurrently(urls: List[str], timeout: float, max_total_chars: int) -> List[tuple[str, str]]:
+    """
+    Scrape several URLs in parallel threads. Each page gets an equal share of
+    max_total_chars, and pages still running after the per-URL timeout (plus a
+    small grace period for extraction) are reported as timed out instead of
+    blocking the whole batch.
+    """
+    per_page_chars = max(256, max_total_chars // max(1, len(urls)))
+    executor = ThreadPoolExecutor(max_workers=min(len(urls), MAX_BATCH_URLS))
+    try:
+        futures = {url: executor.submit(scrape, url, timeout=timeout, max_chars=per_page_chars) for url in urls}
+        wait(futures.values(), timeout=timeout + 5)
+        results = []
+        for url, future in futures.items():
+            if not future.done():
+                results.append((url, f"Error: Request timed out ({timeout:g} second limit)."))
+                continue
+            try:
+                results.append((url, future.result()))
+            except Exception as exc:
+                results.append((url, f"Error fetching URL: {exc}"))
+        return results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _format_page_results(results: List[tuple[str, str]], max_total_chars: int, titles: Dict[str, str] | None = None) -> str:
+    titles = titles or {}
+    sections = []
+    remaining = max_total_chars
+    for index, (url, text) in enumerate(results, start=1):
+        header = f"[{index}] {titles[url]}\nURL: {url}" if titles.get(url) else f"[{index}] URL: {url}"
+        if remaining <= 0:
+            sections.append(f"{header}\n(Omitted: total output budget of {max_total_chars} characters reached.)")
+            continue
+        if len(text) > remaining:
+            text = text[:remaining].rstrip() + "..."
+        remaining -= len(text)
+        sections.append(f"{header}\n{text}")
+    return "\n\n".join(sections)
+
+
+def scrape_many(urls: Union[List[str], str], *, timeout: float = 10, max_total_chars: int = 24000) -> str:
+    """Scrape several webpages concurrently and return their extracted text, one section per URL."""
+    url_list = _normalize_url_list(urls)
+    if not url_list:
+        return "Error: urls must be a non-empty list of URLs."
+    if len(url_list) > MAX_BATCH_URLS:
+        return f"Error: At most {MAX_BATCH_URLS} URLs can be scraped in one call (got {len(url_list)})."
+
+    timeout = max(1.0, min(float(timeout), 30.0))
+    results = _scrape_concurrently(url_list, timeout, int(max_total_chars))
+    return _format_page_results(results, int(max_total_chars))
+
+
+def search_and_read(query: str, *, top_k: int = 3, timeout: float = 10, max_total_chars: int = 24000) -> str:
+    """Run a Google Custom Search query and fetch the top-k result pages in parallel."""
+    if not query or not query.strip():
+        return "Error: Search query must be a non-empty string."
+
+    top_k = max(1, min(int(top_k), MAX_BATCH_URLS))
+    items, error = _google_search_items(query, top_k, "off")
+    if error:
+        return error
+
+    titles = {}
+    urls = []
+    for item in items:
+        link = item.get("link")
+        if link and link not in titles:
+            titles[link] = item.get("title") or ""
+            urls.append(link)
+    if not urls:
+        return f"Search results for '{query}':\n\nNo results with links found."
+
+    timeout = max(1.0, min(float(timeout), 30.0))
+    results = _scrape_concurrently(urls, timeout, int(max_total_chars))
+    return f"Search results for '{query}' (top {len(urls)} pages):\n\n" + _format_page_results(results, int(max_total_chars), titles)
+
+
+def get_lesswrong_post(url: str) -> str:
+    """Fetch the main LessWrong post content (title and body) without comments or sidebar."""
+    if not url or not isinstance(url, str):
+        return "Error: URL must be a non-empty string."
+
+    if BeautifulSoup is None:
+        return "Error: BeautifulSoup (bs4) is not installed."
+
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    }
+
+    try:
+        response = requests.get(url, headers=headers, timeout=15)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as exc:
+        logger.error("Error fetching LessWrong post '%s': %s", url, exc)
+        return f"Error fetching LessWrong post: {exc}"
+
+    soup = BeautifulSoup(response.text, "html.parser")
+
+    title_elem = soup.find("h1", class_="PostsPageTitle-title")
+    title = title_elem.get_text(strip=True) if title_elem else ""
+
+    post_content = soup.find("div", class_=lambda value: value and "PostsPage-postContent" in value)
+    if not post_content:
+        post_content = soup.find("div", class_="PostsPage-postBody")
+
+    if not post_content:
+        return "Error: Could not find post content on the LessWrong page."
+
+    body = post_content.get_text(separator="\n\n", strip=True)
+
+    if title:
+        return f"{title}\n\n{body}" if body else title
+    return body or "Error: Post content was empty."
+
+
+if __name__ == "__main__":
+    search_query = "what is a capybara"
+    print(search(search_query))
@@ -0,0 +1,63 @@
+# tracing.py
+"""
+Per-generation span timeline.
+
+A GenerationTrace records named spans (with durations) and marks (points in time)
+relative to the start of a generation. api.py persists the timeline against the
+messages the generation produced and summarizes it in the `timing` SSE event.
+"""
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class GenerationTrace:
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or str(uuid.uuid4())
+        self.started_at = time.perf_counter()
+        self.created_at = time.time()
+        self.spans: List[Dict[str, Any]] = []
+
+    def _offset_ms(self, at: float) -> float:
+        return round((at - self.started_at) * 1000, 2)
+
+    def add(self, name: str, start: float, end: Optional[float] = None, **attrs: Any) -> None:
+        """Records a span from perf_counter() timestamps; without `end` it is a point-in-time mark."""
+        entry: Dict[str, Any] = {"name": name, "start_ms": self._offset_ms(start)}
+        if end is not None:
+            entry["duration_ms"] = round((end - start) * 1000, 2)
+        entry.update({key: value for key, value in attrs.items() if value is not None})
+        self.spans.append(entry)
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+        """Times the wrapped block. Attributes added to the yielded dict are stored with the span."""
+        start = time.perf_counter()
+        extra: Dict[str, Any] = {}
+        try:
+            yield extra
+        finally:
+            self.add(name, start, time.perf_counter(), **attrs, **extra)
+
+    def total_ms(self) -> float:
+        return self._offset_ms(time.perf_counter())
+
+    def summary(self) -> Dict[str, Any]:
+        """Compact totals per span name, plus time to first token, for the `timing` SSE event."""
+        totals: Dict[str, float] = {}
+        counts: Dict[str, int] = {}
+        first_token_ms = None
+        for entry in self.spans:
+            if entry["name"] == "first_token" and first_token_ms is None:
+                first_token_ms = entry["start_ms"]
+            if "duration_ms" in entry:
+                totals[entry["name"]] = round(totals.get(entry["name"], 0.0) + entry["duration_ms"], 2)
+                counts[entry["name"]] = counts.get(entry["name"], 0) + 1
+        return {
+            "trace_id": self.trace_id,
+            "total_ms": self.total_ms(),
+            "first_token_ms": first_token_ms,
+            "spans_ms": totals,
+            "span_counts": counts,
+        }